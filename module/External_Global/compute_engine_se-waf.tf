@@ -49,22 +49,47 @@ resource "google_compute_instance" "gce_se_waf" {
 
   machine_type = each.value.machine_type
 
-  metadata = {
+  # With se_waf_config, its host directory is mounted in the container and the
+  # startup script keeps the rules file in it in sync with the metadata
+  metadata = merge({
     gce-container-declaration = yamlencode({
-      "spec" : {
+      "spec" : merge({
         "containers" : [
-          {
+          merge({
             "name" : "instance-1",
             "image" : each.value.container_id,
             "env" : each.value.env,
             "stdin" : false,
             "tty" : false
-          }
+          }, {
+            for key, value in {
+              "volumeMounts" : [{
+                "name" : "se-waf-config",
+                "mountPath" : local.se_waf_config_dir,
+                "readOnly" : true
+              }]
+            } : key => value if each.value.se_waf_config != null
+          })
         ],
         "restartPolicy" : "Always"
-      }
+      }, {
+        for key, value in {
+          "volumes" : [{
+            "name" : "se-waf-config",
+            "hostPath" : { "path" : local.se_waf_config_host_dir }
+          }]
+        } : key => value if each.value.se_waf_config != null
+      })
     })
-  }
+  }, {
+    for key, value in {
+      se-waf-config  = each.value.se_waf_config
+      startup-script = templatefile("${path.module}/templates/se_waf_config_sync.tftpl", {
+        config_dir  = local.se_waf_config_host_dir
+        config_file = "${local.se_waf_config_host_dir}/config.json"
+      })
+    } : key => value if each.value.se_waf_config != null
+  })
 
   network_interface {
     subnetwork = each.value.subnetwork
@@ -15,6 +15,10 @@ locals {
 
   random_suffix = try(var.random_suffix, random_id.suffix.hex)
 
+  # se-waf-config is kept in sync on the host directory, mounted in the container
+  se_waf_config_host_dir = "/var/lib/se-waf"
+  se_waf_config_dir      = "/etc/se-waf"
+
   instance_configurations = { for instance in flatten([
     for configuration in var.instance_configurations : [
       for idx in range(configuration.instance_count) : {
@@ -23,6 +27,13 @@ locals {
         subnetwork   = configuration.subnetwork
         container_id = configuration.container_id
         machine_type = configuration.machine_type
+        # Unset rules are left out, so they don't override the environment
+        se_waf_config = try(jsonencode({
+          for key, value in coalesce(
+            try(configuration.se_waf_config, null),
+            var.global_se_waf_config,
+          ) : key => value if value != null
+        }), null)
         env = [
           {
             name = "se_debug",
@@ -38,6 +49,20 @@ locals {
               var.global_se_waf_env.se_require_iap,
             ))
           },
+          {
+            name = "se_iap_audience",
+            value = try(coalesce(
+              try(configuration.se_waf_env.se_iap_audience, null),
+              var.global_se_waf_env.se_iap_audience,
+            ), "")
+          },
+          {
+            name = "se_iap_keys_source",
+            value = try(coalesce(
+              try(configuration.se_waf_env.se_iap_keys_source, null),
+              var.global_se_waf_env.se_iap_keys_source,
+            ), "")
+          },
           {
             name = "se_allowed_ipv4_cidr_ranges",
             value = try(join(",", coalesce(
@@ -51,6 +76,157 @@ locals {
               try(configuration.se_waf_env.se_denied_ipv4_cidr_ranges, null),
               var.global_se_waf_env.se_denied_ipv4_cidr_ranges,
             )), "")
+          },
+          {
+            name = "se_allowed_ipv6_cidr_ranges",
+            value = try(join(",", coalesce(
+              try(configuration.se_waf_env.se_allowed_ipv6_cidr_ranges, null),
+              var.global_se_waf_env.se_allowed_ipv6_cidr_ranges,
+            )), "")
+          },
+          {
+            name = "se_denied_ipv6_cidr_ranges",
+            value = try(join(",", coalesce(
+              try(configuration.se_waf_env.se_denied_ipv6_cidr_ranges, null),
+              var.global_se_waf_env.se_denied_ipv6_cidr_ranges,
+            )), "")
+          },
+          {
+            name = "se_xff_trusted_hops",
+            value = tostring(coalesce(
+              try(configuration.se_waf_env.se_xff_trusted_hops, null),
+              var.global_se_waf_env.se_xff_trusted_hops,
+            ))
+          },
+          {
+            name = "se_xff_trusted_proxy_ranges",
+            value = try(join(",", coalesce(
+              try(configuration.se_waf_env.se_xff_trusted_proxy_ranges, null),
+              var.global_se_waf_env.se_xff_trusted_proxy_ranges,
+            )), "")
+          },
+          {
+            name = "se_config_file",
+            value = try(coalesce(
+              try(configuration.se_waf_env.se_config_file, null),
+              var.global_se_waf_env.se_config_file,
+              try(coalesce(
+                try(configuration.se_waf_config, null),
+                var.global_se_waf_config,
+              ), null) != null ? "${local.se_waf_config_dir}/config.json" : null,
+            ), "")
+          },
+          {
+            name = "se_config_reload_interval",
+            value = tostring(coalesce(
+              try(configuration.se_waf_env.se_config_reload_interval, null),
+              var.global_se_waf_env.se_config_reload_interval,
+            ))
+          },
+          {
+            name = "se_workers",
+            value = tostring(coalesce(
+              try(configuration.se_waf_env.se_workers, null),
+              var.global_se_waf_env.se_workers,
+            ))
+          },
+          {
+            name = "se_grpc_max_workers",
+            value = tostring(coalesce(
+              try(configuration.se_waf_env.se_grpc_max_workers, null),
+              var.global_se_waf_env.se_grpc_max_workers,
+            ))
+          },
+          {
+            name = "se_grpc_max_concurrent_rpcs",
+            value = tostring(coalesce(
+              try(configuration.se_waf_env.se_grpc_max_concurrent_rpcs, null),
+              var.global_se_waf_env.se_grpc_max_concurrent_rpcs,
+            ))
+          },
+          {
+            name = "se_grpc_keepalive_time_ms",
+            value = tostring(coalesce(
+              try(configuration.se_waf_env.se_grpc_keepalive_time_ms, null),
+              var.global_se_waf_env.se_grpc_keepalive_time_ms,
+            ))
+          },
+          {
+            name = "se_grpc_keepalive_timeout_ms",
+            value = tostring(coalesce(
+              try(configuration.se_waf_env.se_grpc_keepalive_timeout_ms, null),
+              var.global_se_waf_env.se_grpc_keepalive_timeout_ms,
+            ))
+          },
+          {
+            name = "se_grpc_max_message_length",
+            value = tostring(coalesce(
+              try(configuration.se_waf_env.se_grpc_max_message_length, null),
+              var.global_se_waf_env.se_grpc_max_message_length,
+            ))
+          },
+          {
+            name = "se_grpc_compression",
+            value = tostring(coalesce(
+              try(configuration.se_waf_env.se_grpc_compression, null),
+              var.global_se_waf_env.se_grpc_compression,
+            ))
+          },
+          {
+            name = "se_load_shed_max_streams",
+            value = tostring(coalesce(
+              try(configuration.se_waf_env.se_load_shed_max_streams, null),
+              var.global_se_waf_env.se_load_shed_max_streams,
+            ))
+          },
+          {
+            name = "se_load_shed_verdict",
+            value = tostring(coalesce(
+              try(configuration.se_waf_env.se_load_shed_verdict, null),
+              var.global_se_waf_env.se_load_shed_verdict,
+            ))
+          },
+          {
+            name = "se_rate_limit",
+            value = tostring(coalesce(
+              try(configuration.se_waf_env.se_rate_limit, null),
+              var.global_se_waf_env.se_rate_limit,
+            ))
+          },
+          {
+            name = "se_rate_limit_burst",
+            value = tostring(coalesce(
+              try(configuration.se_waf_env.se_rate_limit_burst, null),
+              var.global_se_waf_env.se_rate_limit_burst,
+            ))
+          },
+          {
+            name = "se_rate_limit_key",
+            value = tostring(coalesce(
+              try(configuration.se_waf_env.se_rate_limit_key, null),
+              var.global_se_waf_env.se_rate_limit_key,
+            ))
+          },
+          {
+            name = "se_rate_limit_backend",
+            value = tostring(coalesce(
+              try(configuration.se_waf_env.se_rate_limit_backend, null),
+              var.global_se_waf_env.se_rate_limit_backend,
+            ))
+          },
+          {
+            name = "se_identity_headers",
+            value = tostring(coalesce(
+              try(configuration.se_waf_env.se_identity_headers, null),
+              var.global_se_waf_env.se_identity_headers,
+            ))
+          },
+          {
+            name = "se_clear_route_cache",
+            value = tostring(coalesce(
+              try(configuration.se_waf_env.se_clear_route_cache, null),
+              var.global_se_waf_env.se_clear_route_cache,
+            ))
           }
         ]
       }
@@ -24,20 +24,80 @@ variable "gce_reset_on_env_change" {
 
 variable "global_se_waf_env" {
   type = object({
-    se_debug                    = optional(bool, false),
-    se_require_iap              = optional(bool, false),
-    se_allowed_ipv4_cidr_ranges = optional(list(string), null)
-    se_denied_ipv4_cidr_ranges  = optional(list(string), null)
+    se_debug                     = optional(bool, false),
+    se_require_iap               = optional(bool, false),
+    se_iap_audience              = optional(string, null)
+    se_iap_keys_source           = optional(string, "https://www.gstatic.com/iap/verify/public_key")
+    se_allowed_ipv4_cidr_ranges  = optional(list(string), null)
+    se_denied_ipv4_cidr_ranges   = optional(list(string), null)
+    se_allowed_ipv6_cidr_ranges  = optional(list(string), null)
+    se_denied_ipv6_cidr_ranges   = optional(list(string), null)
+    se_xff_trusted_hops          = optional(number, 1)
+    se_xff_trusted_proxy_ranges  = optional(list(string), null)
+    se_config_file               = optional(string, null)
+    se_config_reload_interval    = optional(number, 5)
+    se_workers                   = optional(number, 1)
+    se_grpc_max_workers          = optional(number, 2)
+    se_grpc_max_concurrent_rpcs  = optional(number, 0)
+    se_grpc_keepalive_time_ms    = optional(number, 0)
+    se_grpc_keepalive_timeout_ms = optional(number, 20000)
+    se_grpc_max_message_length   = optional(number, 0)
+    se_grpc_compression          = optional(string, "none")
+    se_load_shed_max_streams     = optional(number, 0)
+    se_load_shed_verdict         = optional(string, "deny")
+    se_rate_limit                = optional(number, 0)
+    se_rate_limit_burst          = optional(number, 0)
+    se_rate_limit_key            = optional(string, "client_ip")
+    se_rate_limit_backend        = optional(string, "local")
+    se_identity_headers          = optional(bool, false)
+    se_clear_route_cache         = optional(string, "auto")
   })
 
   default = {
-    se_debug                    = false,
-    se_require_iap              = false,
-    se_allowed_ipv4_cidr_ranges = null
-    se_denied_ipv4_cidr_ranges  = null
+    se_debug                     = false,
+    se_require_iap               = false,
+    se_iap_audience              = null
+    se_iap_keys_source           = "https://www.gstatic.com/iap/verify/public_key"
+    se_allowed_ipv4_cidr_ranges  = null
+    se_denied_ipv4_cidr_ranges   = null
+    se_allowed_ipv6_cidr_ranges  = null
+    se_denied_ipv6_cidr_ranges   = null
+    se_xff_trusted_hops          = 1
+    se_xff_trusted_proxy_ranges  = null
+    se_config_file               = null
+    se_config_reload_interval    = 5
+    se_workers                   = 1
+    se_grpc_max_workers          = 2
+    se_grpc_max_concurrent_rpcs  = 0
+    se_grpc_keepalive_time_ms    = 0
+    se_grpc_keepalive_timeout_ms = 20000
+    se_grpc_max_message_length   = 0
+    se_grpc_compression          = "none"
+    se_load_shed_max_streams     = 0
+    se_load_shed_verdict         = "deny"
+    se_rate_limit                = 0
+    se_rate_limit_burst          = 0
+    se_rate_limit_key            = "client_ip"
+    se_rate_limit_backend        = "local"
+    se_identity_headers          = false
+    se_clear_route_cache         = "auto"
   }
 }
 
+# Rules written to se_config_file through the se-waf-config instance metadata.
+# They are reloaded when changed, without gce_reset_on_env_change.
+variable "global_se_waf_config" {
+  type = object({
+    se_require_iap              = optional(bool, null)
+    se_allowed_ipv4_cidr_ranges = optional(list(string), null)
+    se_denied_ipv4_cidr_ranges  = optional(list(string), null)
+    se_allowed_ipv6_cidr_ranges = optional(list(string), null)
+    se_denied_ipv6_cidr_ranges  = optional(list(string), null)
+    se_body_deny_patterns       = optional(list(string), null)
+  })
+  default = null
+}
+
 variable "instance_configurations" {
   type = list(object({
     region         = string,
@@ -46,11 +106,42 @@ variable "instance_configurations" {
     instance_count = optional(number, 1)
     machine_type   = optional(string, "n2-standard-2")
     container_id   = optional(string, "rteller/se-waf:latest"),
-    se_waf_env = optional(object({
-      se_debug                    = optional(bool, null),
-      se_require_iap              = optional(bool, null),
+    se_waf_env                   = optional(object({
+      se_debug                     = optional(bool, null),
+      se_require_iap               = optional(bool, null),
+      se_iap_audience              = optional(string, null)
+      se_iap_keys_source           = optional(string, null)
+      se_allowed_ipv4_cidr_ranges  = optional(list(string), null)
+      se_denied_ipv4_cidr_ranges   = optional(list(string), null)
+      se_allowed_ipv6_cidr_ranges  = optional(list(string), null)
+      se_denied_ipv6_cidr_ranges   = optional(list(string), null)
+      se_xff_trusted_hops          = optional(number, null)
+      se_xff_trusted_proxy_ranges  = optional(list(string), null)
+      se_config_file               = optional(string, null)
+      se_config_reload_interval    = optional(number, null)
+      se_workers                   = optional(number, null)
+      se_grpc_max_workers          = optional(number, null)
+      se_grpc_max_concurrent_rpcs  = optional(number, null)
+      se_grpc_keepalive_time_ms    = optional(number, null)
+      se_grpc_keepalive_timeout_ms = optional(number, null)
+      se_grpc_max_message_length   = optional(number, null)
+      se_grpc_compression          = optional(string, null)
+      se_load_shed_max_streams     = optional(number, null)
+      se_load_shed_verdict         = optional(string, null)
+      se_rate_limit                = optional(number, null)
+      se_rate_limit_burst          = optional(number, null)
+      se_rate_limit_key            = optional(string, null)
+      se_rate_limit_backend        = optional(string, null)
+      se_identity_headers          = optional(bool, null)
+      se_clear_route_cache         = optional(string, null)
+    }))
+    se_waf_config = optional(object({
+      se_require_iap              = optional(bool, null)
       se_allowed_ipv4_cidr_ranges = optional(list(string), null)
       se_denied_ipv4_cidr_ranges  = optional(list(string), null)
+      se_allowed_ipv6_cidr_ranges = optional(list(string), null)
+      se_denied_ipv6_cidr_ranges  = optional(list(string), null)
+      se_body_deny_patterns       = optional(list(string), null)
     }))
   }))
 
@@ -0,0 +1,347 @@
+# Copyright 2023 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+# Service Extension WAF Decision Microbenchmarks
+----
+Times the request decision functions of server.py in-process, without gRPC:
+* sort_cidr_ranges by rule count
+* handle_xff_validation by rule count, XFF chain length and outcome, with the
+  decision cache off and on
+* handle_iap_jwt_validation for cached, uncached and invalid tokens, verified
+  natively or through google.auth
+* add_headers_mutation by header count
+* handle_path_signatures by signature count and path length
+
+Every case reports the median and minimum nanoseconds per call over --repeat runs.
+
+Example:
+    python3 bench_decisions.py --rules 10,1000,10000 --chain-lengths 2,8 \\
+        --json decisions.json
+"""
+
+import argparse
+import dataclasses
+import json
+import os
+import random
+import statistics
+import string
+import sys
+import tempfile
+import time
+import timeit
+
+from typing import Any, Callable, Dict, List, Optional
+
+from bench_server import generate_iap_keys, generate_tokens, random_cidr, random_ipv4
+from signatures import SignatureEngine, parse_signature
+
+# Address of the load balancer hop appended after the client IP
+PROXY_IP = "35.191.0.1"
+
+
+def parse_int_list(value: str) -> List[int]:
+    return [int(item) for item in value.split(",") if item.strip()]
+
+
+def measure(
+    function: Callable[[], Any], repeat: int, min_time: float
+) -> Dict[str, float]:
+    "Returns ns per call, picking the number of calls so a run takes min_time"
+    timer = timeit.Timer(function)
+    number = 1
+    while timer.timeit(number) < min_time:
+        number *= 2
+    runs = [timer.timeit(number) / number * 1e9 for _ in range(repeat)]
+    median = statistics.median(runs)
+    return {
+        "ns_per_call": median,
+        "min_ns_per_call": min(runs),
+        "calls_per_second": 1e9 / median if median else 0.0,
+        "calls_per_run": number,
+    }
+
+
+def xff_header(rng: random.Random, client_ip: str, chain_length: int) -> str:
+    # Spoofable hops the client sent, then the client IP and the load balancer
+    hops = [random_ipv4(rng) for _ in range(max(chain_length - 2, 0))]
+    return ",".join(hops + [client_ip, PROXY_IP])
+
+
+def bench_cidr_ranges(server: Any, args: argparse.Namespace) -> List[dict]:
+    results = []
+    cache_size = server.SERVICE_EXTENSION_DECISION_CACHE_SIZE
+    policy = server.global_request_policy
+    try:
+        for rule_count in args.rules:
+            results += bench_rule_count(server, args, rule_count, cache_size)
+    finally:
+        server.SERVICE_EXTENSION_DECISION_CACHE_SIZE = cache_size
+        server.global_request_policy = policy
+    return results
+
+
+def bench_rule_count(
+    server: Any, args: argparse.Namespace, rule_count: int, cache_size: int
+) -> List[dict]:
+    results = []
+    rng = random.Random(args.seed)
+    configuration = server.RuleConfiguration(
+        allowed_ipv4_cidr_ranges="0.0.0.0/0",
+        denied_ipv4_cidr_ranges=",".join(random_cidr(rng) for _ in range(rule_count)),
+    )
+    results.append(
+        {
+            "name": "sort_cidr_ranges",
+            "params": {"rules": rule_count},
+            **measure(
+                lambda: server.sort_cidr_ranges(configuration),
+                args.repeat,
+                args.min_time,
+            ),
+        }
+    )
+
+    # Denied clients sit inside a denied range, allowed ones only match 0.0.0.0/0
+    denied_ips = [
+        cidr.split("/")[0]
+        for _, cidr in server.compile_cidr_matcher(configuration).rules()
+        if cidr != "0.0.0.0/0"
+    ] or ["0.0.0.0"]
+    clients = {
+        "allowed": [random_ipv4(rng) for _ in range(256)],
+        "denied": [rng.choice(denied_ips) for _ in range(256)],
+    }
+    for chain_length in args.chain_lengths:
+        for outcome, client_ips in clients.items():
+            headers = [
+                xff_header(rng, client_ip, chain_length) for client_ip in client_ips
+            ]
+            # The 256 clients all fit in the decision cache, so the cached
+            # case only measures hits and the uncached one the lookups
+            for decision_cache, max_size in (
+                ("uncached", 0),
+                ("cached", cache_size or 10000),
+            ):
+                server.SERVICE_EXTENSION_DECISION_CACHE_SIZE = max_size
+                server.apply_rule_configuration(configuration)
+                header_iter = iter(())
+
+                def call() -> Any:
+                    nonlocal header_iter
+                    header = next(header_iter, None)
+                    if header is None:
+                        header_iter = iter(headers)
+                        header = next(header_iter)
+                    return server.handle_xff_validation(header)
+
+                results.append(
+                    {
+                        "name": "handle_xff_validation",
+                        "params": {
+                            "rules": rule_count,
+                            "chain_length": chain_length,
+                            "outcome": outcome,
+                            "cache": decision_cache,
+                        },
+                        **measure(call, args.repeat, args.min_time),
+                    }
+                )
+    return results
+
+
+def bench_iap_jwt(server: Any, args: argparse.Namespace, tokens: dict) -> List[dict]:
+    results = []
+    cache = server.IAP_TOKEN_CACHE
+    cache_size = cache.max_size
+    key_set = server.IAP_KEY_SET
+    native = key_set.native
+    for validity, max_size, verifier in (
+        ("valid_cached", cache_size or 10000, "native"),
+        ("valid_uncached", 0, "native"),
+        ("valid_uncached", 0, "google_auth"),
+        ("invalid", cache_size, "native"),
+        ("invalid", cache_size, "google_auth"),
+    ):
+        cache.clear()
+        cache.max_size = max_size
+        key_set.native = verifier == "native"
+        token = tokens["invalid" if validity == "invalid" else "valid"]
+        try:
+            results.append(
+                {
+                    "name": "handle_iap_jwt_validation",
+                    "params": {"token": validity, "verifier": verifier},
+                    **measure(
+                        lambda: server.handle_iap_jwt_validation(token),
+                        args.repeat,
+                        args.min_time,
+                    ),
+                }
+            )
+        finally:
+            cache.max_size = cache_size
+            cache.clear()
+            key_set.native = native
+    return results
+
+
+def bench_headers_mutation(server: Any, args: argparse.Namespace) -> List[dict]:
+    results = []
+    for header_count in args.header_counts:
+        headers = [(f"x-se-header-{index}", "value") for index in range(header_count)]
+        results.append(
+            {
+                "name": "add_headers_mutation",
+                "params": {"headers": header_count},
+                **measure(
+                    lambda: server.add_headers_mutation(
+                        headers, clear_route_cache=True
+                    ),
+                    args.repeat,
+                    args.min_time,
+                ),
+            }
+        )
+    return results
+
+
+def random_word(rng: random.Random, length: int) -> str:
+    return "".join(rng.choice(string.ascii_lowercase) for _ in range(length))
+
+
+def bench_signatures(server: Any, args: argparse.Namespace) -> List[dict]:
+    results = []
+    policy = server.global_request_policy
+    try:
+        for signature_count in args.signatures:
+            rng = random.Random(args.seed)
+            # Mostly strings, some regexes with a given literal, a few with a derived one
+            entries = []
+            for index in range(signature_count):
+                word = random_word(rng, 8)
+                if index % 10 == 8:
+                    entries.append(
+                        {"id": str(index), "regex": f"{word}\\d+", "literal": word}
+                    )
+                elif index % 100 == 99:
+                    entries.append(
+                        {"id": str(index), "regex": f"{word[:4]}[0-9]{word[4:]}"}
+                    )
+                else:
+                    entries.append({"id": str(index), "pattern": word})
+            server.global_request_policy = dataclasses.replace(
+                policy,
+                signature_engine=SignatureEngine(
+                    [parse_signature(entry) for entry in entries]
+                ),
+            )
+            for path_length in args.path_lengths:
+                # Paths made of digits and punctuation never match a word
+                path = "/" + "".join(
+                    rng.choice("0123456789/-_.") for _ in range(path_length // 2)
+                )
+                path += "?" + "".join(
+                    rng.choice("0123456789=&-") for _ in range(path_length - len(path))
+                )
+                results.append(
+                    {
+                        "name": "handle_path_signatures",
+                        "params": {
+                            "signatures": signature_count,
+                            "path_length": path_length,
+                        },
+                        **measure(
+                            lambda: server.handle_path_signatures(path),
+                            args.repeat,
+                            args.min_time,
+                        ),
+                    }
+                )
+    finally:
+        server.global_request_policy = policy
+    return results
+
+
+def print_results(results: List[dict]) -> None:
+    for result in results:
+        params = ",".join(f"{key}={value}" for key, value in result["params"].items())
+        print(
+            "%-28s %-60s %14.0f ns %14.0f ns min"
+            % (result["name"], params, result["ns_per_call"], result["min_ns_per_call"])
+        )
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n----\n")[0])
+    parser.add_argument("--rules", type=parse_int_list, default=[10, 1000, 10000])
+    parser.add_argument("--chain-lengths", type=parse_int_list, default=[2, 8])
+    parser.add_argument("--header-counts", type=parse_int_list, default=[1, 4, 16])
+    parser.add_argument("--signatures", type=parse_int_list, default=[10, 1000, 10000])
+    parser.add_argument("--path-lengths", type=parse_int_list, default=[64, 512])
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per case")
+    parser.add_argument(
+        "--min-time", type=float, default=0.05, help="minimum seconds per timed run"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> dict:
+    args = parse_args(argv)
+    keys_json, signer = generate_iap_keys()
+    _, other_signer = generate_iap_keys()
+    tokens = {
+        "valid": generate_tokens(signer, 1)[0],
+        "invalid": generate_tokens(other_signer, 1)[0],
+    }
+
+    with tempfile.NamedTemporaryFile("w", suffix=".json") as key_file:
+        key_file.write(keys_json)
+        key_file.flush()
+        # server.py reads its settings and certificates when imported
+        os.environ.update(
+            se_debug="False",
+            se_log_level="WARNING",
+            se_iap_certificate_file=key_file.name,
+        )
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+        import server
+
+        server.apply_rule_configuration(server.RuleConfiguration())
+
+    started = time.time()
+    results = (
+        bench_cidr_ranges(server, args)
+        + bench_iap_jwt(server, args, tokens)
+        + bench_headers_mutation(server, args)
+        + bench_signatures(server, args)
+    )
+    print_results(results)
+
+    benchmark_report = {
+        "timestamp": started,
+        "python": sys.version.split()[0],
+        "config": {key: value for key, value in vars(args).items() if key != "json"},
+        "results": results,
+    }
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(benchmark_report, f, indent=2)
+    return benchmark_report
+
+
+if __name__ == "__main__":
+    main()
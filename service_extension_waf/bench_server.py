@@ -0,0 +1,346 @@
+# Copyright 2023 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+# Service Extension WAF Load Benchmark
+----
+Drives ExternalProcessorStub.Process with many concurrent streams (one stream
+per simulated HTTP request, like the load balancer) and reports requests/sec
+and p50/p90/p99/p999 latency overall and per request kind.
+
+Unless --target is given, a local server.py is started with a generated IAP
+key, --rules random denied CIDR ranges and the requested server mode/workers.
+
+Request kinds (--mix kind=weight,...):
+* xff: only an x-forwarded-for header with a random client IP
+* iap_valid: x-forwarded-for plus a valid IAP JWT (from a pool of --tokens)
+* iap_invalid: x-forwarded-for plus an IAP JWT with a bad signature
+
+Example:
+    python3 bench_server.py --requests 20000 --streams 200 \\
+        --mix xff=0.5,iap_valid=0.4,iap_invalid=0.1 --rules 50000 --json out.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from typing import Dict, List, Optional, Tuple
+
+import grpc
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from google.auth import jwt
+from google.auth.crypt import es256
+
+import service_pb2
+import service_pb2_grpc
+
+from iap_jwt import IAP_ISSUER
+
+EXT_PROC_INSECURE_PORT = 8080
+HEALTH_CHECK_PORT = 8000
+# Address of the load balancer hop appended after the client IP
+PROXY_IP = "35.191.0.1"
+REQUEST_KINDS = ("xff", "iap_valid", "iap_invalid")
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    weights = {}
+    for item in mix.split(","):
+        kind, _, weight = item.partition("=")
+        kind = kind.strip()
+        if kind not in REQUEST_KINDS:
+            raise argparse.ArgumentTypeError(f"Unknown request kind {kind}")
+        weights[kind] = float(weight or 1)
+    return weights
+
+
+def random_ipv4(rng: random.Random) -> str:
+    return ".".join(str(rng.randint(1, 254)) for _ in range(4))
+
+
+def random_cidr(rng: random.Random) -> str:
+    prefix_length = rng.randint(16, 32)
+    address = rng.getrandbits(32) & ~((1 << (32 - prefix_length)) - 1)
+    return "%d.%d.%d.%d/%d" % (
+        address >> 24,
+        (address >> 16) & 0xFF,
+        (address >> 8) & 0xFF,
+        address & 0xFF,
+        prefix_length,
+    )
+
+
+def generate_iap_keys(key_id: str = "bench") -> Tuple[str, es256.ES256Signer]:
+    "Returns an IAP style public key set and a signer for it"
+    private_key = ec.generate_private_key(ec.SECP256R1())
+    public_key = private_key.public_key().public_bytes(
+        serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+    return (
+        json.dumps({key_id: public_key.decode("utf-8")}),
+        es256.ES256Signer(private_key, key_id=key_id),
+    )
+
+
+def generate_tokens(signer: es256.ES256Signer, count: int) -> List[str]:
+    now = int(time.time())
+    return [
+        jwt.encode(
+            signer,
+            {
+                "sub": f"accounts.google.com:{index}",
+                "email": f"user{index}@example.com",
+                "iat": now,
+                "exp": now + 3600,
+                "iss": IAP_ISSUER,
+            },
+        ).decode("utf-8")
+        for index in range(count)
+    ]
+
+
+def build_request(headers: List[Tuple[str, str]]) -> service_pb2.ProcessingRequest:
+    return service_pb2.ProcessingRequest(
+        request_headers=service_pb2.HttpHeaders(
+            headers=service_pb2.HeaderMap(
+                headers=[
+                    service_pb2.HeaderValue(key=key, raw_value=value.encode("utf-8"))
+                    for key, value in headers
+                ]
+            ),
+            end_of_stream=True,
+        )
+    )
+
+
+def build_workload(
+    args: argparse.Namespace, valid_tokens: List[str], invalid_tokens: List[str]
+) -> List[Tuple[str, service_pb2.ProcessingRequest]]:
+    "Pre-builds every request so request construction isn't measured"
+    rng = random.Random(args.seed)
+    kinds = list(args.mix)
+    weights = [args.mix[kind] for kind in kinds]
+    workload = []
+    for kind in rng.choices(kinds, weights, k=args.requests):
+        headers = [
+            (":authority", "se-waf.demo.com"),
+            (":path", "/"),
+            ("x-forwarded-for", f"{random_ipv4(rng)},{PROXY_IP}"),
+        ]
+        if kind == "iap_valid":
+            headers.append(("x-goog-iap-jwt-assertion", rng.choice(valid_tokens)))
+        elif kind == "iap_invalid":
+            headers.append(("x-goog-iap-jwt-assertion", rng.choice(invalid_tokens)))
+        workload.append((kind, build_request(headers)))
+    return workload
+
+
+def start_local_server(
+    args: argparse.Namespace, keys_json: str, workdir: str
+) -> subprocess.Popen:
+    rng = random.Random(args.seed)
+    key_file = os.path.join(workdir, "iap_public_key.json")
+    with open(key_file, "w") as f:
+        f.write(keys_json)
+    config_file = os.path.join(workdir, "se_config.json")
+    with open(config_file, "w") as f:
+        denied_cidr_ranges = [random_cidr(rng) for _ in range(args.rules)]
+        json.dump({"se_denied_ipv4_cidr_ranges": denied_cidr_ranges}, f)
+
+    env = dict(
+        os.environ,
+        se_debug="False",
+        se_log_level="WARNING",
+        se_require_iap=str(any(kind.startswith("iap") for kind in args.mix)),
+        se_iap_certificate_file=key_file,
+        se_config_file=config_file,
+        se_allowed_ipv4_cidr_ranges="0.0.0.0/0",
+        se_server_mode=args.server_mode,
+        se_workers=str(args.workers),
+    )
+    process = subprocess.Popen(
+        [sys.executable, "server.py"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+    )
+    deadline = time.monotonic() + args.startup_timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"server.py exited with code {process.returncode}")
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{HEALTH_CHECK_PORT}", timeout=1)
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("server.py did not become healthy in time")
+
+
+async def run_streams(
+    target: str,
+    workload: List[Tuple[str, service_pb2.ProcessingRequest]],
+    concurrency: int,
+) -> Tuple[List[Tuple[str, float, str]], float]:
+    "Returns (kind, latency seconds, outcome) per request and the wall time"
+    results: List[Tuple[str, float, str]] = []
+    next_index = 0
+
+    async with grpc.aio.insecure_channel(target) as channel:
+        stub = service_pb2_grpc.ExternalProcessorStub(channel)
+
+        async def stream_worker() -> None:
+            nonlocal next_index
+            while next_index < len(workload):
+                kind, request = workload[next_index]
+                next_index += 1
+                started = time.perf_counter()
+                outcome = "no_response"
+                try:
+                    async for response in stub.Process(iter([request])):
+                        outcome = response.WhichOneof("response")
+                        break
+                except grpc.aio.AioRpcError as e:
+                    outcome = f"rpc_error_{e.code().name.lower()}"
+                results.append((kind, time.perf_counter() - started, outcome))
+
+        started = time.perf_counter()
+        await asyncio.gather(*(stream_worker() for _ in range(concurrency)))
+        return results, time.perf_counter() - started
+
+
+def percentile(sorted_values: List[float], percent: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100))
+    return sorted_values[index]
+
+
+def summarize(latencies: List[float], outcomes: List[str], elapsed: float) -> dict:
+    latencies = sorted(latencies)
+    summary = {
+        "requests": len(latencies),
+        "requests_per_second": len(latencies) / elapsed if elapsed else 0.0,
+        "outcomes": {outcome: outcomes.count(outcome) for outcome in set(outcomes)},
+    }
+    for percent in PERCENTILES:
+        summary[f"p{percent:g}_ms"] = percentile(latencies, percent) * 1000
+    return summary
+
+
+def report(results: List[Tuple[str, float, str]], elapsed: float) -> dict:
+    report = {
+        "elapsed_seconds": elapsed,
+        "total": summarize(
+            [latency for _, latency, _ in results],
+            [outcome for _, _, outcome in results],
+            elapsed,
+        ),
+        "kinds": {},
+    }
+    for kind in sorted({kind for kind, _, _ in results}):
+        kind_results = [result for result in results if result[0] == kind]
+        report["kinds"][kind] = summarize(
+            [latency for _, latency, _ in kind_results],
+            [outcome for _, _, outcome in kind_results],
+            elapsed,
+        )
+    return report
+
+
+def print_report(report: dict) -> None:
+    columns = ["requests", "requests_per_second"] + [
+        f"p{percent:g}_ms" for percent in PERCENTILES
+    ]
+    print("%-12s" % "kind" + "".join("%20s" % column for column in columns))
+    rows = [("total", report["total"])] + list(report["kinds"].items())
+    for name, summary in rows:
+        print(
+            "%-12s" % name
+            + "".join(
+                "%20d" % summary[column]
+                if column == "requests"
+                else "%20.3f" % summary[column]
+                for column in columns
+            )
+        )
+    for name, summary in rows:
+        print(f"{name} outcomes: {summary['outcomes']}")
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n----\n")[0])
+    parser.add_argument(
+        "--target", help="host:port of a running server, default starts server.py"
+    )
+    parser.add_argument("--requests", type=int, default=10000)
+    parser.add_argument("--streams", type=int, default=100, help="concurrent streams")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("xff=1"))
+    parser.add_argument("--rules", type=int, default=0, help="random denied ranges")
+    parser.add_argument("--tokens", type=int, default=100, help="distinct IAP JWTs")
+    parser.add_argument("--server-mode", choices=["thread", "async"], default="thread")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--warmup", type=int, default=200, help="unmeasured requests")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--startup-timeout", type=float, default=30)
+    parser.add_argument("--json", help="also write the report to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> dict:
+    args = parse_args(argv)
+    keys_json, signer = generate_iap_keys()
+    _, other_signer = generate_iap_keys()
+    valid_tokens = generate_tokens(signer, args.tokens)
+    invalid_tokens = generate_tokens(other_signer, args.tokens)
+    workload = build_workload(args, valid_tokens, invalid_tokens)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        process = None
+        target = args.target
+        if target is None:
+            process = start_local_server(args, keys_json, workdir)
+            target = f"127.0.0.1:{EXT_PROC_INSECURE_PORT}"
+        try:
+            if args.warmup:
+                asyncio.run(run_streams(target, workload[: args.warmup], args.streams))
+            results, elapsed = asyncio.run(run_streams(target, workload, args.streams))
+        finally:
+            if process is not None:
+                # SIGINT lets the supervisor stop its worker processes
+                process.send_signal(signal.SIGINT)
+                process.wait()
+
+    benchmark_report = report(results, elapsed)
+    benchmark_report["config"] = {
+        key: value for key, value in vars(args).items() if key != "json"
+    }
+    print_report(benchmark_report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(benchmark_report, f, indent=2)
+    return benchmark_report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+# Copyright 2023 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+# Service Extension WAF Blocklist
+----
+Compiles IP reputation feeds into a compact binary table that the server maps
+into memory, for blocklists too large to configure as CIDR ranges.
+
+Feeds are text files with one IP address, CIDR range or `first-last` address
+range per line; anything after `#` or `;` is a comment. Entries are converted to
+inclusive integer ranges, sorted and merged, then written as:
+
+* a 16 byte header: b"SEWAFBL1", IPv4 range count, IPv6 range count
+* IPv4 range starts and ends as little-endian uint32 arrays
+* IPv6 range starts and ends as uint128, each stored as little-endian uint64
+  arrays of the high and low halves
+
+The file is opened with mmap, so worker processes share one copy of the table
+through the page cache and nothing is parsed at startup. A lookup is a binary
+search over the range starts of the client's address family.
+
+Compile feeds with:
+    python3 blocklist.py blocklist.bin feed1.txt feed2.txt
+"""
+
+import mmap
+import os
+import struct
+import sys
+
+from array import array
+from bisect import bisect_right
+from ipaddress import ip_address, ip_network
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+from cidr_matcher import (
+    DENY,
+    IPV4_ALL_ONES,
+    IPV4_MAPPED_PREFIX,
+    CidrMatch,
+    ipv4_to_int,
+    ipv6_to_int,
+)
+
+MAGIC = b"SEWAFBL1"
+HEADER = struct.Struct("<8sII")
+UINT64_ALL_ONES = (1 << 64) - 1
+
+# Inclusive (first, last) integer addresses
+IpRange = Tuple[int, int]
+
+
+def parse_feed_entry(entry: str) -> Tuple[int, IpRange]:
+    """Returns the IP version and range of an address, CIDR or `first-last` range.
+
+    Raises ValueError for anything else.
+    """
+    if "-" in entry:
+        first, _, last = entry.partition("-")
+        first_address, last_address = ip_address(first), ip_address(last)
+        if first_address.version != last_address.version:
+            raise ValueError(f"{entry} mixes IPv4 and IPv6 addresses")
+        if first_address > last_address:
+            raise ValueError(f"{entry} ends before it starts")
+        return first_address.version, (int(first_address), int(last_address))
+    network = ip_network(entry, strict=False)
+    return network.version, (
+        int(network.network_address),
+        int(network.broadcast_address),
+    )
+
+
+def merge_ranges(ranges: Iterable[IpRange]) -> List[IpRange]:
+    "Sorts ranges and merges the ones that overlap or are adjacent"
+    merged: List[IpRange] = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            if last > merged[-1][1]:
+                merged[-1] = (merged[-1][0], last)
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def _array(typecode: str, values: Iterable[int]) -> array:
+    values = array(typecode, values)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values
+
+
+def compile_blocklist(feeds: Sequence[str], output: str) -> dict:
+    """
+    Compiles the feed files into output, replacing it atomically, and returns
+    the number of IPv4 and IPv6 ranges written and feed lines skipped.
+    """
+    ranges: dict = {4: [], 6: []}
+    skipped = 0
+    for feed in feeds:
+        with open(feed, "r") as f:
+            for line in f:
+                entry = line.split("#", 1)[0].split(";", 1)[0].strip()
+                if not entry:
+                    continue
+                try:
+                    version, ip_range = parse_feed_entry(entry.split()[0].rstrip(","))
+                except ValueError:
+                    skipped += 1
+                    continue
+                first, last = ip_range
+                if (
+                    version == 6
+                    and (first & ~IPV4_ALL_ONES) == IPV4_MAPPED_PREFIX
+                    and (last & ~IPV4_ALL_ONES) == IPV4_MAPPED_PREFIX
+                ):
+                    # IPv4-mapped entries are looked up as IPv4
+                    version, ip_range = 4, (first & IPV4_ALL_ONES, last & IPV4_ALL_ONES)
+                ranges[version].append(ip_range)
+
+    ipv4_ranges = merge_ranges(ranges[4])
+    ipv6_ranges = merge_ranges(ranges[6])
+    temporary_output = f"{output}.tmp"
+    with open(temporary_output, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(ipv4_ranges), len(ipv6_ranges)))
+        _array("I", (first for first, _ in ipv4_ranges)).tofile(f)
+        _array("I", (last for _, last in ipv4_ranges)).tofile(f)
+        for index in (0, 1):
+            _array("Q", (ip_range[index] >> 64 for ip_range in ipv6_ranges)).tofile(f)
+            _array(
+                "Q", (ip_range[index] & UINT64_ALL_ONES for ip_range in ipv6_ranges)
+            ).tofile(f)
+    os.replace(temporary_output, output)
+    return {
+        "ipv4_ranges": len(ipv4_ranges),
+        "ipv6_ranges": len(ipv6_ranges),
+        "skipped": skipped,
+    }
+
+
+class Blocklist:
+    """A compiled blocklist mapped read-only into memory."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < HEADER.size:
+                raise ValueError(f"{path} is not a compiled blocklist")
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, ipv4_count, ipv6_count = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a compiled blocklist")
+        if size != HEADER.size + ipv4_count * 8 + ipv6_count * 32:
+            raise ValueError(f"{path} is truncated")
+
+        offset = HEADER.size
+        self._ipv4_starts, offset = self._view(offset, ipv4_count, "I")
+        self._ipv4_ends, offset = self._view(offset, ipv4_count, "I")
+        self._ipv6_start_highs, offset = self._view(offset, ipv6_count, "Q")
+        self._ipv6_start_lows, offset = self._view(offset, ipv6_count, "Q")
+        self._ipv6_end_highs, offset = self._view(offset, ipv6_count, "Q")
+        self._ipv6_end_lows, offset = self._view(offset, ipv6_count, "Q")
+
+    def _view(
+        self, offset: int, count: int, typecode: str
+    ) -> Tuple[Sequence[int], int]:
+        end = offset + count * struct.calcsize(typecode)
+        view = memoryview(self._mmap)[offset:end].cast(typecode)
+        if sys.byteorder != "little":
+            # Big-endian hosts get a private, byte-swapped copy
+            view = array(typecode, view)
+            view.byteswap()
+        return view, end
+
+    def __len__(self) -> int:
+        return len(self._ipv4_starts) + len(self._ipv6_start_highs)
+
+    def lookup_int(self, address: int) -> Optional[CidrMatch]:
+        """Looks up an integer IPv4 address."""
+        index = bisect_right(self._ipv4_starts, address) - 1
+        if index >= 0 and address <= self._ipv4_ends[index]:
+            return (
+                DENY,
+                f"{ip_address(self._ipv4_starts[index])}-"
+                f"{ip_address(self._ipv4_ends[index])}",
+            )
+        return None
+
+    def lookup_ipv6_int(self, address: int) -> Optional[CidrMatch]:
+        """Looks up an integer IPv6 address, IPv4-mapped addresses as IPv4."""
+        if (address & ~IPV4_ALL_ONES) == IPV4_MAPPED_PREFIX:
+            return self.lookup_int(address & IPV4_ALL_ONES)
+
+        highs, lows = self._ipv6_start_highs, self._ipv6_start_lows
+        low, high = 0, len(highs)
+        while low < high:
+            middle = (low + high) // 2
+            if (highs[middle] << 64 | lows[middle]) <= address:
+                low = middle + 1
+            else:
+                high = middle
+        index = low - 1
+        if index < 0:
+            return None
+        last = self._ipv6_end_highs[index] << 64 | self._ipv6_end_lows[index]
+        if address > last:
+            return None
+        first = highs[index] << 64 | lows[index]
+        return (DENY, f"{ip_address(first)}-{ip_address(last)}")
+
+    def lookup(self, address: str) -> Optional[CidrMatch]:
+        """Returns (DENY, "first-last") for a blocked address, None otherwise.
+
+        Addresses that aren't valid IPv4 or IPv6 never match.
+        """
+        address_int = ipv4_to_int(address)
+        if address_int is not None:
+            return self.lookup_int(address_int)
+        address_int = ipv6_to_int(address)
+        if address_int is None:
+            return None
+        return self.lookup_ipv6_int(address_int)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        sys.exit(f"usage: {sys.argv[0]} OUTPUT FEED [FEED ...]")
+    print(compile_blocklist(sys.argv[2:], sys.argv[1]))
@@ -0,0 +1,57 @@
+# Copyright 2023 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+# Service Extension WAF Body Inspection
+----
+Inspects a request body as Envoy streams it, one HttpBody chunk at a time.
+
+The body itself is never buffered: only the last (longest pattern - 1) bytes
+of the previous chunks are kept, so patterns split across chunks are still
+found while memory per stream stays bounded. A verdict is returned as soon as
+a pattern matches or the body exceeds the size limit, without waiting for the
+end of the body.
+"""
+from typing import Optional, Sequence, Tuple
+
+BODY_TOO_LARGE = "body_too_large"
+BODY_PATTERN = "body_pattern"
+
+# (reason, detail) of a denied body
+BodyVerdict = Tuple[str, str]
+
+
+class BodyInspector:
+    """Case-insensitive search for deny patterns across the chunks of one body."""
+
+    def __init__(self, patterns: Sequence[bytes], max_body_bytes: int = 0) -> None:
+        self.patterns = tuple(pattern.lower() for pattern in patterns if pattern)
+        self.max_body_bytes = max_body_bytes
+        self.size = 0
+        self._overlap = max((len(pattern) for pattern in self.patterns), default=1) - 1
+        self._tail = b""
+
+    def feed(self, chunk: bytes) -> Optional[BodyVerdict]:
+        "Inspects the next chunk, returns the verdict once the body is denied"
+        self.size += len(chunk)
+        if self.max_body_bytes and self.size > self.max_body_bytes:
+            return (BODY_TOO_LARGE, f"{self.size} > {self.max_body_bytes} bytes")
+        if not self.patterns:
+            return None
+
+        window = self._tail + chunk.lower()
+        for pattern in self.patterns:
+            if pattern in window:
+                return (BODY_PATTERN, pattern.decode("utf-8", "replace"))
+        self._tail = window[-self._overlap :] if self._overlap else b""
+        return None
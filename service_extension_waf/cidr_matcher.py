@@ -0,0 +1,144 @@
+# Copyright 2023 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+# Service Extension WAF CIDR Matcher
+----
+Compiled longest-prefix-match index used to decide whether a client source IP
+is allowed or denied.
+
+Rules are bucketed by address family and prefix length into dicts keyed by the
+integer network address (32-bit for IPv4, 128-bit for IPv6). A lookup masks
+the client address once per distinct prefix length of its family, longest
+first, and returns the first hit, so the cost is bounded by the number of
+distinct prefix lengths (at most 33 for IPv4, 129 for IPv6) rather than the
+rule count. IPv4-mapped IPv6 clients (::ffff:1.2.3.4) are matched as IPv4.
+"""
+from ipaddress import IPv4Network, IPv6Network, ip_network
+from socket import AF_INET, AF_INET6, inet_pton
+
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+ALLOW = "allow"
+DENY = "deny"
+
+IPV4_MAX_PREFIXLEN = 32
+IPV4_ALL_ONES = (1 << IPV4_MAX_PREFIXLEN) - 1
+IPV6_MAX_PREFIXLEN = 128
+IPV6_ALL_ONES = (1 << IPV6_MAX_PREFIXLEN) - 1
+# ::ffff:0:0/96, the IPv6 addresses that carry an IPv4 address
+IPV4_MAPPED_PREFIX = 0xFFFF << 32
+
+# (cidr, action) as provided by the configuration
+CidrRule = Tuple[Union[str, IPv4Network, IPv6Network], str]
+# (action, cidr) as returned by a lookup, pre-built so lookups don't allocate
+CidrMatch = Tuple[str, str]
+# (mask, {network address: match}) per prefix length, longest first
+CidrLevels = Tuple[Tuple[int, Dict[int, CidrMatch]], ...]
+
+
+def ipv4_to_int(address: str) -> Optional[int]:
+    """Returns the integer value of a dotted quad, or None if it isn't one."""
+    try:
+        return int.from_bytes(inet_pton(AF_INET, address), "big")
+    except (OSError, TypeError, ValueError):
+        return None
+
+
+def ipv6_to_int(address: str) -> Optional[int]:
+    """Returns the integer value of an IPv6 address, or None if it isn't one."""
+    try:
+        return int.from_bytes(inet_pton(AF_INET6, address), "big")
+    except (OSError, TypeError, ValueError):
+        return None
+
+
+def _compile_levels(tables: Dict[int, Dict[int, CidrMatch]], bits: int) -> CidrLevels:
+    all_ones = (1 << bits) - 1
+    return tuple(
+        ((all_ones << (bits - prefixlen)) & all_ones, tables[prefixlen])
+        for prefixlen in sorted(tables, reverse=True)
+    )
+
+
+def _lookup_levels(levels: CidrLevels, address: int) -> Optional[CidrMatch]:
+    for mask, table in levels:
+        match = table.get(address & mask)
+        if match is not None:
+            return match
+    return None
+
+
+class CidrMatcher:
+    """Longest-prefix-match index over allow/deny IPv4 and IPv6 CIDR ranges.
+
+    When the same range is listed as both allowed and denied it is denied.
+    """
+
+    def __init__(self, rules: Iterable[CidrRule]) -> None:
+        tables: Dict[int, Dict[int, Dict[int, CidrMatch]]] = {4: {}, 6: {}}
+        for cidr, action in rules:
+            if action not in (ALLOW, DENY):
+                raise ValueError(f"Unknown CIDR action: {action}")
+            network = (
+                cidr
+                if isinstance(cidr, (IPv4Network, IPv6Network))
+                else ip_network(cidr)
+            )
+
+            table = tables[network.version].setdefault(network.prefixlen, {})
+            key = int(network.network_address)
+            if key in table and table[key][0] == DENY:
+                continue
+            table[key] = (action, str(network))
+
+        self._levels: CidrLevels = _compile_levels(tables[4], IPV4_MAX_PREFIXLEN)
+        self._ipv6_levels: CidrLevels = _compile_levels(tables[6], IPV6_MAX_PREFIXLEN)
+        self._size = sum(
+            len(table) for family in tables.values() for table in family.values()
+        )
+
+    def __len__(self) -> int:
+        return self._size
+
+    def rules(self) -> List[CidrMatch]:
+        """Returns every (action, cidr) in match order, IPv4 first."""
+        return [
+            match
+            for levels in (self._levels, self._ipv6_levels)
+            for _, table in levels
+            for match in table.values()
+        ]
+
+    def lookup_int(self, address: int) -> Optional[CidrMatch]:
+        """Looks up an integer IPv4 address."""
+        return _lookup_levels(self._levels, address)
+
+    def lookup_ipv6_int(self, address: int) -> Optional[CidrMatch]:
+        """Looks up an integer IPv6 address, IPv4-mapped addresses as IPv4."""
+        if (address & ~IPV4_ALL_ONES) == IPV4_MAPPED_PREFIX:
+            return _lookup_levels(self._levels, address & IPV4_ALL_ONES)
+        return _lookup_levels(self._ipv6_levels, address)
+
+    def lookup(self, address: str) -> Optional[CidrMatch]:
+        """Returns the (action, cidr) of the longest matching range, if any.
+
+        Addresses that aren't valid IPv4 or IPv6 never match.
+        """
+        address_int = ipv4_to_int(address)
+        if address_int is not None:
+            return _lookup_levels(self._levels, address_int)
+        address_int = ipv6_to_int(address)
+        if address_int is None:
+            return None
+        return self.lookup_ipv6_int(address_int)
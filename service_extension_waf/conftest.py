@@ -1,8 +1,14 @@
 def pytest_addoption(parser):
     parser.addoption("--se_debug", action="store", default="True")
     parser.addoption("--se_require_iap", action="store", default=None)
+    parser.addoption("--se_server_mode", action="store", default=None)
+    parser.addoption("--se_workers", action="store", default=None)
+    parser.addoption("--se_config_file", action="store", default=None)
     parser.addoption("--se_allowed_ipv4_cidr_ranges", action="store", default=None)
     parser.addoption("--se_denied_ipv4_cidr_ranges", action="store", default=None)
+    parser.addoption("--se_allowed_ipv6_cidr_ranges", action="store", default=None)
+    parser.addoption("--se_denied_ipv6_cidr_ranges", action="store", default=None)
+    parser.addoption("--se_xff_trusted_proxy_ranges", action="store", default=None)
     
     
     parser.addoption("--se_test_case", action="store")
@@ -35,6 +41,18 @@ def pytest_configure(config):
     if require_iap is not None:
         os.environ["se_require_iap"] = require_iap
 
+    server_mode = config.getoption("--se_server_mode")
+    if server_mode is not None:
+        os.environ["se_server_mode"] = server_mode
+
+    workers = config.getoption("--se_workers")
+    if workers is not None:
+        os.environ["se_workers"] = workers
+
+    config_file = config.getoption("--se_config_file")
+    if config_file is not None:
+        os.environ["se_config_file"] = config_file
+
     allowed_ranges = config.getoption("--se_allowed_ipv4_cidr_ranges")
     if allowed_ranges is not None:
         os.environ["se_allowed_ipv4_cidr_ranges"] = allowed_ranges
@@ -43,3 +61,14 @@ def pytest_configure(config):
     if denied_ranges is not None:
         os.environ["se_denied_ipv4_cidr_ranges"] = denied_ranges
 
+    allowed_ipv6_ranges = config.getoption("--se_allowed_ipv6_cidr_ranges")
+    if allowed_ipv6_ranges is not None:
+        os.environ["se_allowed_ipv6_cidr_ranges"] = allowed_ipv6_ranges
+
+    denied_ipv6_ranges = config.getoption("--se_denied_ipv6_cidr_ranges")
+    if denied_ipv6_ranges is not None:
+        os.environ["se_denied_ipv6_cidr_ranges"] = denied_ipv6_ranges
+
+    trusted_proxy_ranges = config.getoption("--se_xff_trusted_proxy_ranges")
+    if trusted_proxy_ranges is not None:
+        os.environ["se_xff_trusted_proxy_ranges"] = trusted_proxy_ranges
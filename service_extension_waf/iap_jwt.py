@@ -0,0 +1,353 @@
+# Copyright 2023 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+# Service Extension WAF IAP JWT Verification
+----
+* IapKeySet parses the IAP public keys ({"key id": "PEM public key"}) once and
+  indexes them by key id, so validating a token never fetches or re-parses
+  keys. Tokens are verified natively with cryptography: the token is split and
+  decoded once and its signature checked with a single ECDSA verification.
+  With native=False they go through google.auth instead, as before. Either
+  way the `iat`, `exp` and `iss` claims are checked, and `aud` when an
+  expected audience is given.
+* IapKeyRefresher reloads the keys from a URL or file in the background, so
+  rotated Google keys are picked up without a restart. Keys are fetched and
+  parsed on its own thread and only the finished key set is swapped in.
+* VerifiedTokenCache remembers tokens that already passed verification, keyed by
+  the SHA-256 of the token, until the earlier of their `exp` claim or the cache
+  TTL, so repeat callers skip signature verification entirely. Clearing it
+  starts a new generation, and tokens verified before the clear are not added.
+"""
+import base64
+import hashlib
+import json
+import logging
+import threading
+import time
+import urllib.request
+
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Mapping, Optional, Tuple, Union
+
+from cryptography import x509
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric.utils import encode_dss_signature
+from google.auth import exceptions, jwt
+from google.auth.crypt import es256
+
+IAP_ALGORITHM = "ES256"
+IAP_ISSUER = "https://cloud.google.com/iap"
+# ES256 signatures are the 32 byte r and s values of a P-256 ECDSA signature
+ES256_SIGNATURE_LENGTH = 64
+_ECDSA_SHA256 = ec.ECDSA(hashes.SHA256())
+
+logger = logging.getLogger("service_extension_waf")
+
+
+def load_es256_public_key(public_key: Union[str, bytes]) -> ec.EllipticCurvePublicKey:
+    "Loads a PEM public key or certificate, raises ValueError unless it's P-256"
+    if isinstance(public_key, str):
+        public_key = public_key.encode("utf-8")
+    if b"-----BEGIN CERTIFICATE-----" in public_key:
+        key = x509.load_pem_x509_certificate(public_key).public_key()
+    else:
+        key = serialization.load_pem_public_key(public_key)
+    if not isinstance(key, ec.EllipticCurvePublicKey) or not isinstance(
+        key.curve, ec.SECP256R1
+    ):
+        raise ValueError("IAP public keys must be P-256 keys")
+    return key
+
+
+def _b64decode(segment: str) -> bytes:
+    return base64.urlsafe_b64decode(segment + "=" * (-len(segment) % 4))
+
+
+def _decode_json(segment: str) -> Dict[str, Any]:
+    value = json.loads(_b64decode(segment))
+    if not isinstance(value, dict):
+        raise ValueError("not a JSON object")
+    return value
+
+
+class IapKeySet:
+    """IAP public keys indexed by key id, verifying ES256 tokens."""
+
+    def __init__(
+        self,
+        keys_json: Union[str, bytes],
+        audience: Optional[str] = None,
+        native: bool = True,
+    ) -> None:
+        certs = json.loads(keys_json)
+        if not isinstance(certs, dict):
+            raise ValueError("IAP keys must be a JSON object of key id to PEM key")
+        self.audience = audience
+        self.native = native
+        self._public_keys = {
+            key_id: load_es256_public_key(public_key)
+            for key_id, public_key in certs.items()
+        }
+        self._verifiers = {
+            key_id: es256.ES256Verifier(public_key)
+            for key_id, public_key in self._public_keys.items()
+        }
+
+    def __len__(self) -> int:
+        return len(self._public_keys)
+
+    def verify(
+        self, token: Union[str, bytes], clock_skew_in_seconds: int = 0
+    ) -> Mapping[str, Any]:
+        """Verifies the token signature and claims and returns its payload.
+
+        Raises the same google.auth exceptions as google.auth.jwt.decode.
+        """
+        if isinstance(token, bytes):
+            token = token.decode("utf-8")
+        if self.native:
+            payload = self._verify_native(token)
+        else:
+            payload = self._verify_google_auth(token)
+        _verify_claims(payload, self.audience, clock_skew_in_seconds)
+        return payload
+
+    def _verify_native(self, token: str) -> Mapping[str, Any]:
+        try:
+            encoded_header, encoded_payload, encoded_signature = token.split(".")
+            header = _decode_json(encoded_header)
+            signature = _b64decode(encoded_signature)
+        except ValueError as e:
+            raise exceptions.MalformedError(f"Malformed token: {e}") from e
+        if header.get("alg") != IAP_ALGORITHM:
+            raise exceptions.InvalidValue(
+                f"Unsupported signature algorithm {header.get('alg')}"
+            )
+        if len(signature) != ES256_SIGNATURE_LENGTH:
+            raise exceptions.MalformedError("Could not verify token signature.")
+
+        key_id = header.get("kid")
+        if key_id:
+            if key_id not in self._public_keys:
+                raise exceptions.MalformedError(
+                    f"Certificate for key id {key_id} not found."
+                )
+            public_keys = [self._public_keys[key_id]]
+        else:
+            public_keys = self._public_keys.values()
+
+        der_signature = encode_dss_signature(
+            int.from_bytes(signature[:32], "big"), int.from_bytes(signature[32:], "big")
+        )
+        message = f"{encoded_header}.{encoded_payload}".encode("utf-8")
+        for public_key in public_keys:
+            try:
+                public_key.verify(der_signature, message, _ECDSA_SHA256)
+                break
+            except InvalidSignature:
+                continue
+        else:
+            raise exceptions.MalformedError("Could not verify token signature.")
+
+        try:
+            return _decode_json(encoded_payload)
+        except ValueError as e:
+            raise exceptions.MalformedError(f"Malformed token payload: {e}") from e
+
+    def _verify_google_auth(self, token: str) -> Mapping[str, Any]:
+        header = jwt.decode_header(token)
+        if header.get("alg") != IAP_ALGORITHM:
+            raise exceptions.InvalidValue(
+                f"Unsupported signature algorithm {header.get('alg')}"
+            )
+
+        key_id = header.get("kid")
+        if key_id:
+            if key_id not in self._verifiers:
+                raise exceptions.MalformedError(
+                    f"Certificate for key id {key_id} not found."
+                )
+            verifiers = [self._verifiers[key_id]]
+        else:
+            verifiers = self._verifiers.values()
+
+        signed_section, _, encoded_signature = token.rpartition(".")
+        signature = _b64decode(encoded_signature)
+        message = signed_section.encode("utf-8")
+        if not any(verifier.verify(message, signature) for verifier in verifiers):
+            raise exceptions.MalformedError("Could not verify token signature.")
+        return jwt.decode(token, verify=False)
+
+
+def _verify_claims(
+    payload: Mapping[str, Any],
+    audience: Optional[str] = None,
+    clock_skew_in_seconds: int = 0,
+) -> None:
+    now = time.time()
+    for key in ("iat", "exp"):
+        if key not in payload:
+            raise exceptions.MalformedError(
+                f"Token does not contain required claim {key}"
+            )
+    iat, exp = payload["iat"], payload["exp"]
+    if now < iat - clock_skew_in_seconds:
+        raise exceptions.InvalidValue(f"Token used too early, {now} < {iat}")
+    if exp + clock_skew_in_seconds < now:
+        raise exceptions.InvalidValue(f"Token expired, {exp} < {now}")
+    if payload.get("iss") != IAP_ISSUER:
+        raise exceptions.InvalidValue(f"Token issuer {payload.get('iss')} is not IAP")
+    if audience is not None and payload.get("aud") != audience:
+        raise exceptions.InvalidValue(
+            f"Token audience {payload.get('aud')} is not {audience}"
+        )
+
+
+def read_keys(source: str, timeout: float = 10) -> bytes:
+    "Returns the keys JSON served at an http(s) URL or stored in a file"
+    if source.startswith(("http://", "https://")):
+        with urllib.request.urlopen(source, timeout=timeout) as response:
+            return response.read()
+    with open(source, "rb") as f:
+        return f.read()
+
+
+class IapKeyRefresher(threading.Thread):
+    """
+    Reloads the IAP keys from source (a URL or file) when started and then
+    every interval seconds. Changed keys are parsed with load and handed to
+    on_update(keys_json, key_set); when the source is unreachable or invalid
+    the previous keys stay in use.
+    """
+
+    def __init__(
+        self,
+        source: str,
+        on_update: Callable[[bytes, IapKeySet], None],
+        load: Callable[[bytes], IapKeySet] = IapKeySet,
+        interval: float = 3600,
+        timeout: float = 10,
+        keys_json: Optional[bytes] = None,
+    ) -> None:
+        super().__init__(name="iap-key-refresh", daemon=True)
+        self.source = source
+        self.on_update = on_update
+        self.load = load
+        self.interval = interval
+        self.timeout = timeout
+        self.updates = 0
+        self.errors = 0
+        self._keys_json = keys_json
+        self._stop_event = threading.Event()
+
+    def refresh(self) -> bool:
+        "Returns True if the keys changed and were swapped in"
+        try:
+            keys_json = read_keys(self.source, self.timeout)
+            if keys_json == self._keys_json:
+                return False
+            key_set = self.load(keys_json)
+            if not len(key_set):
+                raise ValueError("no keys found")
+        except Exception as e:
+            self.errors += 1
+            logger.warning(
+                "Service Extension IAP key refresh from %s failed: %s", self.source, e
+            )
+            return False
+        self._keys_json = keys_json
+        self.updates += 1
+        self.on_update(keys_json, key_set)
+        logger.info(
+            "Service Extension loaded %d IAP keys from %s", len(key_set), self.source
+        )
+        return True
+
+    def run(self) -> None:
+        self.refresh()
+        while not self._stop_event.wait(self.interval):
+            self.refresh()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+
+class VerifiedTokenCache:
+    """Bounded LRU of verified token payloads that honors the token `exp`."""
+
+    def __init__(self, max_size: int = 10000, ttl: float = 300) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # Incremented by clear(), e.g. when the keys were replaced
+        self.generation = 0
+        self._entries: "OrderedDict[bytes, Tuple[float, Mapping[str, Any]]]" = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def _key(token: Union[str, bytes]) -> bytes:
+        if isinstance(token, str):
+            token = token.encode("utf-8")
+        return hashlib.sha256(token).digest()
+
+    def get(self, token: Union[str, bytes]) -> Optional[Mapping[str, Any]]:
+        if self.max_size <= 0:
+            return None
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, payload = entry
+                if time.time() < expires_at:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return payload
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(
+        self,
+        token: Union[str, bytes],
+        payload: Mapping[str, Any],
+        generation: Optional[int] = None,
+    ) -> None:
+        """
+        Adds a verified token. generation, read before verifying it, keeps out
+        tokens verified with keys that were replaced (and the cache cleared) since.
+        """
+        if self.max_size <= 0:
+            return
+        expires_at = min(float(payload["exp"]), time.time() + self.ttl)
+        key = self._key(token)
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries[key] = (expires_at, payload)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
@@ -0,0 +1,47 @@
+# Copyright 2023 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+# Service Extension WAF Load Shedding
+----
+Bounds the number of ext_proc streams a process inspects at once.
+
+A stream beyond the limit is shed: the server answers it right away with a
+fixed verdict (fail open or fail closed) without inspecting it, instead of
+letting it wait behind the others until Envoy's message timeout expires.
+"""
+import threading
+
+
+class StreamLimiter:
+    """Counts the open streams and admits at most max_streams (0 is unlimited)."""
+
+    def __init__(self, max_streams: int = 0) -> None:
+        self.max_streams = max_streams
+        self.active = 0
+        self.shed = 0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> bool:
+        "Admits a new stream, False when it should be shed"
+        with self._lock:
+            if self.max_streams and self.active >= self.max_streams:
+                self.shed += 1
+                return False
+            self.active += 1
+            return True
+
+    def release(self) -> None:
+        "Called once an admitted stream ends"
+        with self._lock:
+            self.active -= 1
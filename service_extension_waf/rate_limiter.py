@@ -0,0 +1,178 @@
+# Copyright 2023 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+# Service Extension WAF Rate Limiter
+----
+Token bucket rate limiting per client (source IP or IAP user).
+
+Every key gets a bucket of `burst` tokens refilled at `rate` tokens per second;
+a request takes one token and is limited when the bucket is empty. Buckets are
+spread over shards by key hash, each with its own lock and LRU of at most
+max_keys / shards buckets, so a check is O(1), contention is spread across
+shards and memory stays bounded however many distinct clients show up. An
+evicted client simply starts again with a full bucket.
+
+With several instances, RateLimitSync makes the limits approximately global:
+each limiter records the tokens its clients took, and a background thread
+periodically exchanges them in one batch with a shared state backend (see
+shared_state.py), deducting what other instances took from the local
+buckets. Requests never wait for the backend; when it is unreachable each
+instance keeps limiting on its own.
+"""
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from shared_state import SharedStateError
+
+logger = logging.getLogger("service_extension_waf")
+
+
+class _Shard:
+    __slots__ = ("lock", "buckets", "taken")
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        # key -> [tokens, time of the last refill]
+        self.buckets: "OrderedDict[str, List[float]]" = OrderedDict()
+        # key -> tokens taken since the last sync, when shared
+        self.taken: Dict[str, int] = {}
+
+
+class TokenBucketRateLimiter:
+    """Sharded, bounded LRU of token buckets keyed by client."""
+
+    def __init__(
+        self,
+        rate: float,
+        burst: float,
+        max_keys: int = 100000,
+        shards: int = 64,
+        shared: bool = False,
+    ) -> None:
+        if rate <= 0 or burst < 1:
+            raise ValueError("rate must be positive and burst at least 1")
+        self.rate = rate
+        self.burst = burst
+        self.shared = shared
+        self.max_keys = max_keys
+        self.max_keys_per_shard = max(1, max_keys // shards)
+        self.evictions = 0
+        self._shards = [_Shard() for _ in range(shards)]
+
+    def __len__(self) -> int:
+        return sum(len(shard.buckets) for shard in self._shards)
+
+    def allow(self, key: str, now: Optional[float] = None) -> bool:
+        "Takes a token from the key's bucket, False when it is empty"
+        if now is None:
+            now = time.monotonic()
+        shard = self._shards[hash(key) % len(self._shards)]
+        with shard.lock:
+            bucket = shard.buckets.get(key)
+            if bucket is None:
+                bucket = shard.buckets[key] = [self.burst, now]
+                if len(shard.buckets) > self.max_keys_per_shard:
+                    shard.buckets.popitem(last=False)
+                    self.evictions += 1
+            else:
+                shard.buckets.move_to_end(key)
+
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            allowed = tokens >= 1
+            bucket[0] = tokens - 1 if allowed else tokens
+            if self.shared:
+                # Limited clients are synced too, to learn what others took
+                shard.taken[key] = shard.taken.get(key, 0) + allowed
+            return allowed
+
+    def take_synced(self) -> Dict[str, int]:
+        "Returns and resets the tokens taken per client since the last call"
+        taken: Dict[str, int] = {}
+        for shard in self._shards:
+            with shard.lock:
+                shard_taken, shard.taken = shard.taken, {}
+            taken.update(shard_taken)
+        return taken
+
+    def deduct(self, key: str, tokens: float) -> None:
+        "Removes tokens other instances took from the client's bucket"
+        shard = self._shards[hash(key) % len(self._shards)]
+        with shard.lock:
+            bucket = shard.buckets.get(key)
+            if bucket is not None:
+                bucket[0] = max(0.0, bucket[0] - tokens)
+
+    def clear(self) -> None:
+        for shard in self._shards:
+            with shard.lock:
+                shard.buckets.clear()
+
+
+class RateLimitSync(threading.Thread):
+    """
+    Exchanges the tokens taken by the limiter's clients with the backend every
+    interval seconds and deducts the tokens other instances took.
+    """
+
+    def __init__(
+        self, limiter: TokenBucketRateLimiter, backend: Any, interval: float = 0.5
+    ) -> None:
+        super().__init__(name="rate-limit-sync", daemon=True)
+        self.limiter = limiter
+        self.backend = backend
+        self.interval = interval
+        self.errors = 0
+        # Consumption older than a full refill no longer matters
+        self.max_age = limiter.burst / limiter.rate
+        # key -> (shared total, time) as of the last exchange
+        self._totals: "OrderedDict[str, tuple]" = OrderedDict()
+        self._stop_event = threading.Event()
+
+    def sync(self, now: Optional[float] = None) -> int:
+        "Runs one exchange, returns the number of clients synced"
+        taken = self.limiter.take_synced()
+        if not taken:
+            return 0
+        if now is None:
+            now = time.monotonic()
+        try:
+            totals = self.backend.exchange(taken)
+        except SharedStateError as e:
+            self.errors += 1
+            logger.warning("Service Extension rate limit sync failed: %s", e)
+            return 0
+
+        for key, total in totals.items():
+            previous = self._totals.pop(key, None)
+            if previous is not None and now - previous[1] <= self.max_age:
+                # The shared total also counts what this instance just took
+                remote = total - previous[0] - taken[key]
+                if remote > 0:
+                    self.limiter.deduct(key, remote)
+            self._totals[key] = (total, now)
+        while len(self._totals) > self.limiter.max_keys:
+            self._totals.popitem(last=False)
+        return len(totals)
+
+    def run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            self.sync()
+
+    def stop(self) -> None:
+        self._stop_event.set()
@@ -19,23 +19,65 @@ This server does two things:
 * Validates that the provided IAP JWT is valid
 -- Environment flag: se_require_iap
 --- Default Value: False
+-- IAP keys are reloaded in the background from a URL or file
+--- Environment flag: se_iap_keys_source, se_iap_keys_refresh_interval
+--- Default Value: None and 3600
 * Validates that the Clients Source IP is
 -- Explicitly Allowed (if allowed ranges are specified only specified source ranges are allowed, regardless if they match a denied range or not)
---- Environment flag: se_allowed_ipv4_cidr_ranges
---- Default Value: 0.0.0.0/0
+--- Environment flag: se_allowed_ipv4_cidr_ranges, se_allowed_ipv6_cidr_ranges
+--- Default Value: 0.0.0.0/0 and ::/0 when neither is set
 -- Explicitly Denied
---- Environment flag: se_denied_ipv4_cidr_ranges
+--- Environment flag: se_denied_ipv4_cidr_ranges, se_denied_ipv6_cidr_ranges
+--- Default Value: None
+-- Listed in a compiled IP reputation blocklist (see blocklist.py)
+--- Environment flag: se_blocklist_file
+--- Default Value: None
+-- The client IP is the first X-Forwarded-For hop from the right that isn't
+   appended by a trusted proxy (see xff_parser.py)
+--- Environment flag: se_xff_trusted_hops, se_xff_trusted_proxy_ranges
+--- Default Value: 1 and None
+* Denies requests whose path, query string or headers match attack signatures
+-- Environment flag: se_signature_file, se_signature_headers
+--- Default Value: None
+* Evaluates candidate rules in shadow, logging and counting their decisions
+  without enforcing them
+-- Environment flag: se_shadow_config_file
 --- Default Value: None
 
 Debug can be enabled by
 -- Environment flag: se_debug
 --- Default Value: False
 """
+
 # [START serviceextensions_callout_add_header_imports]
+import asyncio
+import json
+import logging
+import multiprocessing
+import signal
+import threading
+import time
+import weakref
+
 from concurrent import futures
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing.connection import Connection
+from time import perf_counter
 
-from typing import Iterator, List, Tuple
+from dataclasses import dataclass, replace
+from functools import lru_cache, wraps
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    FrozenSet,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
 import grpc
 
@@ -45,13 +87,49 @@ import service_pb2
 import service_pb2_grpc
 
 # Used to validate IAP JWT tokens
-from google.auth.transport import requests
-from google.oauth2 import id_token
+from iap_jwt import IapKeyRefresher, IapKeySet, VerifiedTokenCache
+
+# Used to validate IPv4 and IPv6 addresses
+from cidr_matcher import ALLOW, DENY, CidrMatcher
+
+# Memory-mapped IP reputation blocklist compiled by blocklist.py
+from blocklist import Blocklist
+
+# Bounds the streams inspected at once
+from load_shedding import StreamLimiter
+
+# Streaming request body inspection
+from body_inspection import BODY_TOO_LARGE, BodyInspector
+
+# Attack signatures matched against the path, query string and headers
+from signatures import SignatureEngine, load_signature_file
+
+# Candidate rules evaluated off the request path
+from shadow import ShadowEvaluator
 
-# Used to validate IPv4 addresses
-from ipaddress import ip_network, ip_address, get_mixed_type_key
+# Right-to-left X-Forwarded-For scanner aware of trusted proxies
+from xff_parser import XffParser
 
-from os import environ
+# Per-client token bucket rate limiting
+from rate_limiter import RateLimitSync, TokenBucketRateLimiter
+
+# Rate limit counters shared by every instance
+from shared_state import create_backend
+
+# Structured logging written from a background thread
+from waf_logging import configure_logging, dropped_records
+
+# Prometheus metrics served on the health check port
+from waf_metrics import (
+    REGISTRY,
+    CallbackMetric,
+    Counter,
+    Gauge,
+    Histogram,
+    Snapshot,
+)
+
+from os import cpu_count, environ, kill, stat
 
 # Backend services on GCE VMs, GKE and hybrid use this port.
 EXT_PROC_SECURE_PORT = 8443
@@ -59,19 +137,131 @@ EXT_PROC_SECURE_PORT = 8443
 EXT_PROC_INSECURE_PORT = 8080
 # Cloud health checks use this port.
 HEALTH_CHECK_PORT = 8000
+# Headers logged when debug logging is enabled.
+DEBUG_HEADERS = [":path", ":method", ":scheme", ":authority"]
+# Set from the verified IAP JWT when se_identity_headers is enabled
+IDENTITY_USER_HEADER = "x-se-waf-user"
+IDENTITY_EMAIL_HEADER = "x-se-waf-email"
+# Seconds between checks for worker processes that need to be restarted.
+WORKER_MONITOR_INTERVAL = 1
+# Seconds the supervisor waits for a worker's metrics before skipping it.
+WORKER_METRICS_TIMEOUT = 1
 # Example SSL Credentials for gRPC server
 # PEM-encoded private key & PEM-encoded certificate chain
 SERVER_CERTIFICATE = open("ssl_creds/localhost.crt", "rb").read()
 SERVER_CERTIFICATE_KEY = open("ssl_creds/localhost.key", "rb").read()
 ROOT_CERTIFICATE = open("ssl_creds/root.crt", "rb").read()
 
-IAP_CERTIFICATE = open("./iap_public_key.crt", "rb").read()
+# IAP public keys ({"key id": "PEM public key"}) used to validate IAP JWTs
+SERVICE_EXTENSION_IAP_CERTIFICATE_FILE = environ.get(
+    "se_iap_certificate_file", "./iap_public_key.crt"
+)
+IAP_CERTIFICATE = open(SERVICE_EXTENSION_IAP_CERTIFICATE_FILE, "rb").read()
 
 SERVICE_EXTENSION_DEBUG = environ.get("se_debug", "False").lower() == ("true")
 SERVICE_EXTENSION_TEST = environ.get("se_test", "False").lower() == ("true")
+# Log level defaults to DEBUG when se_debug is enabled, records below WARNING
+# are sampled with se_log_sample_rate (0.0 - 1.0)
+SERVICE_EXTENSION_LOG_LEVEL = environ.get(
+    "se_log_level", "DEBUG" if SERVICE_EXTENSION_DEBUG else "INFO"
+).upper()
+SERVICE_EXTENSION_LOG_SAMPLE_RATE = float(environ.get("se_log_sample_rate", "1.0"))
+SERVICE_EXTENSION_LOG_QUEUE_SIZE = int(environ.get("se_log_queue_size", "10000"))
 SERVICE_EXTENSION_REQUIRE_IAP = environ.get("se_require_iap", "False").lower() == (
     "true"
 )
+# "thread" serves each ext_proc stream on a thread pool worker, "async" multiplexes
+# all streams on a single grpc.aio event loop
+SERVICE_EXTENSION_SERVER_MODE = environ.get("se_server_mode", "thread").lower()
+# Number of ext_proc worker processes sharing the ports, 0 starts one per CPU
+SERVICE_EXTENSION_WORKERS = int(environ.get("se_workers", "1")) or cpu_count() or 1
+# gRPC server resources: thread pool size ("thread" mode), streams served at
+# once before new ones are rejected with RESOURCE_EXHAUSTED (0 is unlimited),
+# keepalive pings (0 disables them), maximum message size in bytes (0 keeps
+# the gRPC defaults) and response compression (none, gzip or deflate)
+SERVICE_EXTENSION_GRPC_MAX_WORKERS = int(environ.get("se_grpc_max_workers", "2"))
+SERVICE_EXTENSION_GRPC_MAX_CONCURRENT_RPCS = (
+    int(environ.get("se_grpc_max_concurrent_rpcs", "0")) or None
+)
+SERVICE_EXTENSION_GRPC_KEEPALIVE_TIME_MS = int(
+    environ.get("se_grpc_keepalive_time_ms", "0")
+)
+SERVICE_EXTENSION_GRPC_KEEPALIVE_TIMEOUT_MS = int(
+    environ.get("se_grpc_keepalive_timeout_ms", "20000")
+)
+SERVICE_EXTENSION_GRPC_MAX_MESSAGE_LENGTH = int(
+    environ.get("se_grpc_max_message_length", "0")
+)
+GRPC_COMPRESSION = {
+    "none": grpc.Compression.NoCompression,
+    "gzip": grpc.Compression.Gzip,
+    "deflate": grpc.Compression.Deflate,
+}
+SERVICE_EXTENSION_GRPC_COMPRESSION = environ.get("se_grpc_compression", "none").lower()
+if SERVICE_EXTENSION_GRPC_COMPRESSION not in GRPC_COMPRESSION:
+    raise ValueError(
+        f"Unknown se_grpc_compression {SERVICE_EXTENSION_GRPC_COMPRESSION}"
+    )
+
+# Lets several worker processes bind the same ext_proc ports.
+GRPC_SERVER_OPTIONS = [("grpc.so_reuseport", 1)]
+if SERVICE_EXTENSION_GRPC_KEEPALIVE_TIME_MS > 0:
+    GRPC_SERVER_OPTIONS += [
+        ("grpc.keepalive_time_ms", SERVICE_EXTENSION_GRPC_KEEPALIVE_TIME_MS),
+        ("grpc.keepalive_timeout_ms", SERVICE_EXTENSION_GRPC_KEEPALIVE_TIMEOUT_MS),
+    ]
+if SERVICE_EXTENSION_GRPC_MAX_MESSAGE_LENGTH > 0:
+    GRPC_SERVER_OPTIONS += [
+        ("grpc.max_receive_message_length", SERVICE_EXTENSION_GRPC_MAX_MESSAGE_LENGTH),
+        ("grpc.max_send_message_length", SERVICE_EXTENSION_GRPC_MAX_MESSAGE_LENGTH),
+    ]
+
+# Streams a process inspects at once; new streams beyond it are shed, answered
+# right away with se_load_shed_verdict without being inspected: "allow" lets
+# the request through (fail open), "deny" rejects it with 503 (fail closed).
+# 0 disables load shedding.
+SERVICE_EXTENSION_LOAD_SHED_MAX_STREAMS = int(
+    environ.get("se_load_shed_max_streams", "0")
+)
+SERVICE_EXTENSION_LOAD_SHED_VERDICT = environ.get(
+    "se_load_shed_verdict", "deny"
+).lower()
+if SERVICE_EXTENSION_LOAD_SHED_VERDICT not in ("allow", "deny"):
+    raise ValueError(
+        f"Unknown se_load_shed_verdict {SERVICE_EXTENSION_LOAD_SHED_VERDICT}"
+    )
+# In thread mode a stream only reaches the limiter once a pool thread picks it
+# up, so with a limit of se_grpc_max_workers or more nothing would be shed
+if SERVICE_EXTENSION_SERVER_MODE != "async" and (
+    0 < SERVICE_EXTENSION_GRPC_MAX_WORKERS <= SERVICE_EXTENSION_LOAD_SHED_MAX_STREAMS
+):
+    raise ValueError(
+        f"se_load_shed_max_streams ({SERVICE_EXTENSION_LOAD_SHED_MAX_STREAMS}) must "
+        f"be below se_grpc_max_workers ({SERVICE_EXTENSION_GRPC_MAX_WORKERS}) in "
+        "thread mode"
+    )
+
+SERVICE_EXTENSION_IAP_TOKEN_CACHE_SIZE = int(
+    environ.get("se_iap_token_cache_size", "10000")
+)
+SERVICE_EXTENSION_IAP_TOKEN_CACHE_TTL = int(
+    environ.get("se_iap_token_cache_ttl", "300")
+)
+# Expected `aud` claim of IAP JWTs (/projects/PROJECT_NUMBER/global/
+# backendServices/SERVICE_ID), not checked when unset
+SERVICE_EXTENSION_IAP_AUDIENCE = environ.get("se_iap_audience") or None
+# "native" verifies IAP JWTs directly with cryptography, "google_auth" through
+# google.auth
+SERVICE_EXTENSION_IAP_VERIFIER = environ.get("se_iap_verifier", "native").lower()
+if SERVICE_EXTENSION_IAP_VERIFIER not in ("native", "google_auth"):
+    raise ValueError(f"Unknown se_iap_verifier {SERVICE_EXTENSION_IAP_VERIFIER}")
+# URL or file the IAP public keys are reloaded from in the background every
+# interval seconds, e.g. https://www.gstatic.com/iap/verify/public_key (unset
+# keeps the keys read from se_iap_certificate_file at startup)
+SERVICE_EXTENSION_IAP_KEYS_SOURCE = environ.get("se_iap_keys_source")
+SERVICE_EXTENSION_IAP_KEYS_REFRESH_INTERVAL = float(
+    environ.get("se_iap_keys_refresh_interval", "3600")
+)
 
 SERVICE_EXTENSION_ALLOWED_IPV4_CIDR_ENABLED = environ.get("se_allowed_ipv4_cidr_ranges")
 SERVICE_EXTENSION_ALLOWED_IPV4_CIDR_RANGES = environ.get(
@@ -81,79 +271,721 @@ SERVICE_EXTENSION_ALLOWED_IPV4_CIDR_RANGES = environ.get(
 SERVICE_EXTENSION_DENIED_IPV4_CIDR_ENABLED = environ.get("se_denied_ipv4_cidr_ranges")
 SERVICE_EXTENSION_DENIED_IPV4_CIDR_RANGES = environ.get("se_denied_ipv4_cidr_ranges")
 
+SERVICE_EXTENSION_ALLOWED_IPV6_CIDR_ENABLED = environ.get("se_allowed_ipv6_cidr_ranges")
+SERVICE_EXTENSION_DENIED_IPV6_CIDR_ENABLED = environ.get("se_denied_ipv6_cidr_ranges")
+
+# Requests per second allowed per client (0 disables rate limiting), bursts of up
+# to se_rate_limit_burst requests (default: the rate), keyed by the source IP
+# ("client_ip") or the IAP user id ("iap_user", requires se_require_iap)
+SERVICE_EXTENSION_RATE_LIMIT = float(environ.get("se_rate_limit", "0"))
+SERVICE_EXTENSION_RATE_LIMIT_BURST = float(
+    environ.get("se_rate_limit_burst", "0")
+) or max(SERVICE_EXTENSION_RATE_LIMIT, 1)
+SERVICE_EXTENSION_RATE_LIMIT_KEY = environ.get("se_rate_limit_key", "client_ip").lower()
+SERVICE_EXTENSION_RATE_LIMIT_MAX_CLIENTS = int(
+    environ.get("se_rate_limit_max_clients", "100000")
+)
+# "local" limits every worker process on its own, a redis:// URL shares the
+# tokens taken with every instance, synced every interval seconds
+SERVICE_EXTENSION_RATE_LIMIT_BACKEND = environ.get("se_rate_limit_backend", "local")
+SERVICE_EXTENSION_RATE_LIMIT_SYNC_INTERVAL = float(
+    environ.get("se_rate_limit_sync_interval", "0.5")
+)
+
+# Request bodies (when Envoy sends them) larger than this are rejected with 413
+# (0 disables the limit)
+SERVICE_EXTENSION_MAX_REQUEST_BODY_BYTES = int(
+    environ.get("se_max_request_body_bytes", "0")
+)
+# Comma separated strings that deny a request body containing them
+SERVICE_EXTENSION_BODY_DENY_PATTERNS = environ.get("se_body_deny_patterns")
+
+# JSON file of attack signatures (see signatures.py), matched against the path,
+# query string and these headers
+SERVICE_EXTENSION_SIGNATURE_FILE = environ.get("se_signature_file")
+SERVICE_EXTENSION_SIGNATURE_HEADERS = [
+    header.strip().lower()
+    for header in environ.get(
+        "se_signature_headers", "user-agent,referer,cookie"
+    ).split(",")
+    if header.strip()
+]
+
+# Client IPs whose allow/deny decision is remembered until the rules change
+# (0 disables the cache)
+SERVICE_EXTENSION_DECISION_CACHE_SIZE = int(
+    environ.get("se_decision_cache_size", "10000")
+)
+
+# Blocklist compiled from IP reputation feeds by blocklist.py
+SERVICE_EXTENSION_BLOCKLIST_FILE = environ.get("se_blocklist_file")
+
+# Optional JSON file overriding the settings above, reloaded on SIGHUP and when
+# its modification time changes (checked every interval seconds, 0 disables)
+SERVICE_EXTENSION_CONFIG_FILE = environ.get("se_config_file")
+SERVICE_EXTENSION_CONFIG_RELOAD_INTERVAL = float(
+    environ.get("se_config_reload_interval", "5")
+)
+
+# Candidate rules (same format as se_config_file, applied on top of the live
+# rules) evaluated in shadow by a pool of background threads: their decisions
+# are logged and counted but never enforced
+SERVICE_EXTENSION_SHADOW_CONFIG_FILE = environ.get("se_shadow_config_file")
+SERVICE_EXTENSION_SHADOW_WORKERS = int(environ.get("se_shadow_workers", "2"))
+SERVICE_EXTENSION_SHADOW_QUEUE_SIZE = int(environ.get("se_shadow_queue_size", "10000"))
+
+# Adds the verified IAP identity to allowed requests as the x-se-waf-user and
+# x-se-waf-email headers (requires se_require_iap)
+SERVICE_EXTENSION_IDENTITY_HEADERS = environ.get(
+    "se_identity_headers", "False"
+).lower() == ("true")
+# When allowed requests clear Envoy's route cache: "auto" only when the WAF
+# mutated headers, "always" or "never"
+SERVICE_EXTENSION_CLEAR_ROUTE_CACHE = environ.get(
+    "se_clear_route_cache", "auto"
+).lower()
+if SERVICE_EXTENSION_CLEAR_ROUTE_CACHE not in ("auto", "always", "never"):
+    raise ValueError(
+        f"Unknown se_clear_route_cache {SERVICE_EXTENSION_CLEAR_ROUTE_CACHE}"
+    )
+
+# X-Forwarded-For hops appended by our own proxies (the load balancer appends
+# the client IP and then its own), skipped before looking for the client IP,
+# along with hops inside the comma separated trusted proxy ranges. At most
+# se_xff_max_hops hops of a header are examined.
+SERVICE_EXTENSION_XFF_TRUSTED_HOPS = int(environ.get("se_xff_trusted_hops", "1"))
+SERVICE_EXTENSION_XFF_TRUSTED_PROXY_RANGES = [
+    cidr.strip()
+    for cidr in environ.get("se_xff_trusted_proxy_ranges", "").split(",")
+    if cidr.strip()
+]
+SERVICE_EXTENSION_XFF_MAX_HOPS = int(environ.get("se_xff_max_hops", "32"))
+
 # Declare global variable
-global_sorted_ipv4_cidr_ranges = None
-global_formatted_ipv4_cidr_ranges = None
+# Hits and misses of decision caches replaced by a rule reload, once no stream
+# uses them anymore, and the caches still used by streams started before. The
+# lock keeps the counts from going backwards while a policy is swapped.
+global_retired_decision_cache_counts = [0, 0]
+global_retiring_client_ip_lookups = set()
+global_retired_decision_cache_lock = threading.RLock()
+global_worker_supervisor = None
+# Every rule compiled from the rule configuration, swapped in as a whole
+global_request_policy = None
+global_thread_pool = None
+global_rate_limit_sync = None
+global_shadow_rules = None
+global_shadow_evaluator = None
+global_iap_key_refresher = None
 
 
-if SERVICE_EXTENSION_DEBUG:
-    print(f"Service Extension Test Mode: {SERVICE_EXTENSION_TEST}")
-    print(f"Service Extension Require IAP: {SERVICE_EXTENSION_REQUIRE_IAP}")
-    print(
-        f"Service Extension Allowed Source Ranges: {SERVICE_EXTENSION_ALLOWED_IPV4_CIDR_RANGES}"
+def load_iap_key_set(keys_json: bytes) -> IapKeySet:
+    return IapKeySet(
+        keys_json,
+        audience=SERVICE_EXTENSION_IAP_AUDIENCE,
+        native=SERVICE_EXTENSION_IAP_VERIFIER == "native",
     )
-    print(
-        f"Service Extension Denied Source Ranges: {SERVICE_EXTENSION_DENIED_IPV4_CIDR_RANGES}"
+
+
+# Verified tokens are reused until they expire
+IAP_TOKEN_CACHE = VerifiedTokenCache(
+    max_size=SERVICE_EXTENSION_IAP_TOKEN_CACHE_SIZE,
+    ttl=SERVICE_EXTENSION_IAP_TOKEN_CACHE_TTL,
+)
+
+RATE_LIMITER = None
+if SERVICE_EXTENSION_RATE_LIMIT > 0:
+    if SERVICE_EXTENSION_RATE_LIMIT_KEY not in ("client_ip", "iap_user"):
+        raise ValueError(
+            f"Unknown se_rate_limit_key {SERVICE_EXTENSION_RATE_LIMIT_KEY}"
+        )
+    RATE_LIMITER = TokenBucketRateLimiter(
+        rate=SERVICE_EXTENSION_RATE_LIMIT,
+        burst=SERVICE_EXTENSION_RATE_LIMIT_BURST,
+        max_keys=SERVICE_EXTENSION_RATE_LIMIT_MAX_CLIENTS,
+        shared=SERVICE_EXTENSION_RATE_LIMIT_BACKEND != "local",
     )
 
+STREAM_LIMITER = StreamLimiter(SERVICE_EXTENSION_LOAD_SHED_MAX_STREAMS)
 
-def sort_ipv4_cidr_ranges() -> None:
-    global global_sorted_ipv4_cidr_ranges
-    global global_formatted_ipv4_cidr_ranges
-    allowed_ipv4_cidr_ranges = []
-    denied_ipv4_cidr_ranges = []
+XFF_PARSER = XffParser(
+    trusted_hops=SERVICE_EXTENSION_XFF_TRUSTED_HOPS,
+    trusted_proxy_ranges=SERVICE_EXTENSION_XFF_TRUSTED_PROXY_RANGES,
+    max_hops=SERVICE_EXTENSION_XFF_MAX_HOPS,
+)
 
-    if SERVICE_EXTENSION_ALLOWED_IPV4_CIDR_RANGES:
-        allowed_ipv4_cidr_ranges = [
-            allowed_ipv4_cidr.strip()
-            for allowed_ipv4_cidr in SERVICE_EXTENSION_ALLOWED_IPV4_CIDR_RANGES.split(
-                ","
-            )
-            if allowed_ipv4_cidr.strip()
-        ]
-    if SERVICE_EXTENSION_DENIED_IPV4_CIDR_RANGES:
-        denied_ipv4_cidr_ranges = [
-            denied_ipv4_cidr.strip()
-            for denied_ipv4_cidr in SERVICE_EXTENSION_DENIED_IPV4_CIDR_RANGES.split(",")
-            if denied_ipv4_cidr.strip()
-        ]
+DECISIONS = REGISTRY.register(
+    Counter(
+        "se_waf_decisions_total",
+        "Requests by WAF decision "
+        "(allow, deny, not_allowed, iap_fail, rate_limited, signature, "
+        "body_pattern, body_too_large, load_shed, error)",
+        ["decision"],
+    )
+)
+SHADOW_DECISIONS = REGISTRY.register(
+    Counter(
+        "se_waf_shadow_decisions_total",
+        "Requests by the decision of the shadow rules and of the live rules",
+        ["decision", "live"],
+    )
+)
+HANDLER_LATENCY = REGISTRY.register(
+    Histogram(
+        "se_waf_handler_duration_seconds",
+        "Time spent per handler, process_request covers the whole request",
+        ["handler"],
+    )
+)
+ACTIVE_STREAMS = REGISTRY.register(
+    Gauge("se_waf_active_streams", "ext_proc streams currently open")
+)
+REGISTRY.register(
+    CallbackMetric(
+        "se_waf_thread_pool_queue_depth",
+        "Streams waiting for a gRPC thread pool worker",
+        lambda: global_thread_pool._work_queue.qsize() if global_thread_pool else 0,
+    )
+)
+REGISTRY.register(
+    CallbackMetric(
+        "se_waf_iap_token_cache_requests_total",
+        "IAP token cache lookups by result",
+        lambda: {("hit",): IAP_TOKEN_CACHE.hits, ("miss",): IAP_TOKEN_CACHE.misses},
+        type="counter",
+        labelnames=["result"],
+    )
+)
+REGISTRY.register(
+    CallbackMetric(
+        "se_waf_iap_key_refreshes_total",
+        "Background IAP key reloads that swapped in new keys or failed",
+        lambda: (
+            {
+                ("updated",): global_iap_key_refresher.updates,
+                ("error",): global_iap_key_refresher.errors,
+            }
+            if global_iap_key_refresher
+            else {}
+        ),
+        type="counter",
+        labelnames=["result"],
+    )
+)
+REGISTRY.register(
+    CallbackMetric(
+        "se_waf_log_records_dropped_total",
+        "Log records dropped because the log queue was full",
+        dropped_records,
+        type="counter",
+    )
+)
+REGISTRY.register(
+    CallbackMetric(
+        "se_waf_decision_cache_requests_total",
+        "Client IP decision cache lookups by result",
+        lambda: decision_cache_counts(),
+        type="counter",
+        labelnames=["result"],
+    )
+)
+REGISTRY.register(
+    CallbackMetric(
+        "se_waf_rate_limit_clients",
+        "Clients with a rate limit token bucket",
+        lambda: len(RATE_LIMITER) if RATE_LIMITER else 0,
+    )
+)
+REGISTRY.register(
+    CallbackMetric(
+        "se_waf_rate_limit_evictions_total",
+        "Token buckets evicted to stay within se_rate_limit_max_clients",
+        lambda: RATE_LIMITER.evictions if RATE_LIMITER else 0,
+        type="counter",
+    )
+)
+REGISTRY.register(
+    CallbackMetric(
+        "se_waf_rate_limit_sync_errors_total",
+        "Failed exchanges with the shared rate limit backend",
+        lambda: global_rate_limit_sync.errors if global_rate_limit_sync else 0,
+        type="counter",
+    )
+)
+REGISTRY.register(
+    CallbackMetric(
+        "se_waf_shadow_queue_depth",
+        "Requests waiting for shadow evaluation",
+        lambda: global_shadow_evaluator.pending() if global_shadow_evaluator else 0,
+    )
+)
+REGISTRY.register(
+    CallbackMetric(
+        "se_waf_shadow_dropped_total",
+        "Requests not evaluated in shadow because the shadow queue was full",
+        lambda: global_shadow_evaluator.dropped if global_shadow_evaluator else 0,
+        type="counter",
+    )
+)
+REGISTRY.register(
+    CallbackMetric(
+        "se_waf_workers_alive",
+        "ext_proc worker processes running under the supervisor",
+        lambda: (
+            global_worker_supervisor.alive_workers() if global_worker_supervisor else 0
+        ),
+    )
+)
+
+
+logger = configure_logging(
+    level=logging.getLevelName(SERVICE_EXTENSION_LOG_LEVEL),
+    sample_rate=SERVICE_EXTENSION_LOG_SAMPLE_RATE,
+    queue_size=SERVICE_EXTENSION_LOG_QUEUE_SIZE,
+)
 
-    combined_ipv4_cidr_ranges = [
-        (ip_network(cidr), "deny") for cidr in denied_ipv4_cidr_ranges
-    ] + [(ip_network(cidr), "allow") for cidr in allowed_ipv4_cidr_ranges]
+logger.debug("Service Extension Test Mode: %s", SERVICE_EXTENSION_TEST)
+logger.debug("Service Extension Require IAP: %s", SERVICE_EXTENSION_REQUIRE_IAP)
+logger.debug("Service Extension Server Mode: %s", SERVICE_EXTENSION_SERVER_MODE)
+logger.debug("Service Extension Workers: %s", SERVICE_EXTENSION_WORKERS)
+logger.debug(
+    "Service Extension Rate Limit: %s/s, burst %s, by %s",
+    SERVICE_EXTENSION_RATE_LIMIT,
+    SERVICE_EXTENSION_RATE_LIMIT_BURST,
+    SERVICE_EXTENSION_RATE_LIMIT_KEY,
+)
+logger.debug(
+    "Service Extension Allowed Source Ranges: %s",
+    SERVICE_EXTENSION_ALLOWED_IPV4_CIDR_RANGES,
+)
+logger.debug(
+    "Service Extension Denied Source Ranges: %s",
+    SERVICE_EXTENSION_DENIED_IPV4_CIDR_RANGES,
+)
+logger.debug(
+    "Service Extension Allowed IPv6 Source Ranges: %s",
+    SERVICE_EXTENSION_ALLOWED_IPV6_CIDR_ENABLED,
+)
+logger.debug(
+    "Service Extension Denied IPv6 Source Ranges: %s",
+    SERVICE_EXTENSION_DENIED_IPV6_CIDR_ENABLED,
+)
 
-    global_sorted_ipv4_cidr_ranges = sorted(
-        combined_ipv4_cidr_ranges,
-        key=lambda x: get_mixed_type_key(x[0]),
-        reverse=True,
+# IAP public keys are parsed once per (re)load. Invalid keys only stop the
+# server when IAP is required, otherwise no keys are loaded until a refresh
+# brings valid ones, and readiness fails if a rule reload then requires IAP.
+try:
+    IAP_KEY_SET = load_iap_key_set(IAP_CERTIFICATE)
+except ValueError as e:
+    if SERVICE_EXTENSION_REQUIRE_IAP:
+        raise
+    logger.error(
+        "Service Extension failed to load the IAP keys of %s: %s",
+        SERVICE_EXTENSION_IAP_CERTIFICATE_FILE,
+        e,
     )
+    IAP_KEY_SET = load_iap_key_set(b"{}")
 
-    if SERVICE_EXTENSION_DEBUG:
-        global_formatted_ipv4_cidr_ranges = [
-            (str(cidr_network), action)
-            for cidr_network, action in global_sorted_ipv4_cidr_ranges
-        ]
-        print(
-            f"Service Extension XFF Header sorted CIDR Ranges: {global_formatted_ipv4_cidr_ranges}"
+
+@dataclass(frozen=True)
+class RuleConfiguration:
+    """
+    Source IP and IAP settings that can be reloaded without a restart.
+    CIDR ranges are kept as comma separated strings, None when not configured.
+    """
+
+    require_iap: bool = SERVICE_EXTENSION_REQUIRE_IAP
+    allowed_ipv4_cidr_ranges: Optional[str] = (
+        SERVICE_EXTENSION_ALLOWED_IPV4_CIDR_ENABLED
+    )
+    denied_ipv4_cidr_ranges: Optional[str] = SERVICE_EXTENSION_DENIED_IPV4_CIDR_ENABLED
+    allowed_ipv6_cidr_ranges: Optional[str] = (
+        SERVICE_EXTENSION_ALLOWED_IPV6_CIDR_ENABLED
+    )
+    denied_ipv6_cidr_ranges: Optional[str] = SERVICE_EXTENSION_DENIED_IPV6_CIDR_ENABLED
+    blocklist_file: Optional[str] = SERVICE_EXTENSION_BLOCKLIST_FILE
+    body_deny_patterns: Optional[str] = SERVICE_EXTENSION_BODY_DENY_PATTERNS
+    signature_file: Optional[str] = SERVICE_EXTENSION_SIGNATURE_FILE
+
+    @property
+    def xff_enabled(self) -> bool:
+        return bool(
+            self.allowed_ipv4_cidr_ranges
+            or self.denied_ipv4_cidr_ranges
+            or self.allowed_ipv6_cidr_ranges
+            or self.denied_ipv6_cidr_ranges
+            or self.blocklist_file
         )
-    return None
+
+
+def load_rule_configuration(
+    config_file: Optional[str] = SERVICE_EXTENSION_CONFIG_FILE,
+    base: Optional[RuleConfiguration] = None,
+) -> RuleConfiguration:
+    """
+    Returns the environment settings (or base) overridden by the JSON config
+    file, e.g. {"se_require_iap": true, "se_denied_ipv4_cidr_ranges": ["1.0.0.0/8"]}
+    """
+    configuration = base or RuleConfiguration()
+    if not config_file:
+        return configuration
+
+    with open(config_file, "r") as f:
+        settings = json.load(f)
+
+    changes = {}
+    for key, value in settings.items():
+        if key == "se_require_iap":
+            changes["require_iap"] = str(value).lower() == "true"
+        elif key in (
+            "se_allowed_ipv4_cidr_ranges",
+            "se_denied_ipv4_cidr_ranges",
+            "se_allowed_ipv6_cidr_ranges",
+            "se_denied_ipv6_cidr_ranges",
+        ):
+            if isinstance(value, list):
+                value = ",".join(value)
+            changes[key[len("se_") :]] = value
+        elif key == "se_body_deny_patterns":
+            if isinstance(value, list):
+                value = ",".join(value)
+            changes["body_deny_patterns"] = value
+        elif key == "se_blocklist_file":
+            changes["blocklist_file"] = value or None
+        elif key == "se_signature_file":
+            changes["signature_file"] = value or None
+        else:
+            raise ValueError(f"Unknown setting {key} in {config_file}")
+    return replace(configuration, **changes)
+
+
+def apply_rule_configuration(configuration: RuleConfiguration) -> None:
+    """
+    Compiles the configuration and swaps it in, only once all of it compiled.
+    Requests already in flight keep using the policy they started with.
+    """
+    global global_request_policy
+    # Without IAP there is no user to rate limit by, requests would all pass
+    if (
+        RATE_LIMITER is not None
+        and SERVICE_EXTENSION_RATE_LIMIT_KEY == "iap_user"
+        and not configuration.require_iap
+    ):
+        raise ValueError("se_rate_limit_key iap_user requires se_require_iap")
+    policy = compile_request_policy(configuration)
+    with global_retired_decision_cache_lock:
+        retired_policy = global_request_policy
+        global_request_policy = policy
+        if retired_policy is not None:
+            retire_client_ip_lookup(retired_policy)
+    load_shadow_rules(policy)
+
+
+def reload_rule_configuration(
+    config_file: Optional[str] = SERVICE_EXTENSION_CONFIG_FILE,
+) -> bool:
+    "Reloads the config file, keeping the current configuration if it is invalid"
+    try:
+        apply_rule_configuration(load_rule_configuration(config_file))
+    except Exception as e:
+        logger.error("Service Extension failed to reload %s: %s", config_file, e)
+        return False
+    logger.info("Service Extension reloaded %s", config_file)
+    return True
+
+
+def load_blocklist(configuration: RuleConfiguration) -> Optional[Blocklist]:
+    """
+    Maps the compiled blocklist into memory. It is mapped again on every reload,
+    so replacing the file and sending SIGHUP picks up new feeds.
+    """
+    blocklist = None
+    if configuration.blocklist_file:
+        blocklist = Blocklist(configuration.blocklist_file)
+        logger.info(
+            "Service Extension mapped %d blocklist ranges from %s",
+            len(blocklist),
+            configuration.blocklist_file,
+            extra={"blocklist_ranges": len(blocklist)},
+        )
+    return blocklist
+
+
+def load_signatures(configuration: RuleConfiguration) -> Optional[SignatureEngine]:
+    "Compiles the signature file, read again on every reload"
+    engine = None
+    if configuration.signature_file:
+        engine = SignatureEngine(load_signature_file(configuration.signature_file))
+        logger.info(
+            "Service Extension compiled %d signatures from %s",
+            len(engine),
+            configuration.signature_file,
+            extra={"signatures": len(engine)},
+        )
+    return engine
+
+
+@dataclass(frozen=True)
+class ShadowRules:
+    """Candidate rules compiled from se_shadow_config_file, never enforced."""
+
+    configuration: RuleConfiguration
+    cidr_matcher: CidrMatcher
+    blocklist: Optional[Blocklist]
+    signature_engine: Optional[SignatureEngine]
+
+
+def load_shadow_rules(policy: "RequestPolicy") -> None:
+    """
+    Compiles se_shadow_config_file on top of the live configuration. A shadow
+    file that fails to load is logged and the previous shadow rules are kept,
+    so it never holds back a reload of the live rules.
+    """
+    global global_shadow_rules
+    if not SERVICE_EXTENSION_SHADOW_CONFIG_FILE:
+        return
+    configuration = policy.configuration
+    try:
+        shadow_configuration = load_rule_configuration(
+            SERVICE_EXTENSION_SHADOW_CONFIG_FILE, base=configuration
+        )
+        # The live blocklist and signatures are reused when unchanged
+        blocklist = policy.blocklist
+        if shadow_configuration.blocklist_file != configuration.blocklist_file:
+            blocklist = None
+            if shadow_configuration.blocklist_file:
+                blocklist = Blocklist(shadow_configuration.blocklist_file)
+        signature_engine = policy.signature_engine
+        if shadow_configuration.signature_file != configuration.signature_file:
+            signature_engine = None
+            if shadow_configuration.signature_file:
+                signature_engine = SignatureEngine(
+                    load_signature_file(shadow_configuration.signature_file)
+                )
+        global_shadow_rules = ShadowRules(
+            configuration=shadow_configuration,
+            cidr_matcher=compile_cidr_matcher(shadow_configuration),
+            blocklist=blocklist,
+            signature_engine=signature_engine,
+        )
+    except Exception as e:
+        logger.error(
+            "Service Extension failed to load shadow rules %s: %s",
+            SERVICE_EXTENSION_SHADOW_CONFIG_FILE,
+            e,
+        )
+        return
+    logger.info(
+        "Service Extension loaded shadow rules %s", SERVICE_EXTENSION_SHADOW_CONFIG_FILE
+    )
+
+
+def handle_reload_signal(signum: int, frame: Any) -> None:
+    threading.Thread(target=reload_rule_configuration, daemon=True).start()
+    if global_worker_supervisor is not None:
+        global_worker_supervisor.signal_workers(signum)
+
+
+class RuleConfigurationWatcher(threading.Thread):
+    "Reloads the config file whenever its modification time changes"
+
+    def __init__(self, config_file: str, interval: float) -> None:
+        super().__init__(daemon=True)
+        self.config_file = config_file
+        self.interval = interval
+        self._modified = self._modification_time()
+
+    def _modification_time(self) -> Optional[int]:
+        try:
+            return stat(self.config_file).st_mtime_ns
+        except OSError:
+            return None
+
+    def check(self) -> bool:
+        "Returns True if the file changed and was reloaded"
+        modified = self._modification_time()
+        if modified is None or modified == self._modified:
+            return False
+        self._modified = modified
+        return reload_rule_configuration(self.config_file)
+
+    def run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            self.check()
+
+
+def start_rule_configuration_reloading() -> None:
+    "Reload the config file on SIGHUP and when it changes"
+    if (
+        hasattr(signal, "SIGHUP")
+        and threading.current_thread() is threading.main_thread()
+    ):
+        signal.signal(signal.SIGHUP, handle_reload_signal)
+    if SERVICE_EXTENSION_CONFIG_FILE and SERVICE_EXTENSION_CONFIG_RELOAD_INTERVAL > 0:
+        RuleConfigurationWatcher(
+            SERVICE_EXTENSION_CONFIG_FILE, SERVICE_EXTENSION_CONFIG_RELOAD_INTERVAL
+        ).start()
+
+
+def update_iap_keys(keys_json: bytes, key_set: IapKeySet) -> None:
+    "Swaps in reloaded IAP keys, tokens verified with the previous keys are dropped"
+    global IAP_CERTIFICATE, IAP_KEY_SET
+    IAP_KEY_SET = key_set
+    IAP_CERTIFICATE = keys_json
+    IAP_TOKEN_CACHE.clear()
+
+
+def start_iap_key_refresh() -> None:
+    "Starts reloading the IAP keys in the background when a source is configured"
+    global global_iap_key_refresher
+    if (
+        not SERVICE_EXTENSION_IAP_KEYS_SOURCE
+        or SERVICE_EXTENSION_IAP_KEYS_REFRESH_INTERVAL <= 0
+    ):
+        return
+    global_iap_key_refresher = IapKeyRefresher(
+        SERVICE_EXTENSION_IAP_KEYS_SOURCE,
+        update_iap_keys,
+        load=load_iap_key_set,
+        interval=SERVICE_EXTENSION_IAP_KEYS_REFRESH_INTERVAL,
+        keys_json=IAP_CERTIFICATE,
+    )
+    global_iap_key_refresher.start()
+
+
+def split_setting(value: Optional[str]) -> List[str]:
+    "Returns the items of a comma separated setting"
+    if not value:
+        return []
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+def compile_cidr_matcher(configuration: RuleConfiguration) -> CidrMatcher:
+    """
+    Compiles the allowed and denied IPv4 and IPv6 CIDR ranges into a
+    longest-prefix-match index, so source IP lookups don't depend on the number
+    of ranges.
+    """
+    allowed_cidr_ranges = split_setting(
+        configuration.allowed_ipv4_cidr_ranges
+    ) + split_setting(configuration.allowed_ipv6_cidr_ranges)
+    denied_cidr_ranges = split_setting(
+        configuration.denied_ipv4_cidr_ranges
+    ) + split_setting(configuration.denied_ipv6_cidr_ranges)
+
+    # Every source range is allowed unless allowed ranges are configured for
+    # either family, in which case the other family has to be listed as well
+    if not allowed_cidr_ranges:
+        allowed_cidr_ranges = ["0.0.0.0/0", "::/0"]
+
+    return CidrMatcher(
+        [(cidr, DENY) for cidr in denied_cidr_ranges]
+        + [(cidr, ALLOW) for cidr in allowed_cidr_ranges]
+    )
+
+
+def sort_cidr_ranges(configuration: RuleConfiguration) -> CidrMatcher:
+    "Compiles the CIDR ranges, logging them"
+    cidr_matcher = compile_cidr_matcher(configuration)
+
+    logger.info(
+        "Service Extension compiled %d CIDR ranges",
+        len(cidr_matcher),
+        extra={"cidr_ranges": len(cidr_matcher)},
+    )
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "Service Extension XFF Header sorted CIDR Ranges: %s",
+            [(cidr, action) for action, cidr in cidr_matcher.rules()],
+        )
+    return cidr_matcher
+
+
+def lookup_client_ip(
+    cidr_matcher: CidrMatcher, blocklist: Optional[Blocklist], client_ip: str
+) -> Optional[Tuple[str, str]]:
+    "Returns the (action, matched range) of the client IP, None if none matches"
+    match = cidr_matcher.lookup(client_ip)
+    # Blocklisted clients are denied even when they are in an allowed range
+    if blocklist is not None and (match is None or match[0] == ALLOW):
+        match = blocklist.lookup(client_ip) or match
+    return match
+
+
+def compile_client_ip_lookup(
+    cidr_matcher: CidrMatcher, blocklist: Optional[Blocklist]
+) -> Callable[[str], Optional[Tuple[str, str]]]:
+    """
+    Combines the CIDR matcher and blocklist into the client IP lookup used by
+    handle_xff_validation, behind an LRU cache of decisions by client IP. Every
+    compiled policy gets a new lookup, with an empty cache.
+    """
+
+    def lookup(client_ip: str) -> Optional[Tuple[str, str]]:
+        return lookup_client_ip(cidr_matcher, blocklist, client_ip)
+
+    if SERVICE_EXTENSION_DECISION_CACHE_SIZE > 0:
+        lookup = lru_cache(maxsize=SERVICE_EXTENSION_DECISION_CACHE_SIZE)(lookup)
+    return lookup
+
+
+def retire_client_ip_lookup(policy: "RequestPolicy") -> None:
+    """
+    Keeps counting the cache hits and misses of the lookup of a policy that was
+    swapped out. Streams that started with the policy still use its lookup, so
+    its counts are only added up for good once the last of them ended.
+    """
+    lookup = policy.client_ip_lookup
+    if hasattr(lookup, "cache_info"):
+        with global_retired_decision_cache_lock:
+            global_retiring_client_ip_lookups.add(lookup)
+        weakref.finalize(policy, count_retired_client_ip_lookup, lookup)
+
+
+def count_retired_client_ip_lookup(lookup: Callable) -> None:
+    with global_retired_decision_cache_lock:
+        cache_info = lookup.cache_info()
+        global_retired_decision_cache_counts[0] += cache_info.hits
+        global_retired_decision_cache_counts[1] += cache_info.misses
+        global_retiring_client_ip_lookups.discard(lookup)
+
+
+def decision_cache_counts() -> Dict[Tuple[str, ...], int]:
+    with global_retired_decision_cache_lock:
+        hits, misses = global_retired_decision_cache_counts
+        lookups = list(global_retiring_client_ip_lookups)
+        policy = global_request_policy
+        if policy is not None and hasattr(policy.client_ip_lookup, "cache_info"):
+            lookups.append(policy.client_ip_lookup)
+        for lookup in lookups:
+            cache_info = lookup.cache_info()
+            hits += cache_info.hits
+            misses += cache_info.misses
+    return {("hit",): hits, ("miss",): misses}
 
 
 # [END serviceextensions_callout_add_header_imports]
 # [START serviceextensions_callout_add_header_main]
 def add_headers_mutation(
-    headers: List[Tuple[str, str]], clear_route_cache: bool = False
+    headers: List[Tuple[str, str]],
+    clear_route_cache: bool = False,
+    overwrite: bool = False,
 ) -> service_pb2.HeadersResponse:
     """
     Returns an ext_proc HeadersResponse for adding a list of headers.
     clear_route_cache should be set to influence service selection for route
-    extensions.
+    extensions. overwrite replaces any value the request already has for the
+    headers, instead of appending to it.
     """
+    append_action = service_pb2.HeaderValueOption.APPEND_IF_EXISTS_OR_ADD
+    if overwrite:
+        append_action = service_pb2.HeaderValueOption.OVERWRITE_IF_EXISTS_OR_ADD
     response_header_mutation = service_pb2.HeadersResponse()
     response_header_mutation.response.header_mutation.set_headers.extend(
         [
             service_pb2.HeaderValueOption(
-                header=service_pb2.HeaderValue(key=k, raw_value=bytes(v, "utf-8"))
+                header=service_pb2.HeaderValue(key=k, raw_value=bytes(v, "utf-8")),
+                append_action=append_action,
             )
             for k, v in headers
         ]
@@ -168,108 +1000,582 @@ def validate_iap_jwt(iap_jwt):
 
     Args:
       iap_jwt: The contents of the X-Goog-IAP-JWT-Assertion header.
-      expected_audience: The Signed Header JWT audience. See
-          https://cloud.google.com/iap/docs/signed-headers-howto
-          for details on how to get this value.
+
+    The expected audience is set with se_iap_audience. See
+    https://cloud.google.com/iap/docs/signed-headers-howto for details on how
+    to get this value.
 
     Returns:
       (user_id, user_email, error_str).
     """
 
     try:
-        decoded_jwt = id_token.verify_token(
-            iap_jwt,
-            requests.Request(),
-            audience=None,
-            certs_url="http://127.0.0.1:8000/iap_public_key.crt",
-        )
+        decoded_jwt = IAP_TOKEN_CACHE.get(iap_jwt)
+        if decoded_jwt is None:
+            # Read before the keys, so a token verified with keys replaced in
+            # the meantime isn't cached past the clear of update_iap_keys
+            generation = IAP_TOKEN_CACHE.generation
+            decoded_jwt = IAP_KEY_SET.verify(iap_jwt)
+            IAP_TOKEN_CACHE.put(iap_jwt, decoded_jwt, generation)
         return (decoded_jwt["sub"], decoded_jwt["email"], "")
     except Exception as e:
         return (None, None, f"**ERROR: JWT validation error {e}**")
 
 
-def custom_response(status_code, custom_response):
-    immediate_response = service_pb2.ImmediateResponse(
-        status=service_pb2.HttpStatus(code=status_code), body=custom_response
+def immediate_response(status_code: int, body: str) -> service_pb2.ProcessingResponse:
+    "Returns the response sending the status and body to the client right away"
+    return service_pb2.ProcessingResponse(
+        immediate_response=service_pb2.ImmediateResponse(
+            status=service_pb2.HttpStatus(code=status_code), body=body
+        )
     )
-    yield service_pb2.ProcessingResponse(immediate_response=immediate_response)
 
 
-def handle_iap_jwt_validation(header_value):
+# Responses of the common verdicts, built once instead of per request. Messages
+# are only read when serialized, so the same instance is shared by every stream.
+ALLOW_RESPONSE = service_pb2.ProcessingResponse(
+    request_headers=service_pb2.HeadersResponse(
+        response=service_pb2.CommonResponse(
+            clear_route_cache=SERVICE_EXTENSION_CLEAR_ROUTE_CACHE == "always"
+        )
+    )
+)
+IAP_INVALID_RESPONSE = immediate_response(
+    service_pb2.StatusCode.Unauthorized,
+    "Either the JWT token is invalid or was not provided",
+)
+NOT_ALLOWED_RESPONSE = immediate_response(
+    service_pb2.StatusCode.Forbidden, "Requests from this source ip are not allowed"
+)
+DENIED_RESPONSE = immediate_response(
+    service_pb2.StatusCode.Forbidden, "Requests from this source ip are denied"
+)
+RATE_LIMITED_RESPONSE = immediate_response(
+    service_pb2.StatusCode.TooManyRequests, "Too many requests"
+)
+SIGNATURE_RESPONSE = immediate_response(
+    service_pb2.StatusCode.Forbidden, "Request matched a blocked signature"
+)
+BODY_DENIED_RESPONSE = immediate_response(
+    service_pb2.StatusCode.Forbidden, "Request body was denied"
+)
+BODY_TOO_LARGE_RESPONSE = immediate_response(
+    service_pb2.StatusCode.PayloadTooLarge, "Request body too large"
+)
+LOAD_SHED_RESPONSE = (
+    ALLOW_RESPONSE
+    if SERVICE_EXTENSION_LOAD_SHED_VERDICT == "allow"
+    else immediate_response(
+        service_pb2.StatusCode.ServiceUnavailable, "Service temporarily overloaded"
+    )
+)
+
+
+def handle_rate_limit(key, client_ip=None):
+    "Returns a 429 response when the client has used up its token bucket"
+    if RATE_LIMITER.allow(key):
+        return None
+    DECISIONS.inc("rate_limited")
+    logger.info(
+        "Service Extension rate limited %s",
+        key,
+        extra={
+            "decision": "deny",
+            "reason": "rate_limited",
+            "rate_limit_key": key,
+            "client_ip": client_ip,
+        },
+    )
+    return RATE_LIMITED_RESPONSE
+
+
+def handle_iap_jwt_validation(header_value, stream=None):
     user_id, user_email, error_str = validate_iap_jwt(header_value)
     if error_str:
-        if SERVICE_EXTENSION_DEBUG:
-            print(f"Service Extension IAP Header was invalid: {error_str}")
-        return custom_response(
-            service_pb2.StatusCode.Unauthorized,
-            "Either the JWT token is invalid or was not provided",
+        DECISIONS.inc("iap_fail")
+        logger.info(
+            "Service Extension IAP Header was invalid: %s",
+            error_str,
+            extra={"decision": "deny", "reason": "iap_invalid"},
         )
-    if SERVICE_EXTENSION_DEBUG:
-        print(f"Service Extension IAP Header was valid")
+        return IAP_INVALID_RESPONSE
+    logger.debug("Service Extension IAP Header was valid")
+    if stream is not None:
+        stream.identity = (user_id, user_email)
+    if RATE_LIMITER is not None and SERVICE_EXTENSION_RATE_LIMIT_KEY == "iap_user":
+        return handle_rate_limit(user_id)
+    return None  # Return if no Validation Issue
+
+
+def deny_signature_match(match):
+    target, signature = match
+    DECISIONS.inc("signature")
+    logger.info(
+        "Service Extension request %s matched signature %s",
+        target,
+        signature.id,
+        extra={
+            "decision": "deny",
+            "reason": "signature",
+            "signature": signature.id,
+            "target": target,
+        },
+    )
+    return SIGNATURE_RESPONSE
+
+
+def handle_path_signatures(header_value, stream=None):
+    policy = stream.policy if stream is not None else global_request_policy
+    match = policy.signature_engine.scan_path(header_value)
+    if match is not None:
+        return deny_signature_match(match)
     return None  # Return if no Validation Issue
 
 
-def handle_xff_validation(header_value):
+def handle_header_signatures(header_value, stream=None):
+    policy = stream.policy if stream is not None else global_request_policy
+    match = policy.signature_engine.scan_header(header_value)
+    if match is not None:
+        return deny_signature_match(match)
+    return None  # Return if no Validation Issue
+
+
+def scan_header_signatures_before(handler):
+    "Returns the scoped handler, run once the header passed the signature scan"
+
+    @wraps(handler)
+    def handle(header_value, stream=None):
+        response = handle_header_signatures(header_value, stream)
+        if response is not None:
+            return response
+        return handler(header_value, stream)
+
+    return handle
+
+
+def handle_xff_validation(header_value, stream=None):
     allow_request = False
     deny_request = False
-    matched_ipv4_cidr = None
-    xff_list = [ip.strip() for ip in header_value.split(",") if ip.strip()]
-
-    if len(xff_list) >= 2:
-        client_ipv4 = ip_address(xff_list[-2])
-        for cidr, action in global_sorted_ipv4_cidr_ranges:
-            if client_ipv4 in cidr:
-                matched_ipv4_cidr = cidr
-                if action == "allow":
-                    allow_request = True
-                    deny_request = False
-                elif action == "deny":
-                    allow_request = False
-                    deny_request = True
-                break
-
-        if SERVICE_EXTENSION_DEBUG:
-            print(
-                f"Service Extension XFF Header sorted CIDR Ranges: {global_formatted_ipv4_cidr_ranges}"
-            )
-            print(
-                f"""Service Extension XFF Header result:
-                    Source IPv4: {client_ipv4}
-                    Deny Request: {deny_request}
-                    Allow Request: {allow_request}
-                    Matched IPv4 CIDR: {matched_ipv4_cidr}"""
-            )
+    matched_cidr = None
+    client_ip = XFF_PARSER.client_ip(header_value)
+
+    if client_ip is not None:
+        policy = stream.policy if stream is not None else global_request_policy
+        match = policy.client_ip_lookup(client_ip)
+        if match is not None:
+            action, matched_cidr = match
+            allow_request = action == ALLOW
+            deny_request = action == DENY
+
+        logger.debug(
+            "Service Extension XFF Header result: Source IP: %s, Deny Request: %s, Allow Request: %s, Matched CIDR: %s",
+            client_ip,
+            deny_request,
+            allow_request,
+            matched_cidr,
+        )
 
         if not allow_request and not deny_request:
-            if SERVICE_EXTENSION_DEBUG:
-                print(
-                    f"Service Extension XFF Header for source ip ({client_ipv4}) did not match any allowed ranges"
-                )
-            return custom_response(
-                service_pb2.StatusCode.Forbidden,
-                f"Requests for source ip ({client_ipv4}) was not allowed",
+            DECISIONS.inc("not_allowed")
+            logger.info(
+                "Service Extension XFF Header for source ip (%s) did not match any allowed ranges",
+                client_ip,
+                extra={
+                    "decision": "deny",
+                    "reason": "not_allowed",
+                    "client_ip": client_ip,
+                },
             )
+            return NOT_ALLOWED_RESPONSE
 
         if deny_request:
-            if SERVICE_EXTENSION_DEBUG:
-                print(
-                    f"Service Extension XFF Header for source ip ({client_ipv4}) matched ({matched_ipv4_cidr}) denied range"
-                )
-            return custom_response(
-                service_pb2.StatusCode.Forbidden,
-                f"Requests for source ip ({client_ipv4}) was denied",
+            DECISIONS.inc("deny")
+            logger.info(
+                "Service Extension XFF Header for source ip (%s) matched (%s) denied range",
+                client_ip,
+                matched_cidr,
+                extra={
+                    "decision": "deny",
+                    "reason": "denied",
+                    "client_ip": client_ip,
+                    "matched_cidr": matched_cidr,
+                },
             )
+            return DENIED_RESPONSE
+
+        if RATE_LIMITER is not None and SERVICE_EXTENSION_RATE_LIMIT_KEY == "client_ip":
+            return handle_rate_limit(client_ip, client_ip)
     return None  # Return if no Validation Issue
 
 
+# Handlers take the header value and the StreamState, and return the response
+# denying the request or None to continue
 scoped_header_actions = {
     "x-goog-iap-jwt-assertion-test": handle_iap_jwt_validation,
     "x-goog-iap-jwt-assertion": handle_iap_jwt_validation,
     "x-forwarded-for-test": handle_xff_validation,
     "x-forwarded-for": handle_xff_validation,
+    ":path": handle_path_signatures,
+}
+
+
+@dataclass(frozen=True)
+class RequestPolicy:
+    """
+    Everything compiled from one RuleConfiguration. It is swapped in as a whole
+    on reload and a stream keeps the policy it started with.
+    header_rules maps every header the WAF inspects to (handler, bit). Scoped
+    headers each own one bit of scoped_bits, debug-only headers have no handler.
+    Headers scanned for signatures have bit 0, so every occurrence is scanned;
+    scoped_bits is then -1 as the headers can't be known to all have been seen.
+    Scoped headers that are also scanned for signatures are scanned before
+    their handler runs, and rescanned_headers scans their later occurrences.
+    """
+
+    header_rules: Dict[str, Tuple[Optional[Callable], int]]
+    scoped_bits: int
+    rescanned_headers: FrozenSet[str]
+    iap_jwt_header: Optional[str]
+    iap_jwt_bit: int
+    configuration: RuleConfiguration
+    cidr_matcher: CidrMatcher
+    blocklist: Optional[Blocklist]
+    client_ip_lookup: Callable[[str], Optional[Tuple[str, str]]]
+    signature_engine: Optional[SignatureEngine]
+    body_deny_patterns: Tuple[bytes, ...] = ()
+    identity_headers: bool = False
+
+
+def compile_request_policy(configuration: RuleConfiguration) -> RequestPolicy:
+    cidr_matcher = sort_cidr_ranges(configuration)
+    blocklist = load_blocklist(configuration)
+    signature_engine = load_signatures(configuration)
+
+    header_rules = {}
+    if logger.isEnabledFor(logging.DEBUG):
+        header_rules.update({header: (None, 0) for header in DEBUG_HEADERS})
+
+    scoped_headers = []
+    iap_jwt_header = None
+    if configuration.require_iap:
+        iap_jwt_header = "x-goog-iap-jwt-assertion"
+        if SERVICE_EXTENSION_TEST:
+            iap_jwt_header = "x-goog-iap-jwt-assertion-test"
+        scoped_headers.append(iap_jwt_header)
+
+    if configuration.xff_enabled or (
+        RATE_LIMITER is not None and SERVICE_EXTENSION_RATE_LIMIT_KEY == "client_ip"
+    ):
+        xff_header = "x-forwarded-for"
+        if SERVICE_EXTENSION_TEST:
+            xff_header = "x-forwarded-for-test"
+        scoped_headers.append(xff_header)
+
+    signature_targets = signature_engine.targets if signature_engine else ()
+    if "path" in signature_targets or "query" in signature_targets:
+        scoped_headers.append(":path")
+
+    for index, header in enumerate(scoped_headers):
+        header_rules[header] = (scoped_header_actions[header], 1 << index)
+
+    scoped_bits = (1 << len(scoped_headers)) - 1
+    rescanned_headers = set()
+    if "headers" in signature_targets:
+        for header in SERVICE_EXTENSION_SIGNATURE_HEADERS:
+            handler, bit = header_rules.get(header, (None, 0))
+            if handler is None:
+                header_rules[header] = (handle_header_signatures, 0)
+            else:
+                header_rules[header] = (scan_header_signatures_before(handler), bit)
+                rescanned_headers.add(header)
+        scoped_bits = -1
+
+    policy = RequestPolicy(
+        header_rules=header_rules,
+        scoped_bits=scoped_bits,
+        rescanned_headers=frozenset(rescanned_headers),
+        iap_jwt_header=iap_jwt_header,
+        iap_jwt_bit=1 if iap_jwt_header else 0,
+        configuration=configuration,
+        cidr_matcher=cidr_matcher,
+        blocklist=blocklist,
+        client_ip_lookup=compile_client_ip_lookup(cidr_matcher, blocklist),
+        signature_engine=signature_engine,
+        identity_headers=SERVICE_EXTENSION_IDENTITY_HEADERS and bool(iap_jwt_header),
+        body_deny_patterns=tuple(
+            pattern.encode("utf-8")
+            for pattern in split_setting(configuration.body_deny_patterns)
+        ),
+    )
+
+    logger.debug("Service Extension IAP Header: %s", iap_jwt_header)
+    logger.debug("Service Extension in Scope Headers: %s", scoped_headers)
+    logger.debug("Service Extension in Debug Headers: %s", DEBUG_HEADERS)
+    return policy
+
+
+class StreamState:
+    "State of one ext_proc stream, i.e. one HTTP request and its response"
+
+    __slots__ = ("policy", "body_inspector", "identity")
+
+    def __init__(self) -> None:
+        self.policy: Optional[RequestPolicy] = None
+        self.body_inspector: Optional[BodyInspector] = None
+        # (user id, email) from the verified IAP JWT
+        self.identity: Optional[Tuple[str, str]] = None
+
+
+# Acknowledgements of the phases the WAF lets through unchanged. Messages are
+# only read when serialized, so the same instance is shared by every stream.
+REQUEST_BODY_ACK = service_pb2.ProcessingResponse(
+    request_body=service_pb2.BodyResponse()
+)
+PHASE_ACKS = {
+    "request_body": REQUEST_BODY_ACK,
+    "response_headers": service_pb2.ProcessingResponse(
+        response_headers=service_pb2.HeadersResponse()
+    ),
+    "response_body": service_pb2.ProcessingResponse(
+        response_body=service_pb2.BodyResponse()
+    ),
+    "request_trailers": service_pb2.ProcessingResponse(
+        request_trailers=service_pb2.TrailersResponse()
+    ),
+    "response_trailers": service_pb2.ProcessingResponse(
+        response_trailers=service_pb2.TrailersResponse()
+    ),
 }
 
 
+def process_request_headers(
+    headers: service_pb2.HttpHeaders, stream: StreamState
+) -> Optional[service_pb2.ProcessingResponse]:
+    "Returns the allow or deny response for the request headers"
+    try:
+        policy = stream.policy = global_request_policy
+        header_rules = policy.header_rules
+        seen_bits = 0
+        if header_rules:
+            for header in headers.headers.headers:
+                rule = header_rules.get(header.key)
+                if rule is None:
+                    continue
+                handler, bit = rule
+                if seen_bits & bit:
+                    if header.key not in policy.rescanned_headers:
+                        continue
+                    # Later occurrences of a scoped header are still scanned
+                    handler = handle_header_signatures
+
+                header_value = header.value or header.raw_value.decode(
+                    "utf-8", "ignore"
+                )
+                logger.debug(
+                    "Service Extension %s Header: (%s), Value: (%s)",
+                    "Scoped" if handler else "Debug",
+                    header.key,
+                    header_value,
+                )
+                if handler is None:
+                    continue
+
+                seen_bits |= bit
+                started = perf_counter()
+                response = handler(header_value, stream)
+                HANDLER_LATENCY.observe(perf_counter() - started, handler.__name__)
+                if response is not None:
+                    return response
+                if seen_bits == policy.scoped_bits:
+                    break
+        # Checks if IAP was required but header was not detected
+        if policy.iap_jwt_bit and not seen_bits & policy.iap_jwt_bit:
+            logger.debug("Service Extension IAP Required Header but Not Found")
+            response = scoped_header_actions[policy.iap_jwt_header]("", stream)
+            if response is not None:
+                return response
+
+        DECISIONS.inc("allow")
+        if policy.identity_headers and stream.identity is not None:
+            user_id, user_email = stream.identity
+            return service_pb2.ProcessingResponse(
+                request_headers=add_headers_mutation(
+                    [
+                        (IDENTITY_USER_HEADER, user_id),
+                        (IDENTITY_EMAIL_HEADER, user_email),
+                    ],
+                    clear_route_cache=SERVICE_EXTENSION_CLEAR_ROUTE_CACHE != "never",
+                    # Copies sent by the client must not reach the backend
+                    overwrite=True,
+                )
+            )
+        return ALLOW_RESPONSE
+    except Exception as e:
+        DECISIONS.inc("error")
+        logger.exception("An error occurred: %s", e)
+    return None
+
+
+def process_request_body(
+    body: service_pb2.HttpBody, stream: StreamState
+) -> service_pb2.ProcessingResponse:
+    """
+    Inspects the next request body chunk, denying the request as soon as the
+    body is known to be bad and acknowledging the chunk otherwise.
+    """
+    policy = stream.policy or global_request_policy
+    inspector = stream.body_inspector
+    if inspector is None:
+        if (
+            not policy.body_deny_patterns
+            and not SERVICE_EXTENSION_MAX_REQUEST_BODY_BYTES
+        ):
+            return REQUEST_BODY_ACK
+        inspector = stream.body_inspector = BodyInspector(
+            policy.body_deny_patterns, SERVICE_EXTENSION_MAX_REQUEST_BODY_BYTES
+        )
+
+    started = perf_counter()
+    verdict = inspector.feed(body.body)
+    HANDLER_LATENCY.observe(perf_counter() - started, "process_request_body")
+    if verdict is None:
+        return REQUEST_BODY_ACK
+
+    reason, detail = verdict
+    DECISIONS.inc(reason)
+    logger.info(
+        "Service Extension request body was denied: %s",
+        detail,
+        extra={"decision": "deny", "reason": reason},
+    )
+    if reason == BODY_TOO_LARGE:
+        return BODY_TOO_LARGE_RESPONSE
+    return BODY_DENIED_RESPONSE
+
+
+def shadow_decision(
+    rules: ShadowRules, headers: service_pb2.HttpHeaders
+) -> Tuple[str, Optional[str]]:
+    """
+    Returns the decision of the shadow rules for the request headers (allow,
+    deny, not_allowed, iap_fail or signature) and what it was based on.
+    """
+    configuration = rules.configuration
+    iap_jwt_header = "x-goog-iap-jwt-assertion"
+    xff_header = "x-forwarded-for"
+    if SERVICE_EXTENSION_TEST:
+        iap_jwt_header = "x-goog-iap-jwt-assertion-test"
+        xff_header = "x-forwarded-for-test"
+
+    header_values: Dict[str, str] = {}
+    for header in headers.headers.headers:
+        header_value = header.value or header.raw_value.decode("utf-8", "ignore")
+        if rules.signature_engine is not None:
+            match = None
+            if header.key == ":path":
+                match = rules.signature_engine.scan_path(header_value)
+            elif header.key in SERVICE_EXTENSION_SIGNATURE_HEADERS:
+                match = rules.signature_engine.scan_header(header_value)
+            if match is not None:
+                return ("signature", match[1].id)
+        header_values.setdefault(header.key, header_value)
+
+    if configuration.require_iap:
+        _, _, error_str = validate_iap_jwt(header_values.get(iap_jwt_header, ""))
+        if error_str:
+            return ("iap_fail", None)
+
+    if configuration.xff_enabled and xff_header in header_values:
+        client_ip = XFF_PARSER.client_ip(header_values[xff_header])
+        if client_ip is not None:
+            match = lookup_client_ip(rules.cidr_matcher, rules.blocklist, client_ip)
+            if match is None:
+                return ("not_allowed", client_ip)
+            if match[0] == DENY:
+                return ("deny", f"{client_ip} in {match[1]}")
+    return ("allow", None)
+
+
+def evaluate_shadow_rules(
+    item: Tuple[ShadowRules, service_pb2.HttpHeaders, str],
+) -> None:
+    "Counts the shadow decision, logging it when it differs from the live one"
+    rules, headers, live_decision = item
+    decision, detail = shadow_decision(rules, headers)
+    SHADOW_DECISIONS.inc(decision, live_decision)
+    if (decision == "allow") != (live_decision == "allow"):
+        logger.info(
+            "Service Extension shadow rules decided %s (%s), live rules %s",
+            decision,
+            detail,
+            live_decision,
+            extra={
+                "shadow": True,
+                "shadow_decision": decision,
+                "shadow_detail": detail,
+                "live_decision": live_decision,
+            },
+        )
+
+
+def submit_shadow_evaluation(
+    headers: service_pb2.HttpHeaders, response: service_pb2.ProcessingResponse
+) -> None:
+    "Queues the request for the shadow rules, never waiting for them"
+    rules = global_shadow_rules
+    if rules is None:
+        return
+    live_decision = "deny" if response.HasField("immediate_response") else "allow"
+    global_shadow_evaluator.submit((rules, headers, live_decision))
+
+
+def process_request(
+    request: service_pb2.ProcessingRequest, stream: Optional[StreamState] = None
+) -> Optional[service_pb2.ProcessingResponse]:
+    """
+    Returns the response for a single ext_proc message, or None if it is not
+    answered. Every phase Envoy sends is answered, so enabling body or trailer
+    processing never stalls a stream. Shared by the threaded and asyncio gRPC
+    servers, which keep one StreamState per stream.
+    """
+    if stream is None:
+        stream = StreamState()
+    phase = request.WhichOneof("request")
+    if phase == "request_headers":
+        response = process_request_headers(request.request_headers, stream)
+        if global_shadow_evaluator is not None and response is not None:
+            submit_shadow_evaluation(request.request_headers, response)
+    elif phase == "request_body":
+        try:
+            response = process_request_body(request.request_body, stream)
+        except Exception as e:
+            DECISIONS.inc("error")
+            logger.exception("An error occurred: %s", e)
+            response = REQUEST_BODY_ACK
+    else:
+        response = PHASE_ACKS.get(phase)
+
+    # In async mode Envoy doesn't wait for (and must not get) a response
+    if request.async_mode:
+        return None
+    return response
+
+
+def shed_request(
+    request: service_pb2.ProcessingRequest,
+) -> Optional[service_pb2.ProcessingResponse]:
+    "Answers a message of a shed stream with the load shedding verdict, uninspected"
+    phase = request.WhichOneof("request")
+    if phase == "request_headers":
+        DECISIONS.inc("load_shed")
+        response = LOAD_SHED_RESPONSE
+    else:
+        response = PHASE_ACKS.get(phase)
+    if request.async_mode:
+        return None
+    return response
+
+
 class CalloutProcessor(service_pb2_grpc.ExternalProcessorServicer):
     def Process(
         self,
@@ -277,120 +1583,117 @@ class CalloutProcessor(service_pb2_grpc.ExternalProcessorServicer):
         context: ServicerContext,
     ) -> Iterator[service_pb2.ProcessingResponse]:
         "Process the client request and add example headers"
-        for request in request_iterator:
-            if request.HasField("request_headers"):
-                try:
-                    scoped_headers = []
-                    debug_headers = [":path", ":method", ":scheme", ":authority"]
-                    IAP_JWT_HEADER = "x-goog-iap-jwt-assertion"
-                    if SERVICE_EXTENSION_REQUIRE_IAP:
-                        if SERVICE_EXTENSION_TEST:
-                            IAP_JWT_HEADER = "x-goog-iap-jwt-assertion-test"
-
-                        if SERVICE_EXTENSION_DEBUG:
-                            print(f"Service Extension IAP Header: {IAP_JWT_HEADER}")
-                        scoped_headers.append(IAP_JWT_HEADER)
-
-                    XFF_HEADER = "x-forwarded-for"
-                    if (
-                        SERVICE_EXTENSION_ALLOWED_IPV4_CIDR_ENABLED
-                        or SERVICE_EXTENSION_DENIED_IPV4_CIDR_ENABLED
-                    ):
-                        if SERVICE_EXTENSION_TEST:
-                            XFF_HEADER = "x-forwarded-for-test"
-
-                        if SERVICE_EXTENSION_DEBUG:
-                            print(f"Service Extension XFF Header: {XFF_HEADER}")
-                        scoped_headers.append(XFF_HEADER)
-
-                    request_headers = request.request_headers.headers
-
-                    if SERVICE_EXTENSION_DEBUG:
-                        print(f"Service Extension in Scope Headers: {scoped_headers}")
-                        print(f"Service Extension in Debug Headers: {debug_headers}")
-
-                    for header in request_headers.headers:
-                        if header.key in scoped_headers or (
-                            SERVICE_EXTENSION_DEBUG and header.key in debug_headers
-                        ):
-                            header_value = header.value or header.raw_value.decode(
-                                "utf-8", "ignore"
-                            )
-
-                            if SERVICE_EXTENSION_DEBUG:
-                                header_type = (
-                                    "Scoped"
-                                    if header.key in scoped_headers
-                                    else "Debug"
-                                )
-                                print(
-                                    f"Service Extension {header_type} Header: ({header.key}), Value: ({header_value})"
-                                )
-
-                            if header.key in scoped_headers:
-                                response_generator = scoped_header_actions[header.key](
-                                    header_value
-                                )
-                                scoped_headers.remove(header.key)
-                                if response_generator:
-                                    yield from response_generator
-                                    return
-                        if not scoped_headers:
-                            break
-                    # Checks if IAP was required but header was not detected
-                    if SERVICE_EXTENSION_REQUIRE_IAP and (
-                        IAP_JWT_HEADER in scoped_headers
-                    ):
-                        if SERVICE_EXTENSION_DEBUG:
-                            print(
-                                f"Service Extension IAP Required Header but Not Found"
-                            )
-                        response_generator = scoped_header_actions[IAP_JWT_HEADER]("")
-                        if response_generator:
-                            yield from response_generator
-                            return
-
-                    request_header_mutation = service_pb2.HeadersResponse()
-                    request_header_mutation.response.clear_route_cache = True
-                    yield service_pb2.ProcessingResponse(
-                        request_headers=request_header_mutation
-                    )
-                except Exception as e:
-                    print(f"An error occurred: {e}")
+        ACTIVE_STREAMS.inc()
+        admitted = STREAM_LIMITER.acquire()
+        try:
+            stream = StreamState()
+            for request in request_iterator:
+                if not admitted:
+                    response = shed_request(request)
+                else:
+                    started = perf_counter()
+                    response = process_request(request, stream)
+                    HANDLER_LATENCY.observe(perf_counter() - started, "process_request")
+                if response is not None:
+                    yield response
+                    if response.HasField("immediate_response"):
+                        return
+        finally:
+            if admitted:
+                STREAM_LIMITER.release()
+            ACTIVE_STREAMS.dec()
+
+
+class AsyncCalloutProcessor(service_pb2_grpc.ExternalProcessorServicer):
+    async def Process(
+        self,
+        request_iterator: AsyncIterator[service_pb2.ProcessingRequest],
+        context: grpc.aio.ServicerContext,
+    ) -> AsyncIterator[service_pb2.ProcessingResponse]:
+        "Process the client request on the event loop used by grpc.aio"
+        ACTIVE_STREAMS.inc()
+        admitted = STREAM_LIMITER.acquire()
+        try:
+            stream = StreamState()
+            async for request in request_iterator:
+                if not admitted:
+                    response = shed_request(request)
+                else:
+                    started = perf_counter()
+                    response = process_request(request, stream)
+                    HANDLER_LATENCY.observe(perf_counter() - started, "process_request")
+                if response is not None:
+                    yield response
+                    if response.HasField("immediate_response"):
+                        return
+        finally:
+            if admitted:
+                STREAM_LIMITER.release()
+            ACTIVE_STREAMS.dec()
+
+
+def readiness_problems() -> List[str]:
+    "Returns why ext_proc requests can't be served yet, empty when ready"
+    problems = []
+    if global_request_policy is None:
+        problems.append("Rules not loaded")
+    elif global_request_policy.iap_jwt_header and not len(IAP_KEY_SET):
+        problems.append("No IAP keys loaded")
+    if (
+        global_worker_supervisor is not None
+        and not global_worker_supervisor.alive_workers()
+    ):
+        problems.append("No ext_proc workers running")
+    return problems
 
 
 class HealthCheckServer(BaseHTTPRequestHandler):
+    """
+    Health check and admin endpoints, served by a ThreadingHTTPServer so a slow
+    client never holds up the others:
+    * /livez answers as long as the process does
+    * /readyz, and any other path, only once the rules and IAP keys are loaded
+      and, with several workers, one of them is running
+    """
+
+    # Seconds a client may take to send its request
+    timeout = 5
+
+    def send_text(self, status: int, body: bytes, content_type="text/html") -> None:
+        self.send_response(status)
+        self.send_header("Content-type", content_type)
+        self.end_headers()
+        self.wfile.write(body)
+
     def do_GET(self) -> None:
         # Check if the request is for the specific file
         if self.path == "/iap_public_key.crt":
-            try:
-                self.send_response(200)
-                self.send_header("Content-type", "application/x-x509-ca-cert")
-                self.end_headers()
-                self.wfile.write(IAP_CERTIFICATE)
-            except FileNotFoundError:
-                # Handle the case where the file is not found
-                self.send_response(404)
-                self.end_headers()
-                self.wfile.write(b"File not found")
+            self.send_text(200, IAP_CERTIFICATE, "application/x-x509-ca-cert")
+        elif self.path == "/metrics":
+            worker_snapshots = []
+            if global_worker_supervisor is not None:
+                worker_snapshots = global_worker_supervisor.collect_metrics()
+            self.send_text(
+                200,
+                REGISTRY.render(worker_snapshots).encode("utf-8"),
+                "text/plain; version=0.0.4; charset=utf-8",
+            )
+        elif self.path == "/livez":
+            self.send_text(200, b"OK")
         else:
-            # Default response for other paths
-            self.send_response(200)
-            self.send_header("Content-type", "text/html")
-            self.end_headers()
-            self.wfile.write(b"OK")
+            problems = readiness_problems()
+            if problems:
+                self.send_text(503, ", ".join(problems).encode("utf-8"))
+            else:
+                self.send_text(200, b"OK")
 
     def log_message(self, format, *args):
         # Override to suppress request logging
         pass  # Do nothing here
 
 
-def serve() -> None:
-    sort_ipv4_cidr_ranges()
-    "Run gRPC server and Health check server"
-    health_server = HTTPServer(("0.0.0.0", HEALTH_CHECK_PORT), HealthCheckServer)
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=2))
-    service_pb2_grpc.add_ExternalProcessorServicer_to_server(CalloutProcessor(), server)
+def add_ext_proc_ports(server: Union[grpc.Server, grpc.aio.Server]) -> None:
+    "Listen on the secure and insecure ext_proc ports"
     server_credentials = grpc.ssl_server_credentials(
         private_key_certificate_chain_pairs=[
             (SERVER_CERTIFICATE_KEY, SERVER_CERTIFICATE)
@@ -398,17 +1701,248 @@ def serve() -> None:
     )
     server.add_secure_port("0.0.0.0:%d" % EXT_PROC_SECURE_PORT, server_credentials)
     server.add_insecure_port("0.0.0.0:%d" % EXT_PROC_INSECURE_PORT)
-    server.start()
-    print(
-        "Server started, listening on %d and %d"
-        % (EXT_PROC_SECURE_PORT, EXT_PROC_INSECURE_PORT)
+
+
+class AsyncServerThread(threading.Thread):
+    """
+    Runs the grpc.aio server on its own event loop, so every ext_proc stream is
+    multiplexed on a single thread instead of occupying a thread pool worker.
+    """
+
+    def __init__(self) -> None:
+        super().__init__(daemon=True)
+        self.loop = asyncio.new_event_loop()
+        self.server = None
+        self.started = threading.Event()
+        self.error = None
+
+    def run(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._start_server())
+        except Exception as e:
+            self.error = e
+            return
+        finally:
+            self.started.set()
+        self.loop.run_forever()
+
+    async def _start_server(self) -> None:
+        self.server = grpc.aio.server(
+            options=GRPC_SERVER_OPTIONS,
+            maximum_concurrent_rpcs=SERVICE_EXTENSION_GRPC_MAX_CONCURRENT_RPCS,
+            compression=GRPC_COMPRESSION[SERVICE_EXTENSION_GRPC_COMPRESSION],
+        )
+        service_pb2_grpc.add_ExternalProcessorServicer_to_server(
+            AsyncCalloutProcessor(), self.server
+        )
+        add_ext_proc_ports(self.server)
+        await self.server.start()
+
+    def stop(self, grace: Optional[float]) -> None:
+        if self.server is not None:
+            asyncio.run_coroutine_threadsafe(
+                self.server.stop(grace), self.loop
+            ).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def start_rate_limit_sync() -> None:
+    "Starts sharing rate limit tokens when a shared backend is configured"
+    global global_rate_limit_sync
+    if RATE_LIMITER is None or not RATE_LIMITER.shared:
+        return
+    global_rate_limit_sync = RateLimitSync(
+        RATE_LIMITER,
+        create_backend(
+            SERVICE_EXTENSION_RATE_LIMIT_BACKEND,
+            ttl=max(60, 2 * RATE_LIMITER.burst / RATE_LIMITER.rate),
+        ),
+        interval=SERVICE_EXTENSION_RATE_LIMIT_SYNC_INTERVAL,
+    )
+    global_rate_limit_sync.start()
+
+
+def start_shadow_evaluation() -> None:
+    "Starts the shadow evaluation workers when shadow rules are configured"
+    global global_shadow_evaluator
+    if not SERVICE_EXTENSION_SHADOW_CONFIG_FILE:
+        return
+    global_shadow_evaluator = ShadowEvaluator(
+        evaluate_shadow_rules,
+        workers=SERVICE_EXTENSION_SHADOW_WORKERS,
+        queue_size=SERVICE_EXTENSION_SHADOW_QUEUE_SIZE,
+    )
+    global_shadow_evaluator.start()
+
+
+def start_ext_proc_server() -> Union[grpc.Server, AsyncServerThread]:
+    "Start the gRPC server in the configured server mode"
+    global global_thread_pool
+    start_rate_limit_sync()
+    start_shadow_evaluation()
+    if SERVICE_EXTENSION_SERVER_MODE == "async":
+        server = AsyncServerThread()
+        server.start()
+        server.started.wait()
+        if server.error:
+            raise server.error
+    else:
+        global_thread_pool = futures.ThreadPoolExecutor(
+            max_workers=SERVICE_EXTENSION_GRPC_MAX_WORKERS
+        )
+        server = grpc.server(
+            global_thread_pool,
+            options=GRPC_SERVER_OPTIONS,
+            maximum_concurrent_rpcs=SERVICE_EXTENSION_GRPC_MAX_CONCURRENT_RPCS,
+            compression=GRPC_COMPRESSION[SERVICE_EXTENSION_GRPC_COMPRESSION],
+        )
+        service_pb2_grpc.add_ExternalProcessorServicer_to_server(
+            CalloutProcessor(), server
+        )
+        add_ext_proc_ports(server)
+        server.start()
+    return server
+
+
+def serve_metrics_snapshots(connection: Connection) -> None:
+    "Answers the supervisor's metrics requests from a worker process"
+    try:
+        while True:
+            connection.recv()
+            connection.send(REGISTRY.snapshot())
+    except (EOFError, OSError):
+        pass
+
+
+def run_worker(metrics_connection: Optional[Connection] = None) -> None:
+    "Entry point of an ext_proc worker process started by WorkerSupervisor"
+    apply_rule_configuration(load_rule_configuration())
+    start_rule_configuration_reloading()
+    start_iap_key_refresh()
+    if metrics_connection is not None:
+        threading.Thread(
+            target=serve_metrics_snapshots, args=(metrics_connection,), daemon=True
+        ).start()
+    server = start_ext_proc_server()
+    try:
+        if isinstance(server, AsyncServerThread):
+            server.join()
+        else:
+            server.wait_for_termination()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop(None)
+
+
+class WorkerSupervisor:
+    """
+    Runs ext_proc worker processes that share EXT_PROC_SECURE_PORT and
+    EXT_PROC_INSECURE_PORT through SO_REUSEPORT, so the kernel spreads streams
+    across cores, and restarts any worker that exits.
+    """
+
+    def __init__(self, worker_count: int) -> None:
+        self.worker_count = worker_count
+        self.restarts = 0
+        self.workers: List[multiprocessing.Process] = []
+        self.metrics_connections: List[Connection] = []
+        self._context = multiprocessing.get_context("spawn")
+        self._stopping = threading.Event()
+        self._metrics_lock = threading.Lock()
+
+    def _spawn_worker(self) -> Tuple[multiprocessing.Process, Connection]:
+        metrics_connection, worker_connection = self._context.Pipe()
+        worker = self._context.Process(
+            target=run_worker, args=(worker_connection,), daemon=True
+        )
+        worker.start()
+        worker_connection.close()
+        return worker, metrics_connection
+
+    def start(self) -> None:
+        for _ in range(self.worker_count):
+            worker, metrics_connection = self._spawn_worker()
+            self.workers.append(worker)
+            self.metrics_connections.append(metrics_connection)
+        threading.Thread(target=self._monitor_workers, daemon=True).start()
+
+    def _monitor_workers(self) -> None:
+        while not self._stopping.wait(WORKER_MONITOR_INTERVAL):
+            for index, worker in enumerate(self.workers):
+                if not worker.is_alive() and not self._stopping.is_set():
+                    logger.warning(
+                        "Service Extension worker %s exited with code %s, restarting",
+                        worker.pid,
+                        worker.exitcode,
+                    )
+                    worker, metrics_connection = self._spawn_worker()
+                    with self._metrics_lock:
+                        self.metrics_connections[index].close()
+                        self.metrics_connections[index] = metrics_connection
+                    self.workers[index] = worker
+                    self.restarts += 1
+
+    def collect_metrics(self) -> List[Snapshot]:
+        "Returns a metrics snapshot from every worker that answers in time"
+        snapshots = []
+        with self._metrics_lock:
+            for connection in self.metrics_connections:
+                try:
+                    # Discard answers that arrived after a previous timeout
+                    while connection.poll():
+                        connection.recv()
+                    connection.send(None)
+                    if connection.poll(WORKER_METRICS_TIMEOUT):
+                        snapshots.append(connection.recv())
+                except (EOFError, OSError):
+                    continue
+        return snapshots
+
+    def signal_workers(self, signum: int) -> None:
+        for worker in self.workers:
+            if worker.pid is not None and worker.is_alive():
+                kill(worker.pid, signum)
+
+    def alive_workers(self) -> int:
+        return sum(1 for worker in self.workers if worker.is_alive())
+
+    def stop(self, grace: Optional[float]) -> None:
+        self._stopping.set()
+        for worker in self.workers:
+            worker.terminate()
+        for worker in self.workers:
+            worker.join(grace)
+
+
+def serve() -> None:
+    global global_worker_supervisor
+    apply_rule_configuration(load_rule_configuration())
+    start_rule_configuration_reloading()
+    start_iap_key_refresh()
+    "Run gRPC server and Health check server"
+    health_server = ThreadingHTTPServer(
+        ("0.0.0.0", HEALTH_CHECK_PORT), HealthCheckServer
+    )
+    if SERVICE_EXTENSION_WORKERS > 1:
+        server = global_worker_supervisor = WorkerSupervisor(SERVICE_EXTENSION_WORKERS)
+        server.start()
+    else:
+        server = start_ext_proc_server()
+    logger.info(
+        "Server started (%s mode, %d worker(s)), listening on %d and %d",
+        SERVICE_EXTENSION_SERVER_MODE,
+        SERVICE_EXTENSION_WORKERS,
+        EXT_PROC_SECURE_PORT,
+        EXT_PROC_INSECURE_PORT,
     )
     try:
         health_server.serve_forever()
     except KeyboardInterrupt:
-        print("Server interrupted")
+        logger.info("Server interrupted")
     finally:
-        server.stop()
+        server.stop(None)
         health_server.server_close()
 
 
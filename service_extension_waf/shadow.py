@@ -0,0 +1,84 @@
+# Copyright 2023 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+# Service Extension WAF Shadow Evaluation
+----
+Runs work off the request path on a small pool of background threads, used to
+evaluate candidate rules against live traffic without enforcing them.
+
+Request threads only put the work on a bounded queue. When the queue is full
+the work is dropped and counted instead of blocking, so a slow or expensive
+rule set can lose shadow samples but never adds latency to requests.
+"""
+import logging
+import queue
+import threading
+
+from typing import Any, Callable, List
+
+logger = logging.getLogger("service_extension_waf")
+
+
+class ShadowEvaluator:
+    """Calls evaluate(item) for every submitted item on background threads."""
+
+    def __init__(
+        self, evaluate: Callable[[Any], None], workers: int = 2, queue_size: int = 10000
+    ) -> None:
+        self.evaluate = evaluate
+        self.dropped = 0
+        self.errors = 0
+        self._queue: "queue.Queue[Any]" = queue.Queue(maxsize=queue_size)
+        self._threads: List[threading.Thread] = [
+            threading.Thread(target=self._run, name=f"shadow-{index}", daemon=True)
+            for index in range(max(1, workers))
+        ]
+
+    def start(self) -> None:
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, item: Any) -> bool:
+        "Queues the item, False if it was dropped because the queue is full"
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def drain(self) -> None:
+        "Waits until every submitted item has been evaluated"
+        self._queue.join()
+
+    def stop(self) -> None:
+        "Stops the workers once the items queued so far are evaluated"
+        for _ in self._threads:
+            self._queue.put(None)
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self.evaluate(item)
+            except Exception as e:
+                self.errors += 1
+                logger.exception("Service Extension shadow evaluation failed: %s", e)
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,183 @@
+# Copyright 2023 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+# Service Extension WAF Shared State
+----
+Counters shared by every WAF instance and worker process, used to make rate
+limits approximately global.
+
+Backends implement `exchange(deltas)`: add each delta to the shared counter
+of its key in one batch and return the new totals. Counters expire after
+`ttl` seconds without updates, so the shared store stays bounded.
+* LocalBackend keeps the counters in memory, the reference implementation
+  (only shared between threads of one process).
+* RedisBackend speaks the Redis protocol (RESP) over a plain socket and sends
+  each batch as a single pipeline of INCRBY and EXPIRE commands.
+"""
+import socket
+import threading
+import time
+
+from typing import Dict, List, Optional, Union
+from urllib.parse import unquote, urlsplit
+
+Reply = Union[None, int, bytes, List["Reply"]]
+
+
+class SharedStateError(Exception):
+    "Raised when the shared state backend can't be reached or returns an error"
+
+
+class LocalBackend:
+    """In-memory counters, shared by the threads of a single process."""
+
+    def __init__(self, ttl: float = 60) -> None:
+        self.ttl = ttl
+        # key -> [total, expiry time]
+        self._counters: Dict[str, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def exchange(self, deltas: Dict[str, int]) -> Dict[str, int]:
+        now = time.monotonic()
+        totals = {}
+        with self._lock:
+            for key, delta in deltas.items():
+                counter = self._counters.get(key)
+                if counter is None or counter[1] <= now:
+                    counter = self._counters[key] = [0, 0.0]
+                counter[0] += delta
+                counter[1] = now + self.ttl
+                totals[key] = int(counter[0])
+            if len(self._counters) > 2 * len(deltas) + 1024:
+                self._counters = {
+                    key: counter
+                    for key, counter in self._counters.items()
+                    if counter[1] > now
+                }
+        return totals
+
+    def close(self) -> None:
+        pass
+
+
+class RedisBackend:
+    """Counters in Redis (or anything speaking its protocol), e.g.
+    redis://:password@10.0.0.3:6379/0
+    """
+
+    def __init__(
+        self,
+        url: str,
+        key_prefix: str = "se_waf:rate_limit:",
+        ttl: float = 60,
+        timeout: float = 1.0,
+    ) -> None:
+        parts = urlsplit(url)
+        if parts.scheme != "redis":
+            raise ValueError(f"Unsupported shared state URL {url}")
+        self.host = parts.hostname or "localhost"
+        self.port = parts.port or 6379
+        self.password = unquote(parts.password) if parts.password else None
+        self.db = int(parts.path.strip("/") or 0)
+        self.key_prefix = key_prefix
+        self.ttl = max(1, int(ttl))
+        self.timeout = timeout
+        self._socket: Optional[socket.socket] = None
+        self._reader = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _encode(*args: Union[str, int]) -> bytes:
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            value = str(arg).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(value), value))
+        return b"".join(parts)
+
+    def _read_reply(self) -> Reply:
+        line = self._reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise SharedStateError("Connection closed by the shared state backend")
+        kind, value = line[:1], line[1:-2]
+        if kind == b"+":
+            return value
+        if kind == b"-":
+            raise SharedStateError(value.decode("utf-8", "replace"))
+        if kind == b":":
+            return int(value)
+        if kind == b"$":
+            length = int(value)
+            if length < 0:
+                return None
+            data = self._reader.read(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            length = int(value)
+            if length < 0:
+                return None
+            return [self._read_reply() for _ in range(length)]
+        raise SharedStateError(f"Unexpected reply {line!r}")
+
+    def _execute(self, commands: List[bytes]) -> List[Reply]:
+        "Sends every command at once and reads the replies, one per command"
+        if self._socket is None:
+            self._socket = socket.create_connection(
+                (self.host, self.port), timeout=self.timeout
+            )
+            self._reader = self._socket.makefile("rb")
+            setup = []
+            if self.password:
+                setup.append(self._encode("AUTH", self.password))
+            if self.db:
+                setup.append(self._encode("SELECT", self.db))
+            commands = setup + commands
+            self._socket.sendall(b"".join(commands))
+            return [self._read_reply() for _ in commands][len(setup) :]
+        self._socket.sendall(b"".join(commands))
+        return [self._read_reply() for _ in commands]
+
+    def exchange(self, deltas: Dict[str, int]) -> Dict[str, int]:
+        keys = list(deltas)
+        commands = []
+        for key in keys:
+            commands.append(self._encode("INCRBY", self.key_prefix + key, deltas[key]))
+            commands.append(self._encode("EXPIRE", self.key_prefix + key, self.ttl))
+        with self._lock:
+            try:
+                replies = self._execute(commands)
+            except (OSError, ValueError, SharedStateError) as e:
+                self._close()
+                raise SharedStateError(str(e)) from e
+        return {key: int(replies[2 * index]) for index, key in enumerate(keys)}
+
+    def _close(self) -> None:
+        if self._socket is not None:
+            try:
+                self._reader.close()
+                self._socket.close()
+            except OSError:
+                pass
+        self._socket = None
+        self._reader = None
+
+    def close(self) -> None:
+        with self._lock:
+            self._close()
+
+
+def create_backend(url: str, ttl: float = 60) -> Union[LocalBackend, RedisBackend]:
+    "Returns the backend for `local` or a redis:// URL"
+    if url == "local":
+        return LocalBackend(ttl=ttl)
+    return RedisBackend(url, ttl=ttl)
@@ -0,0 +1,346 @@
+# Copyright 2023 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+# Service Extension WAF Signatures
+----
+Scans the request path, query string and selected headers for attack
+signatures (SQL injection, XSS, path traversal, ...).
+
+Signatures are read from a JSON file, e.g.
+    [
+      {"id": "sqli-union", "pattern": "union select", "targets": ["query"]},
+      {"id": "traversal", "pattern": "../"},
+      {"id": "xss-handler", "regex": "on(error|load)\\\\s*=", "literal": "on"}
+    ]
+`pattern` is a case-insensitive string, `regex` a Python regular expression
+(without numbered backreferences). `targets` defaults to every target: `path`,
+`query` and `headers`. Values are percent-decoded and lowercased before they
+are scanned.
+
+Signatures are compiled once per target:
+* every string, and the `literal` of every regex, goes into one Aho-Corasick
+  automaton, which finds all of them in a single pass over the value, so the
+  cost grows with the length of the value rather than the number of strings
+* a regex only runs when the automaton found its `literal` (a string every
+  match contains) in the value. Unless given, the longest run of plain
+  characters outside groups is used, e.g. `select` for `select\\s.+from`
+* the remaining regexes, without a literal of at least 3 characters, are
+  combined into one alternation, run once per value
+"""
+
+import json
+import re
+
+from collections import deque
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+from urllib.parse import unquote, unquote_plus
+
+TARGETS = ("path", "query", "headers")
+# Shorter literals found in regexes would let them run on most values
+MIN_REQUIRED_LITERAL_LENGTH = 3
+# {m}, {m,} or {m,n} after a character, anything else is a literal brace
+QUANTIFIER = re.compile(r"\{\d*(?:,\d*)?\}")
+# Characters following \x, \u and \U that make up the escaped code point
+CODE_POINT_DIGITS = {"x": 2, "u": 4, "U": 8}
+
+
+@dataclass(frozen=True)
+class Signature:
+    id: str
+    # Lowercased string, or the source of a regex
+    pattern: str
+    is_regex: bool = False
+    # Lowercased string contained in every match of the regex, if known
+    literal: Optional[str] = None
+    targets: Tuple[str, ...] = TARGETS
+
+
+def required_literal(regex: str) -> str:
+    """Returns the longest lowercased string every match of the regex contains.
+
+    Only plain ASCII characters outside of groups and character classes count,
+    so the result is empty for regexes with a top-level alternation. Escapes
+    other than escaped punctuation, and quantifier bounds, end a run.
+    """
+    if re.compile(regex).flags & re.VERBOSE:
+        return ""
+    runs: List[str] = []
+    run: List[str] = []
+    depth = 0
+    index = 0
+    while index < len(regex):
+        char = regex[index]
+        index += 1
+        literal = False
+        if char == "\\" and index < len(regex):
+            char = regex[index]
+            index += 1
+            literal = depth == 0 and char.isascii() and not char.isalnum()
+            # Skip what follows \x3c, \N{...}, octal escapes and group references
+            if char in CODE_POINT_DIGITS:
+                index += CODE_POINT_DIGITS[char]
+            elif char == "N":
+                index = regex.find("}", index) + 1 or len(regex)
+            elif char.isdigit():
+                while index < len(regex) and regex[index].isdigit():
+                    index += 1
+        elif char == "{":
+            quantifier = QUANTIFIER.match(regex, index - 1)
+            if quantifier:
+                index = quantifier.end()
+        elif char == "[":
+            # A ] right after [ or [^ is part of the class
+            if regex[index : index + 1] == "^":
+                index += 1
+            if regex[index : index + 1] == "]":
+                index += 1
+            while index < len(regex) and regex[index] != "]":
+                index += 2 if regex[index] == "\\" else 1
+            index += 1
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "|" and depth == 0:
+            return ""
+        elif depth == 0 and char.isascii() and char not in ".^$*+?{}":
+            literal = True
+
+        if literal:
+            run.append(char.lower())
+            continue
+        if char in "?*{" and run:
+            # The quantifier makes the previous character optional
+            run.pop()
+        runs.append("".join(run))
+        run = []
+    runs.append("".join(run))
+    return max(runs, key=len)
+
+
+def parse_signature(entry: dict) -> Signature:
+    "Returns the signature of one signature file entry, raises ValueError if invalid"
+    signature_id = str(entry.get("id", ""))
+    if not signature_id:
+        raise ValueError(f"Signature without an id: {entry}")
+    unknown = set(entry) - {"id", "pattern", "regex", "literal", "targets"}
+    if unknown:
+        raise ValueError(
+            f"Unknown fields {sorted(unknown)} in signature {signature_id}"
+        )
+
+    targets = tuple(entry.get("targets") or TARGETS)
+    for target in targets:
+        if target not in TARGETS:
+            raise ValueError(f"Unknown target {target} in signature {signature_id}")
+
+    if ("pattern" in entry) == ("regex" in entry):
+        raise ValueError(f"Signature {signature_id} needs either pattern or regex")
+    if "pattern" in entry:
+        if not entry["pattern"]:
+            raise ValueError(f"Signature {signature_id} has an empty pattern")
+        return Signature(signature_id, entry["pattern"].lower(), targets=targets)
+
+    try:
+        literal = entry.get("literal") or required_literal(entry["regex"])
+    except re.error as e:
+        raise ValueError(f"Invalid regex in signature {signature_id}: {e}") from e
+    if "literal" not in entry and len(literal) < MIN_REQUIRED_LITERAL_LENGTH:
+        literal = ""
+    return Signature(
+        signature_id,
+        entry["regex"],
+        is_regex=True,
+        literal=literal.lower() or None,
+        targets=targets,
+    )
+
+
+def load_signature_file(path: str) -> List[Signature]:
+    with open(path, "r") as f:
+        entries = json.load(f)
+    if not isinstance(entries, list):
+        raise ValueError(f"{path} should contain a list of signatures")
+    return [parse_signature(entry) for entry in entries]
+
+
+class AhoCorasick:
+    """Finds every occurrence of a set of strings in one pass over a text."""
+
+    def __init__(self, patterns: Sequence[str]) -> None:
+        # Per state: transitions, failure link and the patterns ending there
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        outputs: List[List[int]] = [[]]
+        for index, pattern in enumerate(patterns):
+            state = 0
+            for char in pattern:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = self._goto[state][char] = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    outputs.append([])
+                state = next_state
+            outputs[state].append(index)
+
+        # Breadth first, so failure links always point at finished states
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(char, 0)
+                self._fail[next_state] = fail
+                outputs[next_state].extend(outputs[fail])
+        self._outputs: List[Tuple[int, ...]] = [tuple(output) for output in outputs]
+
+    def __len__(self) -> int:
+        return len(self._goto)
+
+    def iter_matches(self, text: str) -> Iterator[int]:
+        "Yields the index of every pattern occurrence, by end position"
+        goto, fail, outputs = self._goto, self._fail, self._outputs
+        state = 0
+        for char in text:
+            next_state = goto[state].get(char)
+            while next_state is None and state:
+                state = fail[state]
+                next_state = goto[state].get(char)
+            state = next_state or 0
+            if outputs[state]:
+                yield from outputs[state]
+
+
+class SignatureSet:
+    """The signatures of one target, compiled for a single pass scan."""
+
+    def __init__(self, signatures: Sequence[Signature]) -> None:
+        self.signatures = tuple(signatures)
+        literal_indexes: Dict[str, int] = {}
+        literals: List[str] = []
+        # Per automaton literal: the string signature and the regexes it gates
+        self._literal_signatures: List[Optional[Signature]] = []
+        self._gated_regexes: List[List[Tuple[Signature, re.Pattern]]] = []
+        self._regex_set_signatures: List[Signature] = []
+
+        for signature in self.signatures:
+            if signature.is_regex and not signature.literal:
+                self._regex_set_signatures.append(signature)
+                continue
+            literal = signature.literal if signature.is_regex else signature.pattern
+            index = literal_indexes.get(literal)
+            if index is None:
+                index = literal_indexes[literal] = len(literals)
+                literals.append(literal)
+                self._literal_signatures.append(None)
+                self._gated_regexes.append([])
+            if signature.is_regex:
+                self._gated_regexes[index].append(
+                    (signature, re.compile(signature.pattern, re.IGNORECASE))
+                )
+            elif self._literal_signatures[index] is None:
+                self._literal_signatures[index] = signature
+
+        self._automaton = AhoCorasick(literals) if literals else None
+        self._regex_set = None
+        if self._regex_set_signatures:
+            # Group names identify the matching regex
+            try:
+                self._regex_set = re.compile(
+                    "|".join(
+                        f"(?P<s{index}>{signature.pattern})"
+                        for index, signature in enumerate(self._regex_set_signatures)
+                    ),
+                    re.IGNORECASE,
+                )
+            except re.error as e:
+                raise ValueError(f"Regex signatures can't be combined: {e}") from e
+
+    def __len__(self) -> int:
+        return len(self.signatures)
+
+    def scan(self, text: str) -> Optional[Signature]:
+        "Returns a signature matching the normalized text, None if none does"
+        if self._automaton is not None:
+            candidates = set()
+            for index in self._automaton.iter_matches(text):
+                signature = self._literal_signatures[index]
+                if signature is not None:
+                    return signature
+                candidates.add(index)
+            for index in sorted(candidates):
+                for signature, regex in self._gated_regexes[index]:
+                    if regex.search(text):
+                        return signature
+
+        if self._regex_set is not None:
+            match = self._regex_set.search(text)
+            if match is not None:
+                return self._regex_set_signatures[int(match.lastgroup[1:])]
+        return None
+
+
+class SignatureEngine:
+    """Signature sets of every target."""
+
+    def __init__(self, signatures: Sequence[Signature]) -> None:
+        self._sets = {}
+        for target in TARGETS:
+            target_signatures = [
+                signature for signature in signatures if target in signature.targets
+            ]
+            if target_signatures:
+                self._sets[target] = SignatureSet(target_signatures)
+
+    def __len__(self) -> int:
+        return len(
+            {
+                signature
+                for signature_set in self._sets.values()
+                for signature in signature_set.signatures
+            }
+        )
+
+    @property
+    def targets(self) -> Tuple[str, ...]:
+        return tuple(self._sets)
+
+    def scan_path(self, path: str) -> Optional[Tuple[str, Signature]]:
+        "Scans the :path pseudo header, returns the (target, signature) matched"
+        path, _, query = path.partition("?")
+        signature_set = self._sets.get("path")
+        if signature_set is not None:
+            signature = signature_set.scan(unquote(path).lower())
+            if signature is not None:
+                return ("path", signature)
+        signature_set = self._sets.get("query")
+        if signature_set is not None and query:
+            signature = signature_set.scan(unquote_plus(query).lower())
+            if signature is not None:
+                return ("query", signature)
+        return None
+
+    def scan_header(self, value: str) -> Optional[Tuple[str, Signature]]:
+        "Scans the value of an inspected header"
+        signature_set = self._sets.get("headers")
+        if signature_set is not None:
+            signature = signature_set.scan(unquote(value).lower())
+            if signature is not None:
+                return ("headers", signature)
+        return None
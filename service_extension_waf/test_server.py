@@ -1,6 +1,15 @@
 from __future__ import print_function
 
+import io
+import json
+import logging
+import os
+import socket
+import socketserver
+import subprocess
+import sys
 import threading
+import time
 import urllib.request
 import grpc
 import pytest
@@ -8,7 +17,28 @@ import pytest
 import server
 import service_pb2
 import service_pb2_grpc
+import waf_logging
+import waf_metrics
+
+from blocklist import Blocklist, compile_blocklist
+from body_inspection import BodyInspector
+from cidr_matcher import CidrMatcher
+from iap_jwt import IAP_ISSUER, IapKeyRefresher, IapKeySet, VerifiedTokenCache
+from load_shedding import StreamLimiter
+from rate_limiter import RateLimitSync, TokenBucketRateLimiter
+from shared_state import LocalBackend, RedisBackend
+from signatures import (
+    AhoCorasick,
+    SignatureEngine,
+    parse_signature,
+    required_literal,
+)
+from xff_parser import XffParser
 
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from google.auth import jwt
+from google.auth.crypt import es256
 from os import environ
 from typing import Iterator, List, Tuple
 
@@ -40,7 +70,7 @@ def get_request(
 
 
 def get_requests_stream(
-    custom_headers: List[Tuple[str, str]]
+    custom_headers: List[Tuple[str, str]],
 ) -> Iterator[service_pb2.ProcessingRequest]:
     """Generator for requests stream"""
     request = get_request(
@@ -73,10 +103,12 @@ def test_with_custom_headers(headers: List[Tuple[str, str]]) -> None:
     """Test function that creates a channel and sends a request with custom headers."""
     channel = grpc.insecure_channel(f"0.0.0.0:{server.EXT_PROC_INSECURE_PORT}")
     result = environ.get("se_result").lower()
-    test_case  = environ.get("se_test_case")
+    test_case = environ.get("se_test_case")
     try:
         stub = service_pb2_grpc.ExternalProcessorStub(channel)
-        for response in stub.Process(get_requests_stream(headers)):
+        responses = list(stub.Process(get_requests_stream(headers)))
+        assert responses, "no response was returned"
+        for response in responses:
             str_message = str(response)
             print(str_message)
             print(result)
@@ -91,22 +123,25 @@ def test_with_custom_headers(headers: List[Tuple[str, str]]) -> None:
         channel.close()
 
 
-import json
-
-
 @pytest.mark.usefixtures("setup_and_teardown")
 def test_server() -> None:
     headers_str = environ.get("se_headers", "[]")
     headers_json = json.loads(headers_str)
-    headers_tuple: List[Tuple[str, str]] = [(key, value) for d in headers_json for key, value in d.items()]
+    headers_tuple: List[Tuple[str, str]] = [
+        (key, value) for d in headers_json for key, value in d.items()
+    ]
 
     test_with_custom_headers(headers_tuple)
 
 
 @pytest.mark.usefixtures("setup_and_teardown")
-def test_server_health_check() -> None:
+def test_server_health_check(monkeypatch) -> None:
     try:
-        response = urllib.request.urlopen(f"http://0.0.0.0:{server.HEALTH_CHECK_PORT}")
+        # A client that never sends its request doesn't hold up the others
+        stalled_client = socket.create_connection(("0.0.0.0", server.HEALTH_CHECK_PORT))
+        response = urllib.request.urlopen(
+            f"http://0.0.0.0:{server.HEALTH_CHECK_PORT}", timeout=2
+        )
         assert response.read() == b"OK"
         print(f"Verify Health Check Status: {response.getcode()}")
         assert response.getcode() == 200
@@ -115,9 +150,842 @@ def test_server_health_check() -> None:
         )
         assert response.getcode() == 200
         print(f"Verify IAP Cert downloaded: {response.read().decode('utf-8')}")
+        response = urllib.request.urlopen(
+            f"http://0.0.0.0:{server.HEALTH_CHECK_PORT}/metrics"
+        )
+        assert response.getcode() == 200
+        metrics = response.read().decode("utf-8")
+        assert "# TYPE se_waf_decisions_total counter" in metrics
+        print(f"Verify metrics are served: {len(metrics.splitlines())} lines")
+        stalled_client.close()
     except urllib.error.URLError:
         raise Exception("Setup Error: Server not ready!")
 
+    # Live but not ready until the rules are loaded
+    monkeypatch.setattr(server, "global_request_policy", None)
+    response = urllib.request.urlopen(
+        f"http://0.0.0.0:{server.HEALTH_CHECK_PORT}/livez"
+    )
+    assert response.getcode() == 200
+    for path in ["/readyz", "/"]:
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(f"http://0.0.0.0:{server.HEALTH_CHECK_PORT}{path}")
+        assert error.value.code == 503
+        assert error.value.read() == b"Rules not loaded"
+    monkeypatch.undo()
+    response = urllib.request.urlopen(
+        f"http://0.0.0.0:{server.HEALTH_CHECK_PORT}/readyz"
+    )
+    assert response.read() == b"OK"
+
+
+def test_cidr_matcher() -> None:
+    matcher = CidrMatcher(
+        [
+            ("1.0.0.0/8", "deny"),
+            ("1.1.0.0/16", "allow"),
+            ("1.1.1.0/24", "deny"),
+            ("1.1.1.1/32", "allow"),
+            ("2.2.2.2/32", "allow"),
+            ("2.2.2.2/32", "deny"),
+            ("0.0.0.0/0", "allow"),
+        ]
+    )
+    assert len(matcher) == 6
+    assert matcher.lookup("1.1.1.1") == ("allow", "1.1.1.1/32")
+    assert matcher.lookup("1.1.1.2") == ("deny", "1.1.1.0/24")
+    assert matcher.lookup("1.1.2.1") == ("allow", "1.1.0.0/16")
+    assert matcher.lookup("1.2.1.1") == ("deny", "1.0.0.0/8")
+    assert matcher.lookup("2.2.2.2") == ("deny", "2.2.2.2/32")
+    assert matcher.lookup("3.3.3.3") == ("allow", "0.0.0.0/0")
+    assert matcher.lookup("::1") is None
+    assert matcher.lookup("::ffff:1.1.1.1") == ("allow", "1.1.1.1/32")
+    assert matcher.lookup("not-an-ip") is None
+    assert matcher.lookup("1.1.1.1\x00") is None
+    assert matcher.lookup("::1\x00") is None
+    assert CidrMatcher([]).lookup("1.1.1.1") is None
+
+    ipv6_matcher = CidrMatcher(
+        [
+            ("2001:db8::/32", "deny"),
+            ("2001:db8:1::/48", "allow"),
+            ("2001:db8:1::1", "deny"),
+            ("::/0", "allow"),
+        ]
+    )
+    assert ipv6_matcher.lookup("2001:db8:1::1") == ("deny", "2001:db8:1::1/128")
+    assert ipv6_matcher.lookup("2001:db8:1::2") == ("allow", "2001:db8:1::/48")
+    assert ipv6_matcher.lookup("2001:db8:2::1") == ("deny", "2001:db8::/32")
+    assert ipv6_matcher.lookup("2001:4860::1") == ("allow", "::/0")
+    assert ipv6_matcher.lookup("1.1.1.1") is None
+
+
+def test_xff_parser() -> None:
+    parser = XffParser()
+    assert parser.client_ip("1.1.1.1,2.2.2.2") == "1.1.1.1"
+    assert parser.client_ip(" 3.3.3.3 , 1.1.1.1 ,, 2.2.2.2 ") == "1.1.1.1"
+    assert parser.client_ip("2.2.2.2") is None
+    assert parser.client_ip(",2.2.2.2,") is None
+    assert parser.client_ip("") is None
+
+    parser = XffParser(trusted_proxy_ranges=["10.0.0.0/8", "2001:db8::/32"])
+    assert parser.client_ip("1.1.1.1,10.0.0.1,2001:db8::1,2.2.2.2") == "1.1.1.1"
+    assert parser.client_ip("10.0.0.2,10.0.0.1,2.2.2.2") == "10.0.0.2"
+    assert XffParser(trusted_hops=0).client_ip("1.1.1.1,2.2.2.2") == "2.2.2.2"
+    assert XffParser(trusted_hops=2).client_ip("1.1.1.1,2.2.2.2") is None
+
+    # Only max_hops hops are examined, whatever the size of the header
+    parser = XffParser(trusted_proxy_ranges=["10.0.0.0/8"], max_hops=4)
+    assert parser.client_ip("1.1.1.1," + "10.0.0.1," * 1000 + "2.2.2.2") == "10.0.0.1"
+    assert parser.client_ip("1.1.1.1" + "," * 1000 + "2.2.2.2") is None
+    with pytest.raises(ValueError):
+        XffParser(trusted_hops=2, max_hops=2)
+
+
+def test_blocklist(tmp_path) -> None:
+    feed = tmp_path / "feed.txt"
+    feed.write_text(
+        "\n".join(
+            [
+                "# reputation feed",
+                "1.1.1.1",
+                "1.1.1.2 ; adjacent to 1.1.1.1",
+                "10.0.0.0/8",
+                "10.1.0.0/16",
+                "5.5.5.1-5.5.5.9",
+                "2001:db8::/32",
+                "::ffff:9.9.9.9",
+                "not-an-ip",
+            ]
+        )
+    )
+    compiled = tmp_path / "blocklist.bin"
+    assert compile_blocklist([str(feed)], str(compiled)) == {
+        "ipv4_ranges": 4,
+        "ipv6_ranges": 1,
+        "skipped": 1,
+    }
+
+    blocklist = Blocklist(str(compiled))
+    assert len(blocklist) == 5
+    assert blocklist.lookup("1.1.1.2") == ("deny", "1.1.1.1-1.1.1.2")
+    assert blocklist.lookup("1.1.1.3") is None
+    assert blocklist.lookup("10.200.0.1") == ("deny", "10.0.0.0-10.255.255.255")
+    assert blocklist.lookup("5.5.5.10") is None
+    assert blocklist.lookup("9.9.9.9") == ("deny", "9.9.9.9-9.9.9.9")
+    assert blocklist.lookup("::ffff:10.0.0.1") == ("deny", "10.0.0.0-10.255.255.255")
+    assert blocklist.lookup("2001:db8:ffff::1") is not None
+    assert blocklist.lookup("2001:db9::1") is None
+    assert blocklist.lookup("0.0.0.0") is None
+    assert blocklist.lookup("not-an-ip") is None
+
+    truncated = tmp_path / "truncated.bin"
+    truncated.write_bytes(compiled.read_bytes()[:-1])
+    with pytest.raises(ValueError):
+        Blocklist(str(truncated))
+
+
+def test_rate_limiter(monkeypatch, tmp_path) -> None:
+    limiter = TokenBucketRateLimiter(rate=2, burst=3, max_keys=2, shards=1)
+    assert [limiter.allow("1.1.1.1", now=0) for _ in range(4)] == [
+        True,
+        True,
+        True,
+        False,
+    ]
+    # Two tokens per second
+    assert limiter.allow("1.1.1.1", now=0.5)
+    assert not limiter.allow("1.1.1.1", now=0.5)
+    assert limiter.allow("2.2.2.2", now=0.5)
+    assert limiter.allow("3.3.3.3", now=0.5)
+    assert len(limiter) == 2 and limiter.evictions == 1
+    # The least recently used client was evicted and starts with a full bucket
+    assert limiter.allow("1.1.1.1", now=0.5)
+
+    server.apply_rule_configuration(server.RuleConfiguration())
+    monkeypatch.setattr(server, "RATE_LIMITER", TokenBucketRateLimiter(1, 1))
+    monkeypatch.setattr(server, "SERVICE_EXTENSION_RATE_LIMIT_KEY", "client_ip")
+    assert server.handle_xff_validation("1.1.1.1,2.2.2.2") is None
+    response = server.handle_xff_validation("1.1.1.1,2.2.2.2")
+    assert response is server.RATE_LIMITED_RESPONSE
+    assert response.immediate_response.status.code == 429
+    assert server.handle_xff_validation("1.1.1.2,2.2.2.2") is None
+
+    # Rate limiting by IAP user is refused when IAP isn't required
+    monkeypatch.setattr(server, "SERVICE_EXTENSION_RATE_LIMIT_KEY", "iap_user")
+    config_file = tmp_path / "rules.json"
+    config_file.write_text('{"se_require_iap": true}')
+    assert server.reload_rule_configuration(str(config_file))
+    config_file.write_text('{"se_require_iap": false}')
+    assert not server.reload_rule_configuration(str(config_file))
+    assert server.global_request_policy.configuration.require_iap
+    with pytest.raises(ValueError):
+        server.apply_rule_configuration(server.RuleConfiguration(require_iap=False))
+    monkeypatch.undo()
+    server.apply_rule_configuration(server.RuleConfiguration())
+
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    "Answers the Redis commands RedisBackend sends from an in-memory dict"
+
+    def handle(self) -> None:
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            args = []
+            for _ in range(int(line[1:])):
+                length = int(self.rfile.readline()[1:])
+                args.append(self.rfile.read(length + 2)[:-2].decode("utf-8"))
+            command, store = args[0].upper(), self.server.store
+            if command == "INCRBY":
+                store[args[1]] = store.get(args[1], 0) + int(args[2])
+                self.wfile.write(b":%d\r\n" % store[args[1]])
+            elif command == "EXPIRE":
+                self.wfile.write(b":1\r\n")
+            elif command in ("AUTH", "SELECT"):
+                self.wfile.write(b"+OK\r\n")
+            else:
+                self.wfile.write(b"-ERR unknown command\r\n")
+
+
+@pytest.fixture
+def fake_redis() -> Iterator[str]:
+    fake_server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), FakeRedisHandler)
+    fake_server.daemon_threads = True
+    fake_server.store = {}
+    thread = threading.Thread(target=fake_server.serve_forever, daemon=True)
+    thread.start()
+    yield "redis://:secret@127.0.0.1:%d/1" % fake_server.server_address[1]
+    fake_server.shutdown()
+    fake_server.server_close()
+
+
+@pytest.mark.parametrize("backend_type", ["local", "redis"])
+def test_shared_rate_limit(backend_type: str, fake_redis: str) -> None:
+    if backend_type == "local":
+        backends = [LocalBackend()] * 2
+    else:
+        backends = [RedisBackend(fake_redis), RedisBackend(fake_redis)]
+    first, second = [
+        TokenBucketRateLimiter(rate=1, burst=5, shared=True) for _ in range(2)
+    ]
+    first_sync = RateLimitSync(first, backends[0])
+    second_sync = RateLimitSync(second, backends[1])
+
+    assert second.allow("1.1.1.1", now=0)
+    assert second_sync.sync(now=0) == 1
+    assert all(first.allow("1.1.1.1", now=0) for _ in range(3))
+    assert first_sync.sync(now=0) == 1
+    # The second instance learns the first took 3 tokens on its next exchange
+    assert second.allow("1.1.1.1", now=0)
+    assert second_sync.sync(now=0) == 1
+    assert not second.allow("1.1.1.1", now=0)
+    assert second_sync.sync(now=0) == 1
+    assert first_sync.sync(now=0) == 0
+    for backend in backends:
+        backend.close()
+
+    unreachable = RateLimitSync(first, RedisBackend("redis://127.0.0.1:1"))
+    assert first.allow("2.2.2.2", now=0)
+    assert unreachable.sync(now=0) == 0 and unreachable.errors == 1
+
+
+def test_rule_configuration_reload(tmp_path) -> None:
+    config_file = tmp_path / "se_config.json"
+    config_file.write_text(json.dumps({"se_denied_ipv4_cidr_ranges": ["1.0.0.0/8"]}))
+    watcher = server.RuleConfigurationWatcher(str(config_file), interval=60)
+    server.apply_rule_configuration(server.load_rule_configuration(str(config_file)))
+    matcher = server.global_request_policy.cidr_matcher
+    assert matcher.lookup("1.1.1.1") == ("deny", "1.0.0.0/8")
+    assert matcher.lookup("2001:db8::1") == ("allow", "::/0")
+    assert server.global_request_policy.scoped_bits
+    assert not watcher.check()
+
+    config_file.write_text(
+        json.dumps(
+            {
+                "se_require_iap": True,
+                "se_allowed_ipv4_cidr_ranges": "1.1.1.1/32",
+                "se_denied_ipv4_cidr_ranges": ["1.0.0.0/8"],
+            }
+        )
+    )
+    os.utime(config_file, ns=(0, time.time_ns() + 1))
+    assert watcher.check()
+    policy = server.global_request_policy
+    assert policy.cidr_matcher.lookup("1.1.1.1") == ("allow", "1.1.1.1/32")
+    # Only listing allowed IPv4 ranges doesn't leave every IPv6 client allowed
+    assert policy.cidr_matcher.lookup("2001:db8::1") is None
+    assert policy.configuration.require_iap
+    # Requests already holding the previous matcher are unaffected
+    assert matcher.lookup("1.1.1.1") == ("deny", "1.0.0.0/8")
+
+    # A reload failing on any of the rules leaves every rule as it was
+    for invalid_config in [
+        '{"se_denied_ipv4_cidr_ranges": ["1.1.1.1/8"]}',
+        "{",
+        json.dumps(
+            {
+                "se_denied_ipv4_cidr_ranges": ["1.0.0.0/8"],
+                "se_blocklist_file": str(tmp_path / "missing.txt"),
+            }
+        ),
+    ]:
+        config_file.write_text(invalid_config)
+        assert not server.reload_rule_configuration(str(config_file))
+        assert server.global_request_policy is policy
+        assert server.handle_xff_validation("1.1.1.1,2.2.2.2") is None
+
+
+def test_reload_during_stream(tmp_path) -> None:
+    "A stream keeps the rules it started with when they are reloaded under it"
+    signature_file = tmp_path / "signatures.json"
+    signature_file.write_text(json.dumps([{"id": "scanner", "pattern": "sqlmap"}]))
+    server.apply_rule_configuration(
+        server.RuleConfiguration(
+            allowed_ipv4_cidr_ranges="1.0.0.0/8", signature_file=str(signature_file)
+        )
+    )
+    stream = server.StreamState()
+    stream.policy = server.global_request_policy
+
+    # The reload drops the signatures and stops allowing 1.0.0.0/8
+    server.apply_rule_configuration(
+        server.RuleConfiguration(allowed_ipv4_cidr_ranges="2.0.0.0/8")
+    )
+    assert server.global_request_policy.signature_engine is None
+    assert server.handle_header_signatures("sqlmap/1.7", stream) is not None
+    assert server.handle_path_signatures("/?q=sqlmap", stream) is not None
+    assert server.handle_xff_validation("1.1.1.1,2.2.2.2", stream) is None
+    assert server.handle_xff_validation("1.1.1.1,2.2.2.2") is not None
+    server.apply_rule_configuration(server.RuleConfiguration())
+
+
+def test_decision_cache() -> None:
+    server.apply_rule_configuration(
+        server.RuleConfiguration(denied_ipv4_cidr_ranges="1.0.0.0/8")
+    )
+    counts = server.decision_cache_counts()
+    assert server.handle_xff_validation("1.1.1.1,2.2.2.2") is not None
+    assert server.handle_xff_validation(" 1.1.1.1 ,2.2.2.2") is not None
+    assert server.decision_cache_counts() == {
+        ("hit",): counts[("hit",)] + 1,
+        ("miss",): counts[("miss",)] + 1,
+    }
+
+    # Rebuilding the rules starts a new cache, counts keep growing
+    server.apply_rule_configuration(
+        server.RuleConfiguration(allowed_ipv4_cidr_ranges="1.0.0.0/8")
+    )
+    assert server.handle_xff_validation("1.1.1.1,2.2.2.2") is None
+    assert server.decision_cache_counts()[("miss",)] == counts[("miss",)] + 2
+    # A malformed client hop matches no range instead of raising
+    assert server.handle_xff_validation("1.1.1.1\x00,2.2.2.2") is not None
+
+    # Streams still using the cache of the previous rules are counted as well,
+    # before and after they end
+    stream = server.StreamState()
+    stream.policy = server.global_request_policy
+    lookup = stream.policy.client_ip_lookup
+    server.apply_rule_configuration(server.RuleConfiguration())
+    counts = server.decision_cache_counts()
+    assert server.handle_xff_validation("3.3.3.3,2.2.2.2", stream) is not None
+    assert server.handle_xff_validation("3.3.3.3,2.2.2.2", stream) is not None
+    expected_counts = {
+        ("hit",): counts[("hit",)] + 1,
+        ("miss",): counts[("miss",)] + 1,
+    }
+    assert server.decision_cache_counts() == expected_counts
+    del stream
+    assert server.decision_cache_counts() == expected_counts
+    assert lookup not in server.global_retiring_client_ip_lookups
+
+
+def test_body_inspection(monkeypatch) -> None:
+    inspector = BodyInspector([b"<script", b"UNION SELECT"], max_body_bytes=64)
+    assert inspector.feed(b"name=a&comment=<scr") is None
+    # Patterns split across chunks still match
+    assert inspector.feed(b"IPT>alert(1)") == ("body_pattern", "<script")
+    assert BodyInspector([b"union select"]).feed(b"1 Union Select 2") == (
+        "body_pattern",
+        "union select",
+    )
+    too_large = BodyInspector([], max_body_bytes=8)
+    assert too_large.feed(b"12345678") is None
+    assert too_large.feed(b"9") == ("body_too_large", "9 > 8 bytes")
+
+    server.apply_rule_configuration(
+        server.RuleConfiguration(body_deny_patterns="<script")
+    )
+    stream = server.StreamState()
+    for phase, message in [
+        ("request_headers", service_pb2.HttpHeaders()),
+        ("request_body", service_pb2.HttpBody(body=b"a=<scr")),
+        ("request_trailers", service_pb2.HttpTrailers()),
+        ("response_headers", service_pb2.HttpHeaders()),
+        ("response_body", service_pb2.HttpBody(body=b"<script>")),
+        ("response_trailers", service_pb2.HttpTrailers()),
+    ]:
+        request = service_pb2.ProcessingRequest(**{phase: message})
+        assert server.process_request(request, stream).WhichOneof("response") == phase
+        assert (
+            server.process_request(
+                service_pb2.ProcessingRequest(async_mode=True, **{phase: message}),
+                server.StreamState(),
+            )
+            is None
+        )
+
+    request = service_pb2.ProcessingRequest(
+        request_body=service_pb2.HttpBody(body=b"ipt>", end_of_stream=True)
+    )
+    response = server.process_request(request, stream)
+    assert response.immediate_response.status.code == 403
+
+    monkeypatch.setattr(server, "SERVICE_EXTENSION_MAX_REQUEST_BODY_BYTES", 4)
+    request = service_pb2.ProcessingRequest(
+        request_body=service_pb2.HttpBody(body=b"12345")
+    )
+    response = server.process_request(request, server.StreamState())
+    assert response.immediate_response.status.code == 413
+
+
+def test_signatures(tmp_path, monkeypatch) -> None:
+    automaton = AhoCorasick(["he", "she", "his", "hers"])
+    assert sorted(automaton.iter_matches("ushers")) == [0, 1, 3]
+
+    engine = SignatureEngine(
+        [
+            parse_signature(entry)
+            for entry in [
+                {"id": "sqli", "pattern": "UNION SELECT", "targets": ["query"]},
+                {"id": "traversal", "pattern": "../"},
+                {"id": "handler", "regex": r"on(error|load)\s*=", "literal": "on"},
+                {"id": "script", "regex": r"<script[^>]*>"},
+            ]
+        ]
+    )
+    assert engine.targets == ("path", "query", "headers")
+    assert required_literal(r"(?i)union\s+all\s+select") == "select"
+    assert required_literal(r"ab+c?d|e") == ""
+    assert required_literal(r"[a-z]+\.\./etc") == "../etc"
+    # Quantifier bounds and escaped code points aren't text of the match
+    assert required_literal(r"ab{2,10}") == "a"
+    assert required_literal(r"\x3cscript") == "script"
+    assert required_literal(r"\u003cscript\N{GREATER-THAN SIGN}") == "script"
+    assert required_literal(r"\d{1,3}\.\d{1,3}") == "."
+    assert required_literal(r"\0123abc") == "abc"
+    escaped_engine = SignatureEngine(
+        [
+            parse_signature(entry)
+            for entry in [
+                {"id": "repeat", "regex": r"ab{2,10}c"},
+                {"id": "hex", "regex": r"\x3cscript"},
+                {"id": "ip", "regex": r"\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}"},
+            ]
+        ]
+    )
+    assert escaped_engine.scan_header("abbbc")[1].id == "repeat"
+    assert escaped_engine.scan_header("%3Cscript>")[1].id == "hex"
+    assert escaped_engine.scan_header("http://10.0.0.1/")[1].id == "ip"
+    assert escaped_engine.scan_header("2,10 3cscript 1,3") is None
+    assert engine.scan_path("/a/..%2F..%2Fetc/passwd")[1].id == "traversal"
+    assert engine.scan_path("/search?q=1+Union+Select+2")[1].id == "sqli"
+    # Signatures only apply to their targets
+    assert engine.scan_path("/union select") is None
+    assert engine.scan_header("<img onerror =alert(1)>")[1].id == "handler"
+    assert engine.scan_header("onward") is None
+    assert engine.scan_header("%3CScript src=x%3E")[1].id == "script"
+    for invalid_entry in [
+        {"pattern": "no id"},
+        {"id": "both", "pattern": "a", "regex": "a"},
+        {"id": "target", "pattern": "a", "targets": ["body"]},
+        {"id": "regex", "regex": "("},
+    ]:
+        with pytest.raises(ValueError):
+            parse_signature(invalid_entry)
+
+    signature_file = tmp_path / "signatures.json"
+    signature_file.write_text(
+        json.dumps(
+            [
+                {"id": "traversal", "pattern": "../", "targets": ["path"]},
+                {"id": "scanner", "pattern": "sqlmap", "targets": ["headers"]},
+            ]
+        )
+    )
+    server.apply_rule_configuration(
+        server.RuleConfiguration(signature_file=str(signature_file))
+    )
+    assert server.global_request_policy.scoped_bits == -1
+    for headers, status in [
+        ([(":path", "/static/../../etc/passwd")], 403),
+        ([(":path", "/"), ("user-agent", "curl/8"), ("user-agent", "sqlmap/1.7")], 403),
+        ([(":path", "/index.html"), ("user-agent", "curl/8")], None),
+    ]:
+        request = service_pb2.ProcessingRequest(
+            request_headers=service_pb2.HttpHeaders(
+                headers=service_pb2.HeaderMap(
+                    headers=[
+                        service_pb2.HeaderValue(key=key, value=value)
+                        for key, value in headers
+                    ]
+                )
+            )
+        )
+        response = server.process_request(request)
+        if status is None:
+            assert response.HasField("request_headers")
+        else:
+            assert response.immediate_response.status.code == status
+
+    # Scoped headers listed in se_signature_headers are scanned as well, every
+    # occurrence of them, before their handler runs
+    xff_header = "x-forwarded-for"
+    if server.SERVICE_EXTENSION_TEST:
+        xff_header = "x-forwarded-for-test"
+    monkeypatch.setattr(server, "SERVICE_EXTENSION_SIGNATURE_HEADERS", [xff_header])
+    server.apply_rule_configuration(
+        server.RuleConfiguration(
+            denied_ipv4_cidr_ranges="3.0.0.0/8", signature_file=str(signature_file)
+        )
+    )
+    for xff_values, expected_response in [
+        (["sqlmap,1.1.1.1,2.2.2.2"], server.SIGNATURE_RESPONSE),
+        (["1.1.1.1,2.2.2.2", "sqlmap,1.1.1.1,2.2.2.2"], server.SIGNATURE_RESPONSE),
+        (["3.3.3.3,2.2.2.2"], server.DENIED_RESPONSE),
+        (["1.1.1.1,2.2.2.2"], server.ALLOW_RESPONSE),
+    ]:
+        request = get_request(
+            custom_headers=[(xff_header, xff_value) for xff_value in xff_values]
+        )
+        assert server.process_request(request) is expected_response
+    server.apply_rule_configuration(server.RuleConfiguration())
+
+
+def test_shadow_evaluation(tmp_path, monkeypatch) -> None:
+    shadow_config_file = tmp_path / "se_shadow_config.json"
+    shadow_config_file.write_text(
+        json.dumps({"se_denied_ipv4_cidr_ranges": ["1.0.0.0/8"]})
+    )
+    monkeypatch.setattr(
+        server, "SERVICE_EXTENSION_SHADOW_CONFIG_FILE", str(shadow_config_file)
+    )
+    monkeypatch.setattr(server, "global_shadow_rules", None)
+    monkeypatch.setattr(server, "global_shadow_evaluator", None)
+    server.apply_rule_configuration(server.RuleConfiguration())
+    server.start_shadow_evaluation()
+    evaluator = server.global_shadow_evaluator
+    xff_header = "x-forwarded-for"
+    if server.SERVICE_EXTENSION_TEST:
+        xff_header = "x-forwarded-for-test"
+
+    def send(client_ip: str) -> service_pb2.ProcessingResponse:
+        return server.process_request(
+            service_pb2.ProcessingRequest(
+                request_headers=service_pb2.HttpHeaders(
+                    headers=service_pb2.HeaderMap(
+                        headers=[
+                            service_pb2.HeaderValue(
+                                key=xff_header, value=f"{client_ip},2.2.2.2"
+                            )
+                        ]
+                    )
+                )
+            )
+        )
+
+    try:
+        decisions = server.SHADOW_DECISIONS.collect()
+        # The shadow rules never block, only count what they would have done
+        assert send("1.1.1.1").HasField("request_headers")
+        assert send("3.3.3.3").HasField("request_headers")
+        evaluator.drain()
+        counts = server.SHADOW_DECISIONS.collect()
+        for labels in [("deny", "allow"), ("allow", "allow")]:
+            assert counts[labels] == decisions.get(labels, 0) + 1
+
+        # A broken shadow file doesn't hold back the live rules
+        shadow_rules = server.global_shadow_rules
+        shadow_config_file.write_text("{")
+        server.apply_rule_configuration(
+            server.RuleConfiguration(denied_ipv4_cidr_ranges="1.0.0.0/8")
+        )
+        assert server.global_shadow_rules is shadow_rules
+        assert send("1.1.1.1").HasField("immediate_response")
+        evaluator.drain()
+        assert server.SHADOW_DECISIONS.collect()[("deny", "deny")] == (
+            decisions.get(("deny", "deny"), 0) + 1
+        )
+    finally:
+        evaluator.stop()
+        server.apply_rule_configuration(server.RuleConfiguration())
+
+
+def test_load_shedding(monkeypatch) -> None:
+    limiter = StreamLimiter(max_streams=1)
+    assert limiter.acquire() and not limiter.acquire()
+    limiter.release()
+    assert limiter.acquire() and (limiter.active, limiter.shed) == (1, 1)
+    assert StreamLimiter().acquire()
+
+    # Streams beyond the limit get the verdict without being inspected
+    server.apply_rule_configuration(server.RuleConfiguration())
+    monkeypatch.setattr(server, "STREAM_LIMITER", limiter)
+    headers = [(":path", "/"), ("x-forwarded-for", "3.3.3.3,2.2.2.2")]
+    requests = [
+        get_request(custom_headers=headers),
+        service_pb2.ProcessingRequest(request_body=service_pb2.HttpBody(body=b"x")),
+    ]
+    responses = list(server.CalloutProcessor().Process(iter(requests), None))
+    assert responses == [server.LOAD_SHED_RESPONSE]
+    assert server.LOAD_SHED_RESPONSE.immediate_response.status.code == 503
+
+    monkeypatch.setattr(server, "LOAD_SHED_RESPONSE", server.ALLOW_RESPONSE)
+    responses = list(server.CalloutProcessor().Process(iter(requests), None))
+    assert responses == [server.ALLOW_RESPONSE, server.REQUEST_BODY_ACK]
+    assert limiter.active == 1
+
+    limiter.release()
+    responses = list(server.CalloutProcessor().Process(iter(requests), None))
+    assert responses == [server.ALLOW_RESPONSE, server.REQUEST_BODY_ACK]
+    assert limiter.active == 0
+
+
+def test_structured_logging() -> None:
+    stream = io.StringIO()
+    logger = waf_logging.configure_logging(
+        level=logging.DEBUG, sample_rate=0.0, queue_size=2, stream=stream
+    )
+    try:
+        logger.info("sampled out")
+        logger.warning("Request from %s", "1.1.1.1", extra={"decision": "deny"})
+        waf_logging.flush_logging()
+        entries = [json.loads(line) for line in stream.getvalue().splitlines()]
+        assert len(entries) == 1
+        assert entries[0]["message"] == "Request from 1.1.1.1"
+        assert entries[0]["severity"] == "WARNING"
+        assert entries[0]["decision"] == "deny"
+
+        # The listener is stopped, so only the queue size is accepted
+        for _ in range(3):
+            logger.warning("queued")
+        assert waf_logging.dropped_records() == 1
+    finally:
+        waf_logging.configure_logging()
+
+
+def test_metrics_registry() -> None:
+    registry = waf_metrics.MetricsRegistry()
+    decisions = registry.register(
+        waf_metrics.Counter("decisions_total", "Decisions", ["decision"])
+    )
+    latency = registry.register(
+        waf_metrics.Histogram("latency_seconds", "Latency", buckets=[0.1, 1])
+    )
+    registry.register(waf_metrics.CallbackMetric("queue_depth", "Depth", lambda: 3))
+
+    threads = [
+        threading.Thread(target=lambda: [decisions.inc("allow") for _ in range(100)])
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    decisions.inc("deny")
+    latency.observe(0.05)
+    latency.observe(0.5)
+    latency.observe(5)
+
+    # A second process reporting the same metrics is summed in
+    text = registry.render([registry.snapshot()])
+    assert 'decisions_total{decision="allow"} 800' in text
+    assert 'decisions_total{decision="deny"} 2' in text
+    assert 'latency_seconds_bucket{le="0.1"} 2' in text
+    assert 'latency_seconds_bucket{le="1"} 4' in text
+    assert 'latency_seconds_bucket{le="+Inf"} 6' in text
+    assert "latency_seconds_count 6" in text
+    assert "queue_depth 6" in text
+
+
+def get_iap_key_pair(key_id: str) -> Tuple[str, es256.ES256Signer]:
+    """Returns an IAP style public key set and a signer for it"""
+    private_key = ec.generate_private_key(ec.SECP256R1())
+    public_key = private_key.public_key().public_bytes(
+        serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+    keys_json = json.dumps({key_id: public_key.decode("utf-8")})
+    return keys_json, es256.ES256Signer(private_key, key_id=key_id)
+
+
+@pytest.mark.parametrize("native", [True, False])
+def test_iap_jwt_verification(native: bool) -> None:
+    keys_json, signer = get_iap_key_pair("test-kid")
+    _, other_signer = get_iap_key_pair("test-kid")
+    _, unknown_signer = get_iap_key_pair("other-kid")
+    audience = "/projects/1/global/backendServices/2"
+    key_set = IapKeySet(keys_json, native=native)
+    now = int(time.time())
+    claims = {
+        "sub": "accounts.google.com:1",
+        "email": "user@example.com",
+        "iss": IAP_ISSUER,
+        "aud": audience,
+    }
+
+    token = jwt.encode(signer, {**claims, "iat": now, "exp": now + 600}).decode()
+    assert key_set.verify(token)["email"] == "user@example.com"
+    assert IapKeySet(keys_json, audience=audience, native=native).verify(token)
+
+    expired = jwt.encode(signer, {**claims, "iat": now - 600, "exp": now - 1}).decode()
+    forged = jwt.encode(other_signer, {**claims, "iat": now, "exp": now + 600})
+    unknown = jwt.encode(unknown_signer, {**claims, "iat": now, "exp": now + 600})
+    issuer = jwt.encode(
+        signer, {**claims, "iss": "https://example.com", "iat": now, "exp": now + 600}
+    )
+    for bad_token in [expired, forged.decode(), unknown.decode(), issuer, "foo", ""]:
+        with pytest.raises(Exception):
+            key_set.verify(bad_token)
+    with pytest.raises(Exception):
+        IapKeySet(keys_json, audience="/projects/1/other", native=native).verify(token)
+
+    cache = VerifiedTokenCache(max_size=1, ttl=300)
+    assert cache.get(token) is None
+    cache.put(token, key_set.verify(token))
+    assert cache.get(token)["sub"] == "accounts.google.com:1"
+    cache.put(expired, {**claims, "exp": now - 1})
+    assert len(cache) == 1 and cache.get(expired) is None
+    assert cache.get(token) is None
+    assert (cache.hits, cache.misses) == (1, 3)
+
+    # Tokens verified before a clear aren't added after it
+    generation = cache.generation
+    cache.clear()
+    cache.put(token, key_set.verify(token), generation)
+    assert cache.get(token) is None
+    cache.put(token, key_set.verify(token), cache.generation)
+    assert cache.get(token)["sub"] == "accounts.google.com:1"
+
+
+def test_iap_key_refresh(tmp_path, monkeypatch) -> None:
+    keys_json, _ = get_iap_key_pair("old-kid")
+    rotated_keys_json, signer = get_iap_key_pair("new-kid")
+    keys_file = tmp_path / "iap_public_key.crt"
+    keys_file.write_text(keys_json)
+    monkeypatch.setattr(server, "IAP_KEY_SET", IapKeySet(keys_json))
+    monkeypatch.setattr(server, "IAP_CERTIFICATE", keys_json.encode())
+    now = int(time.time())
+    claims = {"sub": "accounts.google.com:1", "email": "user@example.com"}
+    token = jwt.encode(
+        signer, {**claims, "iss": IAP_ISSUER, "iat": now, "exp": now + 600}
+    ).decode()
+    assert server.validate_iap_jwt(token)[0] is None
+
+    refresher = IapKeyRefresher(
+        str(keys_file),
+        server.update_iap_keys,
+        load=server.load_iap_key_set,
+        keys_json=keys_json.encode(),
+    )
+    assert not refresher.refresh()
+    keys_file.write_text(rotated_keys_json)
+    assert refresher.refresh() and refresher.updates == 1
+    assert server.IAP_CERTIFICATE == rotated_keys_json.encode()
+    assert server.validate_iap_jwt(token)[0] == "accounts.google.com:1"
+
+    # Broken or missing keys keep the previous ones
+    for broken in ["{", "{}"]:
+        keys_file.write_text(broken)
+        assert not refresher.refresh()
+    keys_file.unlink()
+    assert not refresher.refresh() and refresher.errors == 3
+    assert server.validate_iap_jwt(token)[0] == "accounts.google.com:1"
+
+
+@pytest.mark.parametrize("require_iap", [False, True])
+def test_invalid_iap_keys(tmp_path, require_iap: bool) -> None:
+    "Invalid IAP keys only stop the server from starting when IAP is required"
+    keys_file = tmp_path / "iap_public_key.crt"
+    keys_file.write_text(json.dumps({"kid": "not a PEM key"}))
+    with pytest.raises(ValueError):
+        IapKeySet("[]")
+    result = subprocess.run(
+        [sys.executable, "-c", "import server; print(len(server.IAP_KEY_SET))"],
+        env=dict(
+            environ,
+            se_iap_certificate_file=str(keys_file),
+            se_require_iap=str(require_iap),
+        ),
+        cwd=os.path.dirname(os.path.abspath(server.__file__)),
+        capture_output=True,
+        text=True,
+    )
+    if require_iap:
+        assert result.returncode != 0 and "ValueError" in result.stderr
+    else:
+        assert result.returncode == 0
+        assert result.stdout.splitlines()[-1] == "0"
+        assert "failed to load the IAP keys" in result.stdout
+
+
+def test_identity_headers(monkeypatch) -> None:
+    keys_json, signer = get_iap_key_pair("test-kid")
+    monkeypatch.setattr(server, "IAP_KEY_SET", IapKeySet(keys_json))
+    now = int(time.time())
+    token = jwt.encode(
+        signer,
+        {
+            "sub": "accounts.google.com:1",
+            "email": "user@example.com",
+            "iss": IAP_ISSUER,
+            "iat": now,
+            "exp": now + 600,
+        },
+    ).decode()
+    server.apply_rule_configuration(server.RuleConfiguration(require_iap=True))
+    request = get_request(
+        custom_headers=[(server.global_request_policy.iap_jwt_header, token)]
+    )
+
+    # Nothing is mutated, so the route cache is kept
+    response = server.process_request(request)
+    assert response is server.ALLOW_RESPONSE
+    assert not response.request_headers.response.clear_route_cache
+
+    monkeypatch.setattr(server, "SERVICE_EXTENSION_IDENTITY_HEADERS", True)
+    server.apply_rule_configuration(server.RuleConfiguration(require_iap=True))
+    response = server.process_request(request).request_headers.response
+    assert response.clear_route_cache
+    assert [
+        (header.header.key, header.header.raw_value)
+        for header in response.header_mutation.set_headers
+    ] == [
+        ("x-se-waf-user", b"accounts.google.com:1"),
+        ("x-se-waf-email", b"user@example.com"),
+    ]
+
+    # Identity headers sent by the client are overwritten, never appended to
+    spoofed_request = get_request(
+        custom_headers=[
+            ("x-se-waf-user", "accounts.google.com:admin"),
+            (server.global_request_policy.iap_jwt_header, token),
+        ]
+    )
+    response = server.process_request(spoofed_request).request_headers.response
+    assert [
+        (header.header.key, header.header.raw_value, header.append_action)
+        for header in response.header_mutation.set_headers
+    ] == [
+        (key, value, service_pb2.HeaderValueOption.OVERWRITE_IF_EXISTS_OR_ADD)
+        for key, value in [
+            ("x-se-waf-user", b"accounts.google.com:1"),
+            ("x-se-waf-email", b"user@example.com"),
+        ]
+    ]
+    server.apply_rule_configuration(server.RuleConfiguration())
+
 
 if __name__ == "__main__":
     # Run the gRPC service tests
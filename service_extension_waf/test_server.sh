@@ -3,6 +3,40 @@ set -e
 
 pytest test_server.py::test_server_health_check -sv
 
+pytest test_server.py::test_cidr_matcher -sv
+
+pytest test_server.py::test_xff_parser -sv
+
+pytest test_server.py::test_iap_jwt_verification -sv
+
+pytest test_server.py::test_identity_headers -sv
+
+pytest test_server.py::test_iap_key_refresh -sv
+pytest test_server.py::test_invalid_iap_keys -sv
+
+pytest test_server.py::test_blocklist -sv
+
+pytest test_server.py::test_rate_limiter -sv
+
+pytest test_server.py::test_shared_rate_limit -sv
+
+pytest test_server.py::test_rule_configuration_reload -sv
+pytest test_server.py::test_reload_during_stream -sv
+
+pytest test_server.py::test_decision_cache -sv
+
+pytest test_server.py::test_body_inspection -sv
+
+pytest test_server.py::test_signatures -sv
+
+pytest test_server.py::test_shadow_evaluation -sv
+
+pytest test_server.py::test_load_shedding -sv
+
+pytest test_server.py::test_structured_logging -sv
+
+pytest test_server.py::test_metrics_registry -sv
+
 pytest test_server.py::test_server -sv \
     --se_test_case="Verify traffic is not denied" \
     --se_result="pass" \
@@ -46,6 +80,32 @@ pytest test_server.py::test_server -sv \
     --se_headers='[{":host":"se-waf.demo.com"},{"x-forwarded-for":"1.1.1.1,2.2.2.2"}]' \
     --se_allowed_ipv4_cidr_ranges='1.1.1.1/32'
 
+pytest test_server.py::test_server -sv \
+    --se_test_case="Verify IPv6 clients are allowed by default" \
+    --se_result="pass" \
+    --se_headers='[{":host":"se-waf.demo.com"},{"x-forwarded-for":"2001:db8::1,2.2.2.2"}]' \
+    --se_denied_ipv4_cidr_ranges='1.0.0.0/8'
+
+pytest test_server.py::test_server -sv \
+    --se_test_case="Verify denied IPv6 ranges are blocked" \
+    --se_result="fail" \
+    --se_headers='[{":host":"se-waf.demo.com"},{"x-forwarded-for":"2001:db8::1,2.2.2.2"}]' \
+    --se_denied_ipv6_cidr_ranges='2001:db8::/32'
+
+pytest test_server.py::test_server -sv \
+    --se_test_case="Verify more specific IPv6 ranges are allowed" \
+    --se_result="pass" \
+    --se_headers='[{":host":"se-waf.demo.com"},{"x-forwarded-for":"2001:db8::1,2.2.2.2"}]' \
+    --se_denied_ipv6_cidr_ranges='2001:db8::/32' \
+    --se_allowed_ipv6_cidr_ranges='2001:db8::1/128'
+
+pytest test_server.py::test_server -sv \
+    --se_test_case="Verify clients behind trusted proxies are blocked" \
+    --se_result="fail" \
+    --se_headers='[{":host":"se-waf.demo.com"},{"x-forwarded-for":"1.1.1.1,10.0.0.1,2.2.2.2"}]' \
+    --se_denied_ipv4_cidr_ranges='1.0.0.0/8' \
+    --se_xff_trusted_proxy_ranges='10.0.0.0/8'
+
 pytest test_server.py::test_server -sv \
     --se_test_case="Verify missing IAP Header is blocked" \
     --se_result="fail" \
@@ -57,3 +117,70 @@ pytest test_server.py::test_server -sv \
     --se_result="fail" \
     --se_headers='[{":host":"se-waf.demo.com"},{"x-forwarded-for":"1.1.1.1,2.2.2.2"},{"x-goog-iap-jwt-assertion":"foo"}]' \
     --se_require_iap='True'
+
+pytest test_server.py::test_server -sv \
+    --se_test_case="Verify the asyncio server allows traffic" \
+    --se_result="pass" \
+    --se_headers='[{":host":"se-waf.demo.com"},{"x-forwarded-for":"1.1.1.1,2.2.2.2"}]' \
+    --se_allowed_ipv4_cidr_ranges='1.1.1.1/32' \
+    --se_server_mode='async'
+
+pytest test_server.py::test_server -sv \
+    --se_test_case="Verify the asyncio server blocks denied ranges" \
+    --se_result="fail" \
+    --se_headers='[{":host":"se-waf.demo.com"},{"x-forwarded-for":"1.1.1.1,2.2.2.2"}]' \
+    --se_denied_ipv4_cidr_ranges='1.0.0.0/8' \
+    --se_server_mode='async'
+
+pytest test_server.py::test_server_health_check -sv \
+    --se_workers='2'
+
+pytest test_server.py::test_server -sv \
+    --se_test_case="Verify worker processes block denied ranges" \
+    --se_result="fail" \
+    --se_headers='[{":host":"se-waf.demo.com"},{"x-forwarded-for":"1.1.1.1,2.2.2.2"}]' \
+    --se_denied_ipv4_cidr_ranges='1.0.0.0/8' \
+    --se_workers='2'
+
+SE_CONFIG_FILE=$(mktemp)
+echo '{"se_denied_ipv4_cidr_ranges": ["1.0.0.0/8"]}' > "$SE_CONFIG_FILE"
+pytest test_server.py::test_server -sv \
+    --se_test_case="Verify denied ranges from the config file are blocked" \
+    --se_result="fail" \
+    --se_headers='[{":host":"se-waf.demo.com"},{"x-forwarded-for":"1.1.1.1,2.2.2.2"}]' \
+    --se_config_file="$SE_CONFIG_FILE"
+rm -f "$SE_CONFIG_FILE"
+
+SE_BLOCKLIST_FEED=$(mktemp)
+SE_BLOCKLIST_FILE=$(mktemp)
+SE_CONFIG_FILE=$(mktemp)
+echo '1.1.1.0/24' > "$SE_BLOCKLIST_FEED"
+python blocklist.py "$SE_BLOCKLIST_FILE" "$SE_BLOCKLIST_FEED"
+echo "{\"se_blocklist_file\": \"$SE_BLOCKLIST_FILE\"}" > "$SE_CONFIG_FILE"
+pytest test_server.py::test_server -sv \
+    --se_test_case="Verify blocklisted clients are blocked" \
+    --se_result="fail" \
+    --se_headers='[{":host":"se-waf.demo.com"},{"x-forwarded-for":"1.1.1.1,2.2.2.2"}]' \
+    --se_config_file="$SE_CONFIG_FILE"
+rm -f "$SE_BLOCKLIST_FEED" "$SE_BLOCKLIST_FILE" "$SE_CONFIG_FILE"
+
+SE_SIGNATURE_FILE=$(mktemp)
+SE_CONFIG_FILE=$(mktemp)
+echo '[{"id": "sqli-union", "pattern": "union select", "targets": ["query"]}]' > "$SE_SIGNATURE_FILE"
+echo "{\"se_signature_file\": \"$SE_SIGNATURE_FILE\"}" > "$SE_CONFIG_FILE"
+pytest test_server.py::test_server -sv \
+    --se_test_case="Verify requests matching a signature are blocked" \
+    --se_result="fail" \
+    --se_headers='[{":path":"/search?q=1%20UNION%20SELECT%20password"},{"x-forwarded-for":"1.1.1.1,2.2.2.2"}]' \
+    --se_config_file="$SE_CONFIG_FILE"
+pytest test_server.py::test_server -sv \
+    --se_test_case="Verify requests not matching a signature are allowed" \
+    --se_result="pass" \
+    --se_headers='[{":path":"/search?q=union"},{"x-forwarded-for":"1.1.1.1,2.2.2.2"}]' \
+    --se_config_file="$SE_CONFIG_FILE"
+rm -f "$SE_SIGNATURE_FILE" "$SE_CONFIG_FILE"
+
+python bench_server.py --requests 500 --streams 20 --warmup 0 \
+    --mix xff=0.5,iap_valid=0.3,iap_invalid=0.2 --rules 1000
+
+python bench_decisions.py --rules 10,1000 --repeat 1 --min-time 0.01
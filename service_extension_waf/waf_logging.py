@@ -0,0 +1,144 @@
+# Copyright 2023 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+# Service Extension WAF Logging
+----
+Structured logging that keeps formatting and I/O off the request path:
+* Request threads put the unformatted record on a bounded queue; a background
+  QueueListener formats it as one JSON object per line and writes it.
+* When the queue is full records are dropped and counted instead of blocking.
+* Records below WARNING are sampled with the configured sample rate.
+"""
+import atexit
+import json
+import logging
+import queue
+import random
+import sys
+
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import IO, Any, Dict, Optional
+
+LOGGER_NAME = "service_extension_waf"
+
+# Attributes every LogRecord has, anything else was passed through `extra`
+_RECORD_ATTRIBUTES = frozenset(
+    vars(logging.LogRecord("", logging.INFO, "", 0, "", None, None))
+) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    "Formats a record and its `extra` fields as a single line JSON object"
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "severity": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    "Keeps every WARNING and above, and sample_rate of everything else"
+
+    def __init__(self, sample_rate: float = 1.0) -> None:
+        super().__init__()
+        self.sample_rate = sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return (
+            record.levelno >= logging.WARNING
+            or self.sample_rate >= 1
+            or random.random() < self.sample_rate
+        )
+
+
+class LazyQueueHandler(QueueHandler):
+    """
+    Queues records without formatting them, so `msg % args` only runs on the
+    listener thread, and drops records rather than blocking when the queue is full.
+    """
+
+    def __init__(self, log_queue: "queue.Queue[logging.LogRecord]") -> None:
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener: Optional[QueueListener] = None
+_handler: Optional[LazyQueueHandler] = None
+
+
+def configure_logging(
+    level: int = logging.INFO,
+    sample_rate: float = 1.0,
+    queue_size: int = 10000,
+    stream: Optional[IO[str]] = None,
+) -> logging.Logger:
+    """
+    Configures the WAF logger and starts the background writer. Calling it again
+    replaces the previous configuration.
+    """
+    global _listener, _handler
+    if _listener is not None:
+        _listener.stop()
+
+    logger = logging.getLogger(LOGGER_NAME)
+    if _handler is not None:
+        logger.removeHandler(_handler)
+
+    stream_handler = logging.StreamHandler(stream or sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+
+    _handler = LazyQueueHandler(queue.Queue(maxsize=queue_size))
+    _handler.addFilter(SamplingFilter(sample_rate))
+    _listener = QueueListener(_handler.queue, stream_handler)
+    _listener.start()
+
+    logger.addHandler(_handler)
+    logger.setLevel(level)
+    logger.propagate = False
+    return logger
+
+
+def dropped_records() -> int:
+    "Number of records dropped because the queue was full"
+    return _handler.dropped if _handler is not None else 0
+
+
+def flush_logging() -> None:
+    "Writes every queued record, stopping the background writer"
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(flush_logging)
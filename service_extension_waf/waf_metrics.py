@@ -0,0 +1,235 @@
+# Copyright 2023 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+# Service Extension WAF Metrics
+----
+Counters, gauges and histograms rendered in the Prometheus text format.
+
+Every thread records into its own shard (a dict only that thread writes), so
+recording a value never takes a lock. Shards are copied and summed when the
+metrics are collected. Snapshots from other processes can be merged in when
+rendering, which is how worker processes are aggregated by the supervisor.
+"""
+import threading
+
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple, Union
+
+Labels = Tuple[str, ...]
+# metric name -> label values -> value (histograms: bucket counts, sum, count)
+Snapshot = Dict[str, Dict[Labels, Union[float, List[float]]]]
+
+DEFAULT_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+)
+
+
+class _ShardedMetric:
+    type = "untyped"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Sequence[str] = ()
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards: List[dict] = []
+        self._shards_lock = threading.Lock()
+
+    def _shard(self) -> dict:
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._shards_lock:
+                self._shards.append(shard)
+            return shard
+
+    def _copy_shards(self) -> List[dict]:
+        with self._shards_lock:
+            shards = list(self._shards)
+        return [shard.copy() for shard in shards]
+
+
+class Counter(_ShardedMetric):
+    type = "counter"
+
+    def inc(self, *labelvalues: str, amount: float = 1) -> None:
+        shard = self._shard()
+        shard[labelvalues] = shard.get(labelvalues, 0) + amount
+
+    def collect(self) -> Dict[Labels, float]:
+        values: Dict[Labels, float] = {}
+        for shard in self._copy_shards():
+            for labels, value in shard.items():
+                values[labels] = values.get(labels, 0) + value
+        return values
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, *labelvalues: str, amount: float = 1) -> None:
+        self.inc(*labelvalues, amount=-amount)
+
+
+class Histogram(_ShardedMetric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labelvalues: str) -> None:
+        shard = self._shard()
+        counts = shard.get(labelvalues)
+        if counts is None:
+            # One count per bucket, +Inf, then the sum and count of observations
+            counts = shard[labelvalues] = [0.0] * (len(self.buckets) + 3)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    def collect(self) -> Dict[Labels, List[float]]:
+        values: Dict[Labels, List[float]] = {}
+        for shard in self._copy_shards():
+            for labels, counts in shard.items():
+                total = values.setdefault(labels, [0.0] * len(counts))
+                for index, count in enumerate(list(counts)):
+                    total[index] += count
+        return values
+
+
+class CallbackMetric:
+    """
+    A counter or gauge whose value is read from the callback when collected,
+    for values that are already tracked elsewhere (cache hits, queue depth).
+    The callback returns a number, or a dict of label values to numbers.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        callback: Callable[[], Union[float, Dict[Labels, float]]],
+        type: str = "gauge",
+        labelnames: Sequence[str] = (),
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.type = type
+        self.labelnames = tuple(labelnames)
+
+    def collect(self) -> Dict[Labels, float]:
+        value = self.callback()
+        if isinstance(value, dict):
+            return value
+        return {(): value}
+
+
+Metric = Union[Counter, Gauge, Histogram, CallbackMetric]
+
+
+def _merge(total: dict, values: dict) -> None:
+    for labels, value in values.items():
+        if isinstance(value, list):
+            merged = total.setdefault(labels, [0.0] * len(value))
+            for index, count in enumerate(value):
+                merged[index] += count
+        else:
+            total[labels] = total.get(labels, 0) + value
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n")
+        pairs.append('%s="%s"' % (name, value.replace('"', '\\"')))
+    return "{%s}" % ",".join(pairs)
+
+
+def _format_value(value: float) -> str:
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def snapshot(self) -> Snapshot:
+        return {name: metric.collect() for name, metric in self._metrics.items()}
+
+    def render(self, snapshots: Iterable[Snapshot] = ()) -> str:
+        "Returns the Prometheus text format, summing in snapshots of other processes"
+        totals = self.snapshot()
+        for snapshot in snapshots:
+            for name, values in snapshot.items():
+                if name in totals:
+                    _merge(totals[name], values)
+
+        lines = []
+        for name, metric in self._metrics.items():
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.type}")
+            for labels, value in sorted(totals[name].items()):
+                if isinstance(metric, Histogram):
+                    cumulative = 0.0
+                    bounds = [str(bound) for bound in metric.buckets] + ["+Inf"]
+                    for bound, count in zip(bounds, value):
+                        cumulative += count
+                        bucket_labels = _format_labels(
+                            metric.labelnames + ("le",), labels + (bound,)
+                        )
+                        lines.append(
+                            f"{name}_bucket{bucket_labels} {_format_value(cumulative)}"
+                        )
+                    label_text = _format_labels(metric.labelnames, labels)
+                    lines.append(f"{name}_sum{label_text} {_format_value(value[-2])}")
+                    lines.append(
+                        f"{name}_count{label_text} {_format_value(value[-1])}"
+                    )
+                else:
+                    label_text = _format_labels(metric.labelnames, labels)
+                    lines.append(f"{name}{label_text} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
@@ -0,0 +1,80 @@
+# Copyright 2023 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+# Service Extension WAF X-Forwarded-For Parser
+----
+Finds the client IP in an X-Forwarded-For header.
+
+Every proxy appends the address it received the request from, so only the
+rightmost hops can be trusted: anything further left may have been sent by
+the client. The header is scanned from the right, one hop at a time:
+* the first `trusted_hops` hops were appended by proxies we operate (the load
+  balancer appends the client IP and then its own address, hence 1 by default)
+* hops inside `trusted_proxy_ranges` (compiled into a CidrMatcher) are proxies
+  in front of the load balancer and skipped as well
+* the first remaining hop is the client
+
+Scanning stops as soon as the client hop is found, without splitting the
+header, and never looks at more than `max_hops` hops, so the work on an
+abusive multi-kilobyte header is bounded.
+"""
+
+from typing import Iterable, Optional
+
+from cidr_matcher import ALLOW, CidrMatcher
+
+
+class XffParser:
+    """Right-to-left X-Forwarded-For scanner aware of trusted proxies."""
+
+    def __init__(
+        self,
+        trusted_hops: int = 1,
+        trusted_proxy_ranges: Iterable[str] = (),
+        max_hops: int = 32,
+    ) -> None:
+        if trusted_hops < 0 or max_hops <= trusted_hops:
+            raise ValueError("max_hops must be larger than trusted_hops >= 0")
+        self.trusted_hops = trusted_hops
+        self.max_hops = max_hops
+        # Any hop the matcher finds is a trusted proxy
+        trusted_proxies = CidrMatcher((cidr, ALLOW) for cidr in trusted_proxy_ranges)
+        self.trusted_proxies = trusted_proxies if len(trusted_proxies) else None
+
+    def client_ip(self, header_value: str) -> Optional[str]:
+        """
+        Returns the client hop of the header, None if there are no hops left of
+        the trusted ones. When every hop examined is a trusted proxy, the
+        leftmost of them is returned as the client.
+        """
+        trusted_proxies = self.trusted_proxies
+        trusted_hops = self.trusted_hops
+        # Empty hops count towards max_hops too, so ",,,,..." is bounded
+        remaining = self.max_hops
+        hops = 0
+        hop = None
+        end = len(header_value)
+        while end >= 0 and remaining:
+            remaining -= 1
+            start = header_value.rfind(",", 0, end)
+            candidate = header_value[start + 1 : end].strip()
+            end = start
+            if candidate:
+                hop = candidate
+                hops += 1
+                if hops > trusted_hops and (
+                    trusted_proxies is None or trusted_proxies.lookup(hop) is None
+                ):
+                    return hop
+        return hop if hops > trusted_hops else None